@@ -12,17 +12,22 @@ from esupy.processed_data_mgmt import load_preprocessed_output
 from flowsa.common import paths, biboutputpath, fbaoutputpath, fbsoutputpath, \
     DEFAULT_DOWNLOAD_IF_MISSING, log, sourceconfigpath, flowbysectormethodpath, load_sourceconfig
 from flowsa.metadata import set_fb_meta
-from flowsa.flowbyfunctions import collapse_fbs_sectors, filter_by_geoscale
+from flowsa.flowbyfunctions import collapse_fbs_sectors, filter_by_geoscale, \
+    create_fba_load_filters
+from flowsa.dataclean import convert_to_compact_dtypes, convert_from_compact_dtypes
 from flowsa.validation import check_for_nonetypes_in_sector_col, check_for_negative_flowamounts
 import flowsa.flowbyactivity
 import flowsa.flowbysector
 from flowsa.bibliography import generate_fbs_bibliography
+from flowsa.validationreport import load_validation_report
 
 
 def getFlowByActivity(datasource, year, flowclass=None, geographic_level=None,
-                      download_if_missing=DEFAULT_DOWNLOAD_IF_MISSING):
+                      download_if_missing=DEFAULT_DOWNLOAD_IF_MISSING, columns=None,
+                      locations=None, activities=None, compact_dtypes=False):
     """
-    Retrieves stored data in the FlowByActivity format
+    Retrieves stored data in the FlowByActivity format. Only the rows and columns
+    requested are read from the stored parquet.
     :param datasource: str, the code of the datasource.
     :param year: int, a year, e.g. 2012
     :param flowclass: str, a 'Class' of the flow. Optional. E.g. 'Water'
@@ -30,6 +35,13 @@ def getFlowByActivity(datasource, year, flowclass=None, geographic_level=None,
                              Optional. E.g. 'national', 'state', 'county'.
     :param download_if_missing: bool, if True will attempt to load from remote server
         prior to generating if file not found locally
+    :param columns: list, columns to load. Optional, defaults to all columns.
+    :param locations: list, Location codes to load. Optional.
+    :param activities: list, activities to load, in either ActivityProducedBy or
+        ActivityConsumedBy. Optional.
+    :param compact_dtypes: bool, True to return the memory saving dtypes in
+        flow_by_fields_compact_dtypes, False to return object, int and float dtypes
+        whichever dtypes the FBA was saved with
     :return: a pandas DataFrame in FlowByActivity format
     """
     from esupy.processed_data_mgmt import download_from_remote
@@ -37,14 +49,25 @@ def getFlowByActivity(datasource, year, flowclass=None, geographic_level=None,
     name = flowsa.flowbyactivity.set_fba_name(datasource, year)
     fba_meta = set_fb_meta(name, "FlowByActivity")
 
+    # only read the rows and columns requested
+    filters = create_fba_load_filters(flowclass=flowclass, geographic_level=geographic_level,
+                                      locations=locations, activities=activities)
+    load_columns = columns
+    if columns is not None and geographic_level is not None:
+        # required to filter by geoscale
+        load_columns = list(columns) + \
+            [c for c in ['Location', 'LocationSystem'] if c not in columns]
+
     # Try to load a local version of fba; generate and load if missing
-    fba = load_preprocessed_output(fba_meta, paths)
+    fba = flowsa.flowbyactivity.load_fba_parquet(fba_meta, load_columns, filters,
+                                                 geographic_level)
     # Remote download
     if fba is None and download_if_missing:
         log.info('%s %s not found in %s, downloading from remote source',
                  datasource, str(year), fbaoutputpath)
         download_from_remote(fba_meta,paths)
-        fba = load_preprocessed_output(fba_meta,paths)
+        fba = flowsa.flowbyactivity.load_fba_parquet(fba_meta, load_columns, filters,
+                                                     geographic_level)
 
     if fba is None:
         log.info('%s %s not found in %s, running functions to generate FBA',
@@ -52,7 +75,8 @@ def getFlowByActivity(datasource, year, flowclass=None, geographic_level=None,
         # Generate the fba
         flowsa.flowbyactivity.main(year=year, source=datasource)
         # Now load the fba
-        fba = load_preprocessed_output(fba_meta, paths)
+        fba = flowsa.flowbyactivity.load_fba_parquet(fba_meta, load_columns, filters,
+                                                     geographic_level)
         if fba is None:
             log.error('getFlowByActivity failed, FBA not found')
         else:
@@ -61,21 +85,27 @@ def getFlowByActivity(datasource, year, flowclass=None, geographic_level=None,
     else:
         log.info('Loaded %s %s from %s', datasource, str(year), fbaoutputpath)
 
-    # Address optional parameters
-    if flowclass is not None:
-        fba = fba[fba['Class'] == flowclass]
     # if geographic level specified, only load rows in geo level
     if geographic_level is not None:
         fba = filter_by_geoscale(fba, geographic_level)
+        if fba is not None and columns is not None:
+            fba = fba[[c for c in columns if c in fba.columns]]
+    if fba is not None:
+        fba = convert_to_compact_dtypes(fba) if compact_dtypes else \
+            convert_from_compact_dtypes(fba)
     return fba
 
 
-def getFlowBySector(methodname, download_if_missing=DEFAULT_DOWNLOAD_IF_MISSING):
+def getFlowBySector(methodname, download_if_missing=DEFAULT_DOWNLOAD_IF_MISSING,
+                    compact_dtypes=False):
     """
     Loads stored FlowBySector output or generates it if it doesn't exist, then loads
     :param methodname: string, Name of an available method for the given class
     :param download_if_missing: bool, if True will attempt to load from remote server
         prior to generating if file not found locally
+    :param compact_dtypes: bool, True to return the memory saving dtypes in
+        flow_by_fields_compact_dtypes, False to return object, int and float dtypes
+        whichever dtypes the FBS was saved with
     :return: dataframe in flow by sector format
     """
     from esupy.processed_data_mgmt import download_from_remote
@@ -105,6 +135,9 @@ def getFlowBySector(methodname, download_if_missing=DEFAULT_DOWNLOAD_IF_MISSING)
             log.info('Loaded %s from %s', methodname, fbsoutputpath)
     else:
         log.info('Loaded %s from %s', methodname, fbsoutputpath)
+    if fbs is not None:
+        fbs = convert_to_compact_dtypes(fbs) if compact_dtypes else \
+            convert_from_compact_dtypes(fbs)
     return fbs
 
 
@@ -137,6 +170,21 @@ def writeFlowBySectorBibliography(methodname):
     generate_fbs_bibliography(methodname)
 
 
+def getValidationReport(methodname, report, run=None, source_name=None, activity_set=None):
+    """
+    Retrieves a validation report saved when generating a FlowBySector
+    :param methodname: string, Name of an available method for the given class
+    :param report: string, report name, ex. 'allocation_ratios', 'fba_fbs_totals',
+        'geographic_totals', 'activity_to_sector_ratios', 'flowamount_diff',
+        'flowamount_diff_totals', 'negative_flowamounts' or 'dropped_sector_data'
+    :param run: string, run of the method, defaults to the latest run
+    :param source_name: string, optional source name to filter by
+    :param activity_set: string, optional activity set to filter by
+    :return: dataframe of the validation report
+    """
+    return load_validation_report(methodname, report, run, source_name, activity_set)
+
+
 def seeAvailableFlowByModels(flowbytype):
     """
     Return available Flow-By-Activity or Flow-By-Sector models
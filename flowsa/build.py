@@ -0,0 +1,165 @@
+# build.py (flowsa)
+# !/usr/bin/env python3
+# coding=utf-8
+"""
+Build FlowBySector methods, first generating any missing FlowByActivity and
+FlowBySector datasets the methods depend on. Missing FBAs are generated in parallel.
+EX: --method Water_national_2015_m1 Land_national_2012 --max_workers 4
+"""
+
+import argparse
+import os
+from esupy.processed_data_mgmt import find_file
+import flowsa.flowbyactivity
+import flowsa.flowbysector
+from flowsa.common import log, paths, sourceconfigpath, find_true_file_path, \
+    create_process_pool_executor, validation_level_key
+from flowsa.metadata import set_fb_meta
+from flowsa.bibliography import generate_list_of_sources_in_fbs_method
+
+
+def parse_args():
+    """
+    Make method and build parameters
+    :return: dictionary, 'method', 'max_workers', 'validation_level' and 'dry_run'
+    """
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-m", "--method", required=True, nargs='+',
+                    help="Method(s) for flow by sector files. "
+                         "A valid method config file must exist with each name.")
+    ap.add_argument("-w", "--max_workers", type=int, default=None,
+                    help="Number of processes to generate missing FBAs in, also used to "
+                         "run the activity sets of each FBS. Runs sequentially if not "
+                         "specified.")
+    ap.add_argument("-v", "--validation_level", choices=list(validation_level_key),
+                    default=None, help="Validation to run when generating FBSs, overrides "
+                                       "the method yamls")
+    ap.add_argument("-n", "--dry_run", action='store_true',
+                    help="List the FBAs and FBSs that would be generated without "
+                         "generating them")
+    args = vars(ap.parse_args())
+    return args
+
+
+def is_fba_source(source):
+    """
+    Determine if a source is generated as a FlowByActivity by flowsa
+    :param source: str, source name
+    :return: bool, True if a FBA method yaml exists for the source
+    """
+    sourcename = find_true_file_path(sourceconfigpath, source, 'yaml')
+    return os.path.isfile(f'{sourceconfigpath}{sourcename}.yaml')
+
+
+def list_method_dependencies(method_name):
+    """
+    List the FlowByActivity and FlowBySector datasets a FBS method loads, including
+    FBAs loaded within functions
+    :param method_name: str, FBS method name
+    :return: list of FBA (source, year) pairs and list of FBS method names
+    """
+    fbas = []
+    for source, year in generate_list_of_sources_in_fbs_method(method_name):
+        # skip allocation functions and values from the literature
+        if year not in [None, 'None'] and is_fba_source(source):
+            fbas.append((source, str(year)))
+    method = flowsa.flowbysector.load_method(method_name)
+    fbs_methods = [k for k, v in method['source_names'].items() if v['data_format'] == 'FBS']
+    return fbas, fbs_methods
+
+
+def resolve_build_order(method_names):
+    """
+    Resolve the dependencies of FBS methods, including FBS methods used as sources
+    :param method_names: list, FBS method names
+    :return: list of FBA (source, year) pairs, and list of FBS method names ordered
+             so each method follows the FBS methods it depends on
+    """
+    fbas = []
+    fbs_order = []
+    visiting = set()
+
+    def visit(method_name):
+        if method_name in fbs_order:
+            return
+        if method_name in visiting:
+            raise ValueError(f'FlowBySector method {method_name} depends on itself')
+        visiting.add(method_name)
+        method_fbas, method_fbs = list_method_dependencies(method_name)
+        fbas.extend(f for f in method_fbas if f not in fbas)
+        for m in method_fbs:
+            visit(m)
+        visiting.remove(method_name)
+        fbs_order.append(method_name)
+
+    for method_name in method_names:
+        visit(method_name)
+    return fbas, fbs_order
+
+
+def fba_exists(source, year):
+    """
+    Determine if a FBA is saved locally
+    :param source: str, source name
+    :param year: str, year
+    :return: bool, True if found
+    """
+    fba_meta = set_fb_meta(flowsa.flowbyactivity.set_fba_name(source, year), "FlowByActivity")
+    return flowsa.flowbyactivity.find_local_fba(fba_meta) is not None
+
+
+def fbs_exists(method_name):
+    """
+    Determine if a FBS is saved locally
+    :param method_name: str, FBS method name
+    :return: bool, True if found
+    """
+    f = find_file(set_fb_meta(method_name, "FlowBySector"), paths)
+    return bool(f) and os.path.exists(f)
+
+
+def main(**kwargs):
+    """
+    Generate missing FBAs and FBSs that FBS methods depend on, then the FBS methods
+    :param kwargs: dictionary of arguments, "method", a list of FBS method names, and
+                   optionally "max_workers", the number of processes to run in,
+                   "validation_level", overriding the method yamls, and
+                   "dry_run", to only list the datasets that would be generated
+    :return: list of FBA (source, year) pairs and list of FBS method names to generate
+    """
+    if len(kwargs) == 0:
+        kwargs = parse_args()
+
+    method_names = kwargs['method']
+    if isinstance(method_names, str):
+        method_names = [method_names]
+    max_workers = kwargs.get('max_workers')
+
+    fbas, fbs_order = resolve_build_order(method_names)
+    # the requested methods are always generated, other datasets only if missing
+    missing_fbas = [(s, y) for s, y in fbas if not fba_exists(s, y)]
+    build_fbs = [m for m in fbs_order if m in method_names or not fbs_exists(m)]
+
+    log.info('FBAs to generate: %s', ', '.join(f'{s} {y}' for s, y in missing_fbas) or 'None')
+    log.info('FBSs to generate: %s', ', '.join(build_fbs))
+    if kwargs.get('dry_run'):
+        return missing_fbas, build_fbs
+
+    if max_workers and len(missing_fbas) > 1:
+        with create_process_pool_executor(max_workers) as executor:
+            futures = [executor.submit(flowsa.flowbyactivity.main, source=s, year=y)
+                       for s, y in missing_fbas]
+            for future in futures:
+                future.result()
+    else:
+        for s, y in missing_fbas:
+            flowsa.flowbyactivity.main(source=s, year=y)
+
+    for m in build_fbs:
+        flowsa.flowbysector.main(method=m, max_workers=max_workers,
+                                 validation_level=kwargs.get('validation_level'))
+    return missing_fbas, build_fbs
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,17 @@ import shutil
 import sys
 import os
 import logging
+import copy
+import glob
+import hashlib
+import json
+import multiprocessing
+import io
+import zipfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 import yaml
 import requests
 import requests_ftp
@@ -35,14 +46,24 @@ externaldatapath = datapath + 'external_data/'
 datasourcescriptspath = MODULEPATH + 'data_source_scripts/'
 
 paths = Paths()
-paths.local_path = os.path.realpath(paths.local_path + "/flowsa")
+# the local data directory can be set with FLOWSA_LOCAL_PATH, e.g. to run against fixture FBAs
+paths.local_path = os.path.realpath(os.environ.get('FLOWSA_LOCAL_PATH',
+                                                   paths.local_path + "/flowsa"))
 outputpath = paths.local_path.replace('\\', '/') + '/'
 fbaoutputpath = outputpath + 'FlowByActivity/'
+fbadatasetpath = fbaoutputpath + 'Partitioned/'
 fbsoutputpath = outputpath + 'FlowBySector/'
 biboutputpath = outputpath + 'Bibliography/'
+httpcachepath = outputpath + 'HTTP_Cache/'
+mappingoutputpath = outputpath + 'ActivityToSectorMapping/'
+activitysetoutputpath = outputpath + 'FlowBySectorActivitySets/'
+allocationfbaoutputpath = outputpath + 'AllocationFBA/'
 logoutputpath = outputpath + 'Log/'
+validationoutputpath = outputpath + 'Validation/'
 
 DEFAULT_DOWNLOAD_IF_MISSING = False
+# seconds to wait to connect to a host, and for data from the host, before a request fails
+HTTP_REQUEST_TIMEOUT = (30, 300)
 
 # paths to scripts
 scriptpath = os.path.dirname(os.path.dirname(os.path.abspath(__file__))).replace('\\', '/') + \
@@ -106,8 +127,9 @@ def rename_log_file(filename, fb_meta):
     :param fb_type: str, 'FlowByActivity' or 'FlowBySector'
     :return: modified log file name
     """
-    # original log file name - all log statements
-    log_file = f'{logoutputpath}{"flowsa.log"}'
+    # original log file name - all log statements, the file the log is currently written
+    # to, see separate_log_files
+    log_file = get_log_file(log)
     # generate new log name
     new_log_name = f'{logoutputpath}{filename}{"_v"}' \
                    f'{fb_meta.tool_version}{"_"}{fb_meta.git_hash}{".log"}'
@@ -116,7 +138,7 @@ def rename_log_file(filename, fb_meta):
     # rename the standard log file name (os.rename throws error if file already exists)
     shutil.copy(log_file, new_log_name)
     # original log file name - validation
-    log_file = f'{logoutputpath}{"validation_flowsa.log"}'
+    log_file = get_log_file(vLogDetailed)
     # generate new log name
     new_log_name = f'{logoutputpath}{filename}_v' \
                    f'{fb_meta.tool_version}_{fb_meta.git_hash}_validation.log'
@@ -125,6 +147,54 @@ def rename_log_file(filename, fb_meta):
     # rename the standard log file name (os.rename throws error if file already exists)
     shutil.copy(log_file, new_log_name)
 
+
+def get_log_file(logger):
+    """
+    Identify the file a logger writes to
+    :param logger: logger, log or vLogDetailed
+    :return: str, path to log file
+    """
+    return [h.baseFilename for h in logger.handlers
+            if isinstance(h, logging.FileHandler)][0]
+
+
+@contextmanager
+def separate_log_files(name):
+    """
+    Write the general and validation logs to separate files while running, such as in
+    a process pool worker running alongside other workers, so the log renamed by
+    rename_log_file only includes the statements of the worker
+    :param name: str, added to the log file names
+    :return: None
+    """
+    handlers = {}
+    for fh, f in [(log_fh, f'{logoutputpath}flowsa_{name}.log'),
+                  (vLog_fh, f'{logoutputpath}validation_flowsa_{name}.log')]:
+        handlers[fh] = logging.FileHandler(f, mode='w')
+        handlers[fh].setFormatter(formatter)
+    swap_log_handlers(handlers)
+    try:
+        yield
+    finally:
+        swap_log_handlers({v: k for k, v in handlers.items()})
+        for fh in handlers.values():
+            fh.close()
+            os.remove(fh.baseFilename)
+
+
+def swap_log_handlers(handlers):
+    """
+    Replace file handlers of the log, vLog and vLogDetailed loggers
+    :param handlers: dictionary, handler to replace and the replacement handler
+    :return: None
+    """
+    for logger in [log, vLog, vLogDetailed]:
+        for h in list(logger.handlers):
+            if h in handlers:
+                logger.removeHandler(h)
+                logger.addHandler(handlers[h])
+
+
 # metadata
 PKG = "flowsa"
 GIT_HASH = get_git_hash()
@@ -132,6 +202,9 @@ GIT_HASH_LONG = get_git_hash('long')
 
 # Common declaration of write format for package data products
 WRITE_FORMAT = "parquet"
+# columns partitioned FBA datasets are split by and maximum rows per row group
+FBA_PARTITION_COLUMNS = ['Class', 'geo']
+FBA_PARTITION_ROW_GROUP_SIZE = 100000
 
 US_FIPS = "00000"
 fips_number_key = {"national": 0,
@@ -144,6 +217,13 @@ sector_level_key = {"NAICS_2": 2,
                     "NAICS_5": 5,
                     "NAICS_6": 6}
 
+# validation levels for FBS method yamls: 'off' skips validation, 'summary' only compares
+# FlowAmount totals, 'full' runs all validation
+validation_level_key = {"off": 0,
+                        "summary": 1,
+                        "full": 2}
+DEFAULT_VALIDATION_LEVEL = 'full'
+
 # withdrawn keyword changed to "none" over "W"
 # because unable to run calculation functions with text string
 WITHDRAWN_KEYWORD = np.nan
@@ -153,6 +233,43 @@ flow_types = ['ELEMENTARY_FLOW', 'TECHNOSPHERE_FLOW', 'WASTE_FLOW']
 # Sets default Sector Source Name
 SECTOR_SOURCE_NAME = 'NAICS_2012_Code'
 
+# unit conversion factors
+days_in_year = 365
+sq_ft_to_sq_m_multiplier = 0.092903
+gallon_water_to_kg = 3.79  # rounded to match USGS_NWIS_WU mapping file on FEDEFL
+ac_ft_water_to_kg = 1233481.84
+acre_to_m2 = 4046.8564224
+mj_in_btu = .0010550559
+ton_to_kg = 907.185
+lb_to_kg = 0.45359
+
+# unit conversions applied by dataclean.standardize_units and convert_fba_unit. Each
+# source unit is converted once, FlowAmount is multiplied by the multiplier, and by the
+# days in a year if the source unit is a flow per day
+unit_conversions = pd.DataFrame(
+    [  # class = land, unit = m2
+     ['ACRES', 'm2', acre_to_m2, False, True, False],
+     ['Acres', 'm2', acre_to_m2, False, True, False],
+     ['million sq ft', 'm2', sq_ft_to_sq_m_multiplier * 1000000, False, True, False],
+     ['million square feet', 'm2', sq_ft_to_sq_m_multiplier * 1000000, False, True, False],
+     ['square feet', 'm2', sq_ft_to_sq_m_multiplier, False, True, False],
+     ['Thousand Acres', 'Acres', 1000, False, False, True],
+     # class = water, unit = kg
+     ['gallons/animal/day', 'kg', gallon_water_to_kg, True, True, False],
+     ['ACRE FEET / ACRE', 'kg/m2', ac_ft_water_to_kg / acre_to_m2, False, True, False],
+     ['Mgal', 'kg', 1000000 * gallon_water_to_kg, False, True, False],
+     ['Bgal/d', 'Mgal', 1000, True, False, True],
+     ['Mgal/d', 'Mgal', 1, True, False, True],
+     ['million Cubic metres/year', 'Mgal', 264.172, False, True, True],
+     # class = energy, unit = MJ
+     ['Quadrillion Btu', 'MJ', mj_in_btu * (10 ** 15), False, True, True],
+     ['Trillion Btu', 'MJ', mj_in_btu * (10 ** 14), False, True, True],
+     # mass units, unit = kg
+     ['TON', 'kg', ton_to_kg, False, True, True],
+     ['LB', 'kg', lb_to_kg, False, True, True]],
+    columns=['SourceUnit', 'TargetUnit', 'Multiplier', 'PerDay',
+             'standardize_units', 'convert_fba_unit']).set_index('SourceUnit')
+
 
 def load_api_key(api_source):
     """
@@ -178,30 +295,117 @@ def load_api_key(api_source):
     return key
 
 
+def create_process_pool_executor(max_workers):
+    """
+    Create a process pool. Where available, workers are forked so they share the
+    loggers of the parent process rather than recreating the log files
+    :param max_workers: int, number of processes
+    :return: ProcessPoolExecutor
+    """
+    start_method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None
+    return ProcessPoolExecutor(max_workers=max_workers,
+                               mp_context=multiprocessing.get_context(start_method))
+
+
+def run_validation(method, level):
+    """
+    Determine if validation of a level is run for a FBS method
+    :param method: dictionary, FBS method yaml, optionally including 'validation_level'
+    :param level: str, validation level of the check ('summary' or 'full')
+    :return: bool, True if the method validation level includes the check
+    """
+    return validation_level_key[method.get('validation_level', DEFAULT_VALIDATION_LEVEL)] >= \
+        validation_level_key[level]
+
+
+def get_peak_rss_mb():
+    """
+    Peak resident set size of the current process
+    :return: float, MB, or None if not available on the platform
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on macOS and kilobytes on linux
+    return maxrss / 1e6 if sys.platform == 'darwin' else maxrss / 1e3
+
+
+def get_current_rss_mb():
+    """
+    Current resident set size of the current process, read from /proc on linux
+    :return: float, MB, or None if not available on the platform
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+@contextmanager
+def record_stage(stage_times, stage, source, activity_set=None, df_in=None):
+    """
+    Record the wall time, CPU time, row counts and memory of a stage in creating a
+    dataset. 'rss_change_mb' is the change in the current memory of the process over the
+    stage, 'process_peak_rss_mb' is the peak memory of the process so far, including
+    earlier stages. Set 'rows_out' in the yielded record to the rows the stage returns.
+    :param stage_times: list, records of the stages, the record of the stage is appended
+    :param stage: str, stage name
+    :param source: str, source name
+    :param activity_set: str, activity set, if the stage is run for an activity set
+    :param df_in: df, input to the stage
+    :return: dictionary, record of the stage
+    """
+    record = {'source': source, 'activity_set': activity_set, 'stage': stage,
+              'rows_in': None if df_in is None else len(df_in), 'rows_out': None}
+    rss = get_current_rss_mb()
+    wall_time = time.perf_counter()
+    cpu_time = time.process_time()
+    yield record
+    record['wall_seconds'] = round(time.perf_counter() - wall_time, 4)
+    record['cpu_seconds'] = round(time.process_time() - cpu_time, 4)
+    rss_out = get_current_rss_mb()
+    record['rss_change_mb'] = None if rss is None or rss_out is None else \
+        round(rss_out - rss, 1)
+    peak_rss = get_peak_rss_mb()
+    record['process_peak_rss_mb'] = None if peak_rss is None else round(peak_rss, 1)
+    stage_times.append(record)
+
+
 def make_http_request(url, **kwargs):
     """
     Makes http request using requests library
     :param url: URL to query
-    :return: request Object
+    :param kwargs: optional 'requests_session', 'set_cookies', 'headers', 'timeout'
+                   (defaults to HTTP_REQUEST_TIMEOUT) and 'http_cache'
+                   (see make_cached_http_request)
+    :return: request Object, connection errors and timeouts are raised
     """
+    if kwargs.get('http_cache') is not None:
+        return make_cached_http_request(url, **kwargs)
+
     if 'requests_session' in kwargs:
         s = kwargs['requests_session']
     else:
         s = requests
+    timeout = kwargs.get('timeout') or HTTP_REQUEST_TIMEOUT
 
-    r = []
     try:
-        r = s.get(url) #requests.get(url)
+        r = s.get(url, headers=kwargs.get('headers'), timeout=timeout) #requests.get(url)
         # determine if require request.post to set cookies
         if 'set_cookies' in kwargs:
             if kwargs['set_cookies'] == 'yes':
                 cookies = dict(r.cookies)
-                r = s.post(url, verify=True, cookies=cookies)
+                r = s.post(url, verify=True, cookies=cookies, timeout=timeout)
     except requests.exceptions.InvalidSchema:  # if url is ftp rather than http
         requests_ftp.monkeypatch_session()
-        r = requests.Session().get(url)
-    except requests.exceptions.ConnectionError:
+        r = requests.Session().get(url, timeout=timeout)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
         log.error("URL Connection Error for %s", url)
+        raise
     try:
         r.raise_for_status()
     except requests.exceptions.HTTPError:
@@ -209,12 +413,147 @@ def make_http_request(url, **kwargs):
     return r
 
 
+def make_cached_http_request(url, **kwargs):
+    """
+    Makes http request, storing the raw response in the local http cache. Cached
+    responses are revalidated with their ETag or Last-Modified headers, or in offline
+    mode are returned without a request
+    :param url: URL to query
+    :param kwargs: 'http_cache', either 'use' to revalidate cached responses or 'offline'
+                   to only use cached responses, and the kwargs of make_http_request
+    :return: request Object
+    """
+    # key cached responses by the url and how the request is made
+    cache_key = hashlib.sha256(
+        f"{url}|{kwargs.get('set_cookies', 'no')}".encode()).hexdigest()
+    cached = load_cached_response(cache_key)
+    if kwargs['http_cache'] == 'offline':
+        if cached is None:
+            raise FileNotFoundError(f'No cached response for {url}, '
+                                    f'run without offline mode to download')
+        log.info("Using cached response for %s", url)
+        return cached
+
+    headers = {}
+    if cached is not None:
+        if 'ETag' in cached.headers:
+            headers['If-None-Match'] = cached.headers['ETag']
+        if 'Last-Modified' in cached.headers:
+            headers['If-Modified-Since'] = cached.headers['Last-Modified']
+    request_kwargs = {k: v for k, v in kwargs.items() if k not in ('http_cache', 'headers')}
+    r = make_http_request(url, headers=headers, **request_kwargs)
+    if cached is not None and r.status_code == 304:
+        log.info("Cached response for %s is unchanged", url)
+        return cached
+    if r.status_code < 400:
+        store_response_in_cache(cache_key, r)
+    return r
+
+
+def store_response_in_cache(cache_key, r):
+    """
+    Save the raw content and metadata of a response to the local http cache
+    :param cache_key: str, hash of the request
+    :param r: request Object
+    :return: None
+    """
+    create_paths_if_missing(httpcachepath)
+    with open(f'{httpcachepath}{cache_key}.raw', 'wb') as f:
+        f.write(r.content)
+    # metadata is written last, so only complete responses are loaded
+    meta = {'url': r.url,
+            'status_code': r.status_code,
+            'encoding': r.encoding,
+            'headers': dict(r.headers)}
+    with open(f'{httpcachepath}{cache_key}.json', 'w') as f:
+        json.dump(meta, f)
+
+
+def load_cached_response(cache_key):
+    """
+    Load a response from the local http cache
+    :param cache_key: str, hash of the request
+    :return: request Object, None if the response is not cached
+    """
+    try:
+        with open(f'{httpcachepath}{cache_key}.json', 'r') as f:
+            meta = json.load(f)
+        with open(f'{httpcachepath}{cache_key}.raw', 'rb') as f:
+            content = f.read()
+    except FileNotFoundError:
+        return None
+    r = requests.models.Response()
+    r.url = meta['url']
+    r.status_code = meta['status_code']
+    r.encoding = meta['encoding']
+    r.headers = requests.structures.CaseInsensitiveDict(meta['headers'])
+    r._content = content
+    return r
+
+
+def read_zipped_csvs(response, name_filter, chunk_fxn=None, groupbycols=None,
+                     chunksize=100000, **kwargs):
+    """
+    Read the csv files in a zip file response in chunks, filtering and summing each
+    chunk as it is read, so only the reduced data is held in memory
+    :param response: request Object, response of a zip file
+    :param name_filter: function, True for the names of the files to read
+    :param chunk_fxn: function, modifies a chunk df, such as dropping rows not needed
+    :param groupbycols: list, columns to sum the remaining columns by, optional
+    :param chunksize: int, number of rows to read at a time
+    :param kwargs: arguments passed to pd.read_csv, such as usecols and dtype
+    :return: df, data from all csv files
+    """
+    def sum_chunks(dfs):
+        df = pd.concat(dfs, ignore_index=True, sort=False)
+        if groupbycols is not None:
+            df = df.groupby(groupbycols, dropna=False, sort=False).sum(min_count=1).reset_index()
+        return df
+
+    df_list = []
+    with zipfile.ZipFile(io.BytesIO(response.content)) as z:
+        for name in filter(name_filter, z.namelist()):
+            with z.open(name) as f:
+                for chunk in pd.read_csv(f, chunksize=chunksize, **kwargs):
+                    if chunk_fxn is not None:
+                        chunk = chunk_fxn(chunk)
+                    df_list.append(sum_chunks([chunk]))
+                    # periodically combine the reduced chunks
+                    if len(df_list) == 50:
+                        df_list = [sum_chunks(df_list)]
+    if len(df_list) == 0:
+        return pd.DataFrame()
+    return sum_chunks(df_list)
+
+
+# reference csv files read from the data directory, keyed by file path and
+# read_csv arguments, with the file modification time
+csv_cache = {}
+
+
+def load_csv_df(filepath, **kwargs):
+    """
+    Read a reference csv file, only reading the file again if it was modified
+    since the last load
+    :param filepath: str, path to the csv file
+    :param kwargs: arguments passed to pd.read_csv
+    :return: df, a copy of the csv contents that can be safely modified
+    """
+    mtime = os.stat(filepath).st_mtime_ns
+    key = (filepath, repr(sorted(kwargs.items())))
+    cached = csv_cache.get(key)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, pd.read_csv(filepath, **kwargs))
+        csv_cache[key] = cached
+    return cached[1].copy()
+
+
 def load_sector_crosswalk():
     """
     Load NAICS crosswalk between the years 2007, 2012, 2017
     :return: df, NAICS crosswalk over the years
     """
-    cw = pd.read_csv(datapath + "NAICS_Crosswalk.csv", dtype="str")
+    cw = load_csv_df(datapath + "NAICS_Crosswalk.csv", dtype="str")
     return cw
 
 
@@ -223,16 +562,77 @@ def load_sector_length_crosswalk():
     Load the 2-digit to 6-digit NAICS crosswalk for 2012
     :return: df, NAICS 2012 crosswalk by sector length
     """
-    cw = pd.read_csv(datapath + 'NAICS_2012_Crosswalk.csv', dtype='str')
+    cw = load_csv_df(datapath + 'NAICS_2012_Crosswalk.csv', dtype='str')
+    return cw
+
+
+@lru_cache(maxsize=None)
+def load_sector_sole_child_crosswalk():
+    """
+    Map each 2- to 5-digit NAICS 2012 sector that has a single 6-digit descendant
+    to its child one digit longer. Chaining the maps for consecutive lengths walks a
+    sector down to its only 6-digit descendant. Built once per session, do not modify.
+    :return: dictionary, sector length as key, pd.Series of child sectors indexed
+             by parent sector as value
+    """
+    cw_load = load_sector_length_crosswalk()
+    sole_child = {}
+    for i in range(2, 6):
+        sector_merge = 'NAICS_' + str(i)
+        sector_add = 'NAICS_' + str(i+1)
+        # only keep the rows where there is only one value in sector_add for a value in sector_merge
+        cw = cw_load[[sector_merge, sector_add]].drop_duplicates(subset=[sector_merge], keep=False)
+        sole_child[i] = cw.set_index(sector_merge)[sector_add]
+    return sole_child
+
+
+@lru_cache(maxsize=None)
+def load_sector_descendant_crosswalk(target_sector_level):
+    """
+    Map each NAICS 2012 sector shorter than the target sector level to its descendants
+    at the target sector level, along with the number of descendants.
+    Built once per target sector level, do not modify.
+    :param target_sector_level: str, target NAICS level, e.g. 'NAICS_6'
+    :return: df with columns 'SectorLength', 'Sector', 'Descendant', 'DescendantCount'
+    """
+    cw_load = load_sector_length_crosswalk()
+    cw_list = []
+    for nlength, i in sector_level_key.items():
+        if i < sector_level_key[target_sector_level]:
+            cw = cw_load[[nlength, target_sector_level]].drop_duplicates()
+            cw_list.append(pd.DataFrame({'SectorLength': i,
+                                         'Sector': cw[nlength],
+                                         'Descendant': cw[target_sector_level]}))
+    cw = pd.concat(cw_list, ignore_index=True)
+    # some non-NAICS codes repeat across sector lengths, so count within each length
+    cw['DescendantCount'] = cw.groupby(['SectorLength', 'Sector'])['Descendant'].transform('count')
     return cw
 
 
+@lru_cache(maxsize=None)
+def load_sorted_sector_codes(sectorsourcename):
+    """
+    Load the unique sector codes for a NAICS year from the master crosswalk, sorted so
+    all codes that start with a prefix are a contiguous slice. Built once per
+    sectorsourcename, do not modify.
+    :param sectorsourcename: str, sectorsourcename for naics year
+    :return: pd.Series of sector codes sorted by code, indexed by order in the crosswalk
+    """
+    cw = load_sector_crosswalk()
+    sectors = cw[sectorsourcename].drop_duplicates().dropna()
+    # drop rows that contain hyphenated sectors
+    sectors = sectors[~sectors.str.contains("-")].reset_index(drop=True)
+    # Ensure 'None' not added to sectors
+    sectors = sectors[sectors != "None"]
+    return sectors.sort_values(kind='mergesort')
+
+
 def load_household_sector_codes():
     """
     Load manually added household sector codes from csv
     :return: df, household sector codes
     """
-    household = pd.read_csv(datapath + 'Household_SectorCodes.csv', dtype='str')
+    household = load_csv_df(datapath + 'Household_SectorCodes.csv', dtype='str')
     return household
 
 
@@ -241,7 +641,7 @@ def load_government_sector_codes():
     Load the government sector codes from csv
     :return: df, government sector codes
     """
-    government = pd.read_csv(datapath + 'Government_SectorCodes.csv', dtype='str')
+    government = load_csv_df(datapath + 'Government_SectorCodes.csv', dtype='str')
     return government
 
 
@@ -250,18 +650,108 @@ def load_bea_crosswalk():
     Load the BEA crosswalk
     :return: df, BEA crosswalk
     """
-    cw = pd.read_csv(datapath + "BEA_Crosswalk.csv", dtype="str")
+    cw = load_csv_df(datapath + "BEA_Crosswalk.csv", dtype="str")
     return cw
 
 
+# parsed yaml files, keyed by file path, with the file modification time
+yaml_cache = {}
+
+
+def load_yaml_dict(filepath):
+    """
+    Load a yaml file, only parsing the file again if it was modified since the last load
+    :param filepath: str, path to the yaml file
+    :return: dictionary, a copy of the yaml contents that can be safely modified
+    """
+    mtime = os.stat(filepath).st_mtime_ns
+    cached = yaml_cache.get(filepath)
+    if cached is None or cached[0] != mtime:
+        with open(filepath, 'r') as f:
+            cached = (mtime, yaml.safe_load(f))
+        yaml_cache[filepath] = cached
+    return copy.deepcopy(cached[1])
+
+
+def get_file_info(filepaths):
+    """
+    Identify the version of files by their modification time and size, used to
+    determine if stored outputs created from the files are out of date
+    :param filepaths: list, paths to files, paths that do not exist are skipped
+    :return: list of (path, modification time, size)
+    """
+    return [(f, os.stat(f).st_mtime_ns, os.stat(f).st_size)
+            for f in filepaths if os.path.exists(f)]
+
+
+def get_data_files():
+    """
+    List the crosswalks, sector code lists, external data and config files in the flowsa
+    data folder that FBSs are created from, excluding the FBA and FBS method yamls and
+    activity set and activity-to-sector mapping files, which are listed per source
+    :return: list, paths to files
+    """
+    files = glob.glob(datapath + '*') + glob.glob(datapath + 'bibliographyinfo/*') + \
+        glob.glob(externaldatapath + '**/*', recursive=True)
+    return sorted(f.replace('\\', '/') for f in files
+                  if os.path.isfile(f) and not f.endswith('.md'))
+
+
+@lru_cache()
+def hash_file_contents(filepaths):
+    """
+    Hash the contents of files, such as the modules used to create an output
+    :param filepaths: tuple, paths to files, paths that do not exist are skipped
+    :return: str, hash of the file contents
+    """
+    file_hash = hashlib.sha256()
+    for f in filepaths:
+        if os.path.isfile(f):
+            with open(f, 'rb') as file:
+                file_hash.update(file.read())
+    return file_hash.hexdigest()
+
+
+def write_parquet_atomically(df, filepath):
+    """
+    Save a df as a parquet by writing a temporary file and renaming it, so other
+    processes loading the file never read a partially written parquet
+    :param df: df
+    :param filepath: str, path of the parquet
+    :return: None
+    """
+    tmp_file = f'{filepath}.{os.getpid()}.tmp'
+    try:
+        df.to_parquet(tmp_file)
+        os.replace(tmp_file, filepath)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def remove_stale_files(pattern, keep=0):
+    """
+    Remove the files matching a glob pattern, other than the most recently modified
+    :param pattern: str, glob pattern, with special characters in fixed parts escaped
+    :param keep: int, number of the most recently modified files to keep
+    :return: None
+    """
+    files = sorted(glob.glob(pattern), key=os.path.getmtime, reverse=True)
+    for f in files[keep:]:
+        try:
+            os.remove(f)
+        except OSError:
+            # the file is removed by another process
+            pass
+
+
 def load_source_catalog():
     """
     Load the information in 'source_catalog.yaml'
     :return: dictionary containing all information in source_catalog.yaml
     """
     sources = datapath + 'source_catalog.yaml'
-    with open(sources, 'r') as f:
-        config = yaml.safe_load(f)
+    config = load_yaml_dict(sources)
     return config
 
 
@@ -272,8 +762,7 @@ def load_sourceconfig(source):
     :return: dictionary, information on the source method
     """
     sfile = sourceconfigpath + source + '.yaml'
-    with open(sfile, 'r') as f:
-        config = yaml.safe_load(f)
+    config = load_yaml_dict(sfile)
     return config
 
 
@@ -284,8 +773,7 @@ def load_values_from_literature_citations_config():
     :return: dictionary of the values from the literature information
     """
     sfile = datapath + 'bibliographyinfo/values_from_literature_source_citations.yaml'
-    with open(sfile, 'r') as f:
-        config = yaml.safe_load(f)
+    config = load_yaml_dict(sfile)
     return config
 
 
@@ -296,8 +784,7 @@ def load_fbs_methods_additional_fbas_config():
     :return: dictionary of the values from the literature information
     """
     sfile = datapath + 'bibliographyinfo/fbs_methods_additional_fbas.yaml'
-    with open(sfile, 'r') as f:
-        config = yaml.safe_load(f)
+    config = load_yaml_dict(sfile)
     return config
 
 
@@ -308,8 +795,7 @@ def load_functions_loading_fbas_config():
     :return: dictionary of the values from the literature information
     """
     sfile = datapath + 'bibliographyinfo/functions_loading_fbas.yaml'
-    with open(sfile, 'r') as f:
-        config = yaml.safe_load(f)
+    config = load_yaml_dict(sfile)
     return config
 
 
@@ -479,6 +965,32 @@ flow_by_activity_mapped_wsec_fields = \
      'ConsumedBySectorType': [{'dtype': 'str'}, {'required': False}]
      }
 
+# Optional compact dtypes for saved and loaded flowbyactivity and flowbysector dfs, see
+# dataclean.convert_to_compact_dtypes. Low cardinality string fields are stored as categories.
+# Data quality scores are weighted averages after aggregation, so are stored as
+# float32 rather than integers
+flow_by_fields_compact_dtypes = \
+    {'Class': 'category',
+     'SourceName': 'category',
+     'Flowable': 'category',
+     'Unit': 'category',
+     'FlowType': 'category',
+     'Compartment': 'category',
+     'Context': 'category',
+     'Location': 'category',
+     'LocationSystem': 'category',
+     'SectorSourceName': 'category',
+     'MeasureofSpread': 'category',
+     'DistributionType': 'category',
+     'MetaSources': 'category',
+     'Year': 'int16',
+     'DataReliability': 'float32',
+     'TemporalCorrelation': 'float32',
+     'GeographicalCorrelation': 'float32',
+     'TechnologicalCorrelation': 'float32',
+     'DataCollection': 'float32'
+     }
+
 # A list of activity fields in each flow data format
 activity_fields = {'ProducedBy': [{'flowbyactivity': 'ActivityProducedBy'},
                                   {'flowbysector': 'SectorProducedBy'}],
@@ -546,7 +1058,7 @@ def read_stored_FIPS(year='2015'):
     :return: df, FIPS for specified year
     """
 
-    FIPS_df = pd.read_csv(datapath + "FIPS_Crosswalk.csv", header=0, dtype=str)
+    FIPS_df = load_csv_df(datapath + "FIPS_Crosswalk.csv", header=0, dtype=str)
     # subset columns by specified year
     df = FIPS_df[["State", "FIPS_" + year, "County_" + year]]
     # rename columns
@@ -765,7 +1277,7 @@ def get_region_and_division_codes():
     Load the Census Regions csv
     :return: pandas df of census regions
     """
-    df = pd.read_csv(datapath + "Census_Regions_and_Divisions.csv", dtype="str")
+    df = load_csv_df(datapath + "Census_Regions_and_Divisions.csv", dtype="str")
     return df
 
 
@@ -817,54 +1329,26 @@ def convert_fba_unit(df):
     :param df: df, FBA flowbyactivity
     :return: df, FBA with standarized units
     """
-    # Convert Water units 'Bgal/d' and 'Mgal/d' to Mgal
-    days_in_year = 365
-    df.loc[:, 'FlowAmount'] = np.where(df['Unit'] == 'Bgal/d',
-                                       df['FlowAmount'] * 1000 * days_in_year, df['FlowAmount'])
-    df.loc[:, 'Unit'] = np.where(df['Unit'] == 'Bgal/d', 'Mgal', df['Unit'])
-
-    df.loc[:, 'FlowAmount'] = np.where(df['Unit'] == 'Mgal/d',
-                                       df['FlowAmount'] * days_in_year, df['FlowAmount'])
-    df.loc[:, 'Unit'] = np.where(df['Unit'] == 'Mgal/d', 'Mgal', df['Unit'])
-
-    # Convert Land unit 'Thousand Acres' to 'Acres
-    acres_in_thousand_acres = 1000
-    df.loc[:, 'FlowAmount'] = np.where(df['Unit'] == 'Thousand Acres',
-                                       df['FlowAmount'] * acres_in_thousand_acres,
-                                       df['FlowAmount'])
-    df.loc[:, 'Unit'] = np.where(df['Unit'] == 'Thousand Acres', 'Acres', df['Unit'])
-
-    # Convert Energy unit "Quadrillion Btu" to MJ
-    mj_in_btu = .0010550559
-    # 1 Quad = .0010550559 x 10^15
-    df.loc[:, 'FlowAmount'] = np.where(df['Unit'] == 'Quadrillion Btu',
-                                       df['FlowAmount'] * mj_in_btu * (10 ** 15),
-                                       df['FlowAmount'])
-    df.loc[:, 'Unit'] = np.where(df['Unit'] == 'Quadrillion Btu', 'MJ', df['Unit'])
-
-    # Convert Energy unit "Trillion Btu" to MJ
-    # 1 Tril = .0010550559 x 10^14
-    df.loc[:, 'FlowAmount'] = np.where(df['Unit'] == 'Trillion Btu',
-                                       df['FlowAmount'] * mj_in_btu * (10 ** 14),
-                                       df['FlowAmount'])
-    df.loc[:, 'Unit'] = np.where(df['Unit'] == 'Trillion Btu', 'MJ', df['Unit'])
+    df = apply_unit_conversions(df, unit_conversions[unit_conversions['convert_fba_unit']])
+    return df
 
-    df.loc[:, 'FlowAmount'] = np.where(df['Unit'] == 'million Cubic metres/year',
-                                       df['FlowAmount'] * 264.172, df['FlowAmount'])
-    df.loc[:, 'Unit'] = np.where(df['Unit'] == 'million Cubic metres/year', 'Mgal', df['Unit'])
 
-    # Convert mass units (LB or TON) to kg
-    ton_to_kg = 907.185
-    lb_to_kg = 0.45359
-    df.loc[:, 'FlowAmount'] = np.where(df['Unit'] == 'TON',
-                                       df['FlowAmount'] * ton_to_kg,
-                                       df['FlowAmount'])
-    df.loc[:, 'FlowAmount'] = np.where(df['Unit'] == 'LB',
-                                       df['FlowAmount'] * lb_to_kg,
+def apply_unit_conversions(df, conversions):
+    """
+    Convert FlowAmount and Unit in a single pass using a table of unit conversions
+    :param df: df with 'FlowAmount' and 'Unit' columns
+    :param conversions: df indexed by source unit, with columns 'TargetUnit',
+           'Multiplier' and 'PerDay', see unit_conversions
+    :return: df with converted FlowAmount and Unit
+    """
+    multiplier = conversions['Multiplier'].where(~conversions['PerDay'],
+                                                 conversions['Multiplier'] * days_in_year)
+    converted = df['Unit'].isin(conversions.index)
+    df.loc[:, 'FlowAmount'] = np.where(converted,
+                                       df['FlowAmount'] * df['Unit'].map(multiplier),
                                        df['FlowAmount'])
-    df.loc[:, 'Unit'] = np.where((df['Unit'] == 'TON') | (df['Unit'] == 'LB'),
-                                 'kg', df['Unit'])
-
+    df.loc[:, 'Unit'] = np.where(converted, df['Unit'].map(conversions['TargetUnit']),
+                                 df['Unit'])
     return df
 
 
@@ -11,16 +11,19 @@ This script is designed to run with a configuration parameter
 --year = 'year' e.g. 2015
 """
 
-import zipfile
-import io
 import pandas as pd
 import numpy as np
 from flowsa.common import US_FIPS, fba_default_grouping_fields, flow_by_activity_wsec_fields, \
-    flow_by_activity_mapped_wsec_fields
+    flow_by_activity_mapped_wsec_fields, read_zipped_csvs
 from flowsa.flowbyfunctions import assign_fips_location_system, \
     aggregator
 from flowsa.dataclean import add_missing_flow_by_fields, replace_strings_with_NoneType
 
+# columns read from the QCEW single files
+qcew_dtypes = {'area_fips': str, 'own_code': str, 'industry_code': str, 'year': str,
+               'annual_avg_estabs': float, 'annual_avg_emplvl': float,
+               'total_annual_wages': float}
+
 
 def BLS_QCEW_URL_helper(**kwargs):
     """
@@ -62,22 +65,18 @@ def bls_qcew_call(**kwargs):
     # load arguments necessary for function
     response_load = kwargs['r']
 
-    # initiate dataframes list
-    df_list = []
-    # unzip folder that contains bls data in ~4000 csv files
-    with zipfile.ZipFile(io.BytesIO(response_load.content), "r") as f:
-        # read in file names
-        for name in f.namelist():
-            # Only want state info
-            if "singlefile" in name:
-                data = f.open(name)
-                df_state = pd.read_csv(data, header=0, dtype=str)
-                df_list.append(df_state)
-                # concat data into single dataframe
-                df = pd.concat(df_list, sort=False)
-                df = df[['area_fips', 'own_code', 'industry_code', 'year',
-                         'annual_avg_estabs', 'annual_avg_emplvl', 'total_annual_wages']]
-        return df
+    def drop_unused_rows(df):
+        # drop area types and ownership codes not used in the FBA
+        df = df[~df['area_fips'].str.contains('C|USCMS|USMSA|USNMS')]
+        return df[df['own_code'].isin(['1', '2', '3', '5'])]
+
+    # unzip folder that contains bls data, only reading the columns used, and sum
+    # flows by area, ownership and industry as the data is read
+    df = read_zipped_csvs(response_load, lambda name: "singlefile" in name,
+                          chunk_fxn=drop_unused_rows,
+                          groupbycols=['area_fips', 'own_code', 'industry_code', 'year'],
+                          usecols=list(qcew_dtypes), dtype=qcew_dtypes)
+    return df
 
 
 def bls_qcew_parse(**kwargs):
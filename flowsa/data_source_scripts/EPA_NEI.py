@@ -5,11 +5,30 @@
 Pulls EPA National Emissions Inventory (NEI) data for nonpoint sources
 """
 
-import io
-import zipfile
 import pandas as pd
 from flowsa.flowbyfunctions import assign_fips_location_system
-from flowsa.common import convert_fba_unit
+from flowsa.common import convert_fba_unit, read_zipped_csvs
+
+# columns used in the NEI data summaries by year, and the FBA fields they are renamed to
+nei_columns = {'2017': {"pollutant desc": "FlowName",
+                        "total emissions": "FlowAmount",
+                        "scc": "ActivityProducedBy",
+                        "fips code": "Location",
+                        "emissions uom": "Unit",
+                        "pollutant code": "Description"},
+               '2014': {"pollutant_desc": "FlowName",
+                        "total_emissions": "FlowAmount",
+                        "scc": "ActivityProducedBy",
+                        "state_and_county_fips_code": "Location",
+                        "uom": "Unit",
+                        "pollutant_cd": "Description"},
+               '2011': {"description": "FlowName",
+                        "total_emissions": "FlowAmount",
+                        "scc": "ActivityProducedBy",
+                        "state_and_county_fips_code": "Location",
+                        "uom": "Unit",
+                        "pollutant_cd": "Description"}}
+nei_columns['2008'] = nei_columns['2011']
 
 
 def epa_nei_url_helper(**kwargs):
@@ -59,19 +78,24 @@ def epa_nei_call(**kwargs):
     """
     # load arguments necessary for function
     response_load = kwargs['r']
+    args = kwargs['args']
 
-    z = zipfile.ZipFile(io.BytesIO(response_load.content))
-    # create a list of files contained in the zip archive
-    znames = z.namelist()
-    # retain only those files that are in .csv format
-    znames = [s for s in znames if '.csv' in s]
-    # initialize the dataframe
-    df = pd.DataFrame()
-    # for all of the .csv data files in the .zip archive,
-    # read the .csv files into a dataframe
-    # and concatenate with the master dataframe
-    for i in range(len(znames)):
-        df = pd.concat([df, pd.read_csv(z.open(znames[i]))])
+    columns = nei_columns[args['year']]
+    amount_col = next(k for k, v in columns.items() if v == 'FlowAmount')
+    location_col = next(k for k, v in columns.items() if v == 'Location')
+
+    def drop_excluded_fips(df):
+        # remove records from certain FIPS
+        fips = df[location_col].apply('{:0>5}'.format)
+        return df[~fips.str[0:2].isin(['78', '85', '88']) & ~fips.str[-3:].isin(['777'])]
+
+    # for all of the .csv data files in the .zip archive, read the columns used into a
+    # dataframe, summing emissions by the remaining columns as the data is read
+    df = read_zipped_csvs(response_load, lambda name: '.csv' in name,
+                          chunk_fxn=drop_excluded_fips,
+                          groupbycols=[k for k in columns if k != amount_col],
+                          usecols=lambda c: c in columns,
+                          dtype={k: float if k == amount_col else str for k in columns})
     return df
 
 
@@ -90,29 +114,7 @@ def epa_nei_global_parse(**kwargs):
     df = pd.concat(dataframe_list, sort=True)
 
     # rename columns to match flowbyactivity format
-    if args['year'] == '2017':
-        df = df.rename(columns={"pollutant desc": "FlowName",
-                                "total emissions": "FlowAmount",
-                                "scc": "ActivityProducedBy",
-                                "fips code": "Location",
-                                "emissions uom": "Unit",
-                                "pollutant code": "Description"})
-
-    elif args['year'] == '2014':
-        df = df.rename(columns={"pollutant_desc": "FlowName",
-                                "total_emissions": "FlowAmount",
-                                "scc": "ActivityProducedBy",
-                                "state_and_county_fips_code": "Location",
-                                "uom": "Unit",
-                                "pollutant_cd": "Description"})
-
-    elif args['year'] == '2011' or args['year'] == '2008':
-        df = df.rename(columns={"description": "FlowName",
-                                "total_emissions": "FlowAmount",
-                                "scc": "ActivityProducedBy",
-                                "state_and_county_fips_code": "Location",
-                                "uom": "Unit",
-                                "pollutant_cd": "Description"})
+    df = df.rename(columns=nei_columns[args['year']])
 
     # make sure FIPS are string and 5 digits
     df['Location'] = df['Location'].astype('str').apply('{:0>5}'.format)
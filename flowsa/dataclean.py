@@ -6,7 +6,9 @@ Common functions to clean and harmonize dataframes
 """
 
 import numpy as np
-from flowsa.common import log
+import pandas as pd
+from flowsa.common import log, flow_by_fields_compact_dtypes, unit_conversions, \
+    apply_unit_conversions
 
 
 def clean_df(df, flowbyfields, fill_na_dict, drop_description=True):
@@ -35,6 +37,40 @@ def clean_df(df, flowbyfields, fill_na_dict, drop_description=True):
     return df
 
 
+def convert_to_compact_dtypes(df):
+    """
+    Convert columns to the dtypes in flow_by_fields_compact_dtypes, storing low
+    cardinality string fields as categories to reduce the memory use of large dfs. Only
+    applied to saved and loaded FBAs and FBSs, as new values cannot be assigned to
+    categories while a df is created.
+    :param df: df, Either flowbyactivity or flowbysector
+    :return: df, with compact dtypes
+    """
+    # columns without values are left as objects, as parquet does not keep the
+    # category dtype of columns without values
+    dtypes = {k: v for k, v in flow_by_fields_compact_dtypes.items()
+              if k in df.columns and (v != 'category' or df[k].notnull().any())}
+    df = df.astype(dtypes)
+    return df
+
+
+def convert_from_compact_dtypes(df):
+    """
+    Convert columns stored with the dtypes in flow_by_fields_compact_dtypes back to
+    the object, int and float dtypes used when creating flowbyactivity and
+    flowbysector dfs
+    :param df: df, Either flowbyactivity or flowbysector
+    :return: df, without compact dtypes
+    """
+    standard_dtypes = {'category': object, 'int16': 'int64', 'float32': 'float64'}
+    dtypes = {k: standard_dtypes[v] for k, v in flow_by_fields_compact_dtypes.items()
+              if k in df.columns and df[k].dtype == v}
+    if len(dtypes) == 0:
+        return df
+    df = df.astype(dtypes)
+    return replace_strings_with_NoneType(df)
+
+
 def replace_strings_with_NoneType(df):
     """
     Ensure that cell values in columns with datatype = string remain NoneType
@@ -42,9 +78,18 @@ def replace_strings_with_NoneType(df):
     :return: A df where values are NoneType if they are supposed to be
     """
     # if datatypes are strings, ensure that Null values remain NoneType
+    # only assign to columns with values to replace, assigning through .loc
+    # is slower than the check and most columns are already converted
     for y in df.columns:
         if df[y].dtype == object:
-            df.loc[df[y].isin(['nan', 'None', np.nan, '']), y] = None
+            null_cells = df[y].isin(['nan', 'None', np.nan, ''])
+            if null_cells.any():
+                df.loc[null_cells, y] = None
+        elif isinstance(df[y].dtype, pd.CategoricalDtype):
+            # removing a category sets its values to null
+            null_categories = df[y].cat.categories.intersection(['nan', 'None', ''])
+            if len(null_categories) > 0:
+                df[y] = df[y].cat.remove_categories(null_categories)
     return df
 
 
@@ -57,7 +102,14 @@ def replace_NoneType_with_empty_cells(df):
     # if datatypes are strings, change NoneType to empty cells
     for y in df.columns:
         if df[y].dtype == object:
-            df.loc[df[y].isin(['nan', 'None', np.nan, None]), y] = ''
+            null_cells = df[y].isin(['nan', 'None', np.nan, None])
+            if null_cells.any():
+                df.loc[null_cells, y] = ''
+        elif isinstance(df[y].dtype, pd.CategoricalDtype):
+            # empty cells must be a category before they can be assigned
+            col = replace_strings_with_NoneType(df[[y]])[y]
+            if col.isnull().any():
+                df[y] = col.cat.add_categories('').fillna('')
     return df
 
 
@@ -87,85 +139,13 @@ def standardize_units(df):
     :param df: df, Either flowbyactivity or flowbysector
     :return: df, with standarized units
     """
-
-    days_in_year = 365
-    sq_ft_to_sq_m_multiplier = 0.092903
-    gallon_water_to_kg = 3.79  # rounded to match USGS_NWIS_WU mapping file on FEDEFL
-    ac_ft_water_to_kg = 1233481.84
-    acre_to_m2 = 4046.8564224
-    mj_in_btu = .0010550559
-    ton_to_kg = 907.185
-    lb_to_kg = 0.45359
-
     # class = employment, unit = 'p'
     # class = energy, unit = MJ
     # class = land, unit = m2
-    df.loc[:, 'FlowAmount'] = np.where(df['Unit'].isin(['ACRES', 'Acres']),
-                                       df['FlowAmount'] * acre_to_m2,
-                                       df['FlowAmount'])
-    df.loc[:, 'Unit'] = np.where(df['Unit'].isin(['ACRES', 'Acres']), 'm2', df['Unit'])
-
-    df.loc[:, 'FlowAmount'] = np.where(df['Unit'].isin(['million sq ft', 'million square feet']),
-                                       df['FlowAmount'] * sq_ft_to_sq_m_multiplier * 1000000,
-                                       df['FlowAmount'])
-    df.loc[:, 'Unit'] = np.where(df['Unit'].isin(['million sq ft', 'million square feet']),
-                                 'm2', df['Unit'])
-
-    df.loc[:, 'FlowAmount'] = np.where(df['Unit'].isin(['square feet']),
-                                       df['FlowAmount'] * sq_ft_to_sq_m_multiplier,
-                                       df['FlowAmount'])
-    df.loc[:, 'Unit'] = np.where(df['Unit'].isin(['square feet']), 'm2', df['Unit'])
-
     # class = money, unit = USD
-
     # class = water, unit = kg
-    df.loc[:, 'FlowAmount'] = np.where(df['Unit'] == 'gallons/animal/day',
-                                       (df['FlowAmount'] * gallon_water_to_kg) * days_in_year,
-                                       df['FlowAmount'])
-    df.loc[:, 'Unit'] = np.where(df['Unit'] == 'gallons/animal/day', 'kg', df['Unit'])
-
-    df.loc[:, 'FlowAmount'] = np.where(df['Unit'] == 'ACRE FEET / ACRE',
-                                       (df['FlowAmount'] / acre_to_m2) * ac_ft_water_to_kg,
-                                       df['FlowAmount'])
-    df.loc[:, 'Unit'] = np.where(df['Unit'] == 'ACRE FEET / ACRE', 'kg/m2', df['Unit'])
-
-    df.loc[:, 'FlowAmount'] = np.where(df['Unit'] == 'Mgal',
-                                       df['FlowAmount'] * 1000000 * gallon_water_to_kg,
-                                       df['FlowAmount'])
-    df.loc[:, 'Unit'] = np.where(df['Unit'] == 'Mgal', 'kg', df['Unit'])
-
     # class = other, unit varies
-
-
-
-
-    # Convert Energy unit "Quadrillion Btu" to MJ
-    # 1 Quad = .0010550559 x 10^15
-    df.loc[:, 'FlowAmount'] = np.where(df['Unit'] == 'Quadrillion Btu',
-                                       df['FlowAmount'] * mj_in_btu * (10 ** 15),
-                                       df['FlowAmount'])
-    df.loc[:, 'Unit'] = np.where(df['Unit'] == 'Quadrillion Btu', 'MJ', df['Unit'])
-
-    # Convert Energy unit "Trillion Btu" to MJ
-    # 1 Tril = .0010550559 x 10^14
-    df.loc[:, 'FlowAmount'] = np.where(df['Unit'] == 'Trillion Btu',
-                                       df['FlowAmount'] * mj_in_btu * (10 ** 14),
-                                       df['FlowAmount'])
-    df.loc[:, 'Unit'] = np.where(df['Unit'] == 'Trillion Btu', 'MJ', df['Unit'])
-
-    df.loc[:, 'FlowAmount'] = np.where(df['Unit'] == 'million Cubic metres/year',
-                                       df['FlowAmount'] * 264.172, df['FlowAmount'])
-    df.loc[:, 'Unit'] = np.where(df['Unit'] == 'million Cubic metres/year', 'Mgal', df['Unit'])
-
-    # Convert mass units (LB or TON) to kg
-    df.loc[:, 'FlowAmount'] = np.where(df['Unit'] == 'TON',
-                                       df['FlowAmount'] * ton_to_kg,
-                                       df['FlowAmount'])
-    df.loc[:, 'FlowAmount'] = np.where(df['Unit'] == 'LB',
-                                       df['FlowAmount'] * lb_to_kg,
-                                       df['FlowAmount'])
-    df.loc[:, 'Unit'] = np.where(df['Unit'].isin(['TON', 'LB']),
-                                 'kg', df['Unit'])
+    df = apply_unit_conversions(df, unit_conversions[unit_conversions['standardize_units']])
 
     return df
 
@@ -5,21 +5,42 @@
 Functions to allocate data using additional data sources
 """
 
+import os
+import glob
+import hashlib
+import json
 import numpy as np
 import pandas as pd
+from esupy.processed_data_mgmt import create_paths_if_missing
 from flowsa.common import load_source_catalog, activity_fields, US_FIPS, \
-    fba_activity_fields, fbs_activity_fields, log, \
-    fba_mapped_wsec_default_grouping_fields, fba_wsec_default_grouping_fields
+    fba_activity_fields, fbs_activity_fields, log, vLog, \
+    fba_mapped_wsec_default_grouping_fields, fba_wsec_default_grouping_fields, \
+    MODULEPATH, datasourcescriptspath, fbaoutputpath, fbadatasetpath, \
+    allocationfbaoutputpath, find_true_file_path, PKG_VERSION_NUMBER, get_file_info, \
+    hash_file_contents, run_validation, write_parquet_atomically, remove_stale_files, \
+    get_data_files, load_functions_loading_fbas_config
 from flowsa.validation import allocate_dropped_sector_data, check_allocation_ratios, \
     check_if_location_systems_match
 from flowsa.flowbyfunctions import collapse_activity_fields, dynamically_import_fxn, \
     sector_aggregation, sector_disaggregation, subset_df_by_geoscale, \
     load_fba_w_standardized_units
 from flowsa.allocation import allocate_by_sector, proportional_allocation_by_location_and_activity
-from flowsa.sectormapping import get_fba_allocation_subset, add_sectors_to_flowbyactivity
+from flowsa.sectormapping import get_fba_allocation_subset, add_sectors_to_flowbyactivity, \
+    get_activitytosector_mapping_path
 from flowsa.dataclean import replace_strings_with_NoneType
 from flowsa.validation import check_if_data_exists_at_geoscale
 
+# modules used to load, clean, and map allocation FBAs, in addition to the data source script
+allocation_fba_modules = ['common', 'dataclean', 'fbs_allocation', 'flowbyfunctions',
+                          'sectormapping', 'validation']
+# prepared allocation FBAs loaded in this session, keyed by parquet path, and the number
+# kept in memory
+prepared_allocation_fbas = {}
+max_prepared_allocation_fbas = 4
+# number of prepared allocation FBAs saved for a source and year, allocation FBAs of a
+# source can be prepared with different parameters across activity sets and methods
+max_stored_allocation_fbas = 5
+
 
 def direct_allocation_method(flow_subset_mapped, k, names, method):
     """
@@ -136,7 +157,8 @@ def dataset_allocation_method(flow_subset_mapped, attr, names, method,
     flow_allocation = collapse_activity_fields(flow_allocation)
 
     # check for issues with allocation ratios
-    check_allocation_ratios(flow_allocation, aset, method)
+    if run_validation(method, 'full'):
+        check_allocation_ratios(flow_allocation, aset, method, k)
 
     # create list of sectors in the flow allocation df, drop any rows of data in the flow df that \
     # aren't in list
@@ -339,6 +361,145 @@ def allocation_helper(df_w_sector, attr, method, v):
 def load_map_clean_fba(method, attr, fba_sourcename, df_year, flowclass,
                        geoscale_from, geoscale_to, **kwargs):
     """
+    Load, clean, and map a FlowByActivity df. The prepared df is saved as a parquet and
+    reused while none of the parameters, code, crosswalks, or FBAs it depends on change.
+    :param method: dictionary, FBS method yaml
+    :param attr: dictionary, attribute data from method yaml for activity set
+    :param fba_sourcename: str, source name
+    :param df_year: str, year
+    :param flowclass: str, flowclass to subset df with
+    :param geoscale_from: str, geoscale to use
+    :param geoscale_to: str, geoscale to aggregate to
+    :param kwargs: dictionary, can include parameters: 'allocation_flow',
+                   'allocation_compartment','clean_allocation_fba', 'clean_allocation_fba_w_sec'
+    :return: df, fba format
+    """
+    fingerprint = allocation_fba_fingerprint(method, attr, fba_sourcename, df_year, flowclass,
+                                             geoscale_from, geoscale_to, **kwargs)
+    fba_file = f'{allocationfbaoutputpath}{fba_sourcename}_{df_year}_{fingerprint}.parquet'
+
+    if fba_file in prepared_allocation_fbas:
+        # move to the end, so the least recently used allocation FBA is dropped first
+        prepared_allocation_fbas[fba_file] = prepared_allocation_fbas.pop(fba_file)
+    else:
+        if os.path.isfile(fba_file):
+            log.info("Loading prepared allocation flowbyactivity %s for year %s",
+                     fba_sourcename, str(df_year))
+            if run_validation(method, 'full'):
+                vLog.info("Skipping validation of cleaning %s %s, the prepared allocation "
+                          "flowbyactivity was validated when created", fba_sourcename,
+                          str(df_year))
+            fba_wsec = pd.read_parquet(fba_file)
+        else:
+            fba_wsec = map_clean_fba(method, attr, fba_sourcename, df_year, flowclass,
+                                     geoscale_from, geoscale_to, **kwargs)
+            # FBAs generated or downloaded while preparing the df change the hash
+            fingerprint = allocation_fba_fingerprint(method, attr, fba_sourcename, df_year,
+                                                     flowclass, geoscale_from, geoscale_to,
+                                                     **kwargs)
+            fba_file = f'{allocationfbaoutputpath}{fba_sourcename}_{df_year}_' \
+                       f'{fingerprint}.parquet'
+            create_paths_if_missing(allocationfbaoutputpath)
+            try:
+                # process pool workers can load the file while it is written
+                write_parquet_atomically(fba_wsec, fba_file)
+            except (ValueError, TypeError):
+                log.warning("Unable to save prepared allocation flowbyactivity %s for "
+                            "year %s", fba_sourcename, str(df_year))
+            # remove allocation FBAs prepared from previous inputs
+            remove_stale_files(f'{glob.escape(allocationfbaoutputpath)}'
+                               f'{glob.escape(f"{fba_sourcename}_{df_year}_")}'
+                               f'{"?" * 12}.parquet', keep=max_stored_allocation_fbas)
+        prepared_allocation_fbas[fba_file] = fba_wsec
+        while len(prepared_allocation_fbas) > max_prepared_allocation_fbas:
+            del prepared_allocation_fbas[next(iter(prepared_allocation_fbas))]
+    return prepared_allocation_fbas[fba_file].copy()
+
+
+def allocation_fba_fingerprint(method, attr, fba_sourcename, df_year, flowclass,
+                               geoscale_from, geoscale_to, **kwargs):
+    """
+    Create a hash of all inputs to a prepared allocation FBA: the load parameters,
+    the method parameters passed to the cleaning functions, the code used to prepare
+    the df, and the crosswalks and local FBAs it is created from
+    :param method: dictionary, FBS method yaml
+    :param attr: dictionary, attribute data from method yaml for activity set
+    :param fba_sourcename: str, source name
+    :param df_year: str, year
+    :param flowclass: str, flowclass to subset df with
+    :param geoscale_from: str, geoscale to use
+    :param geoscale_to: str, geoscale to aggregate to
+    :param kwargs: dictionary, parameters passed to load_map_clean_fba
+    :return: str, hash of inputs
+    """
+    # the activity names differ by activity set but are not used to prepare the df
+    attr_params = {k: v for k, v in attr.items() if k != 'names'}
+    method_params = {k: method.get(k) for k in
+                     ['target_sector_level', 'target_sector_source', 'target_geoscale']}
+    params = [fba_sourcename, df_year, flowclass, geoscale_from, geoscale_to, kwargs,
+              attr_params, method_params]
+
+    input_files = get_data_files() + \
+        list_allocation_fba_files(fba_sourcename, df_year, **kwargs)
+    mapping_file = get_activitytosector_mapping_path(fba_sourcename)
+    if os.path.isfile(mapping_file):
+        input_files.append(mapping_file)
+    file_info = get_file_info(input_files)
+
+    fingerprint = hashlib.sha256(
+        json.dumps([PKG_VERSION_NUMBER, params, file_info], sort_keys=True,
+                   default=str).encode())
+    fingerprint.update(hash_allocation_fba_code(fba_sourcename).encode())
+    return fingerprint.hexdigest()[0:12]
+
+
+def list_allocation_fba_files(fba_sourcename, df_year, **kwargs):
+    """
+    List the local FBAs a prepared allocation FBA is created from: the allocation FBA,
+    and the FBAs loaded by its cleaning functions (functions_loading_fbas.yaml). All
+    years of a source are listed if the year a function loads is not specified.
+    :param fba_sourcename: str, source name
+    :param df_year: str, year
+    :param kwargs: dictionary, parameters passed to load_map_clean_fba
+    :return: list, paths to FBA parquets and partitioned FBA datasets
+    """
+    from flowsa.flowbyactivity import set_fba_name, find_local_fba
+    from flowsa.metadata import set_fb_meta
+
+    fbas = [(fba_sourcename, df_year)]
+    fxn_fbas = load_functions_loading_fbas_config()
+    for fxn in [kwargs.get('clean_fba'), kwargs.get('clean_fba_w_sec')]:
+        for fba_info in fxn_fbas.get(fxn, {}).values():
+            year = df_year if fba_info.get('year') == '__year__' else fba_info.get('year')
+            fbas.append((fba_info['source'], year))
+
+    fba_files = []
+    for source, year in fbas:
+        if year is None:
+            fba_files.extend(
+                sorted(glob.glob(f'{glob.escape(fbaoutputpath + source)}_*.parquet')) +
+                sorted(glob.glob(f'{glob.escape(fbadatasetpath + source)}_*/')))
+        else:
+            fba_files.append(find_local_fba(set_fb_meta(set_fba_name(source, year),
+                                                        "FlowByActivity")) or '')
+    return fba_files
+
+
+def hash_allocation_fba_code(fba_sourcename):
+    """
+    Hash the contents of the modules used to prepare an allocation FBA
+    :param fba_sourcename: str, source name
+    :return: str, hash of module contents
+    """
+    script = find_true_file_path(datasourcescriptspath, fba_sourcename, 'py')
+    code_files = [f'{MODULEPATH}{m}.py' for m in allocation_fba_modules] + \
+        [f'{datasourcescriptspath}{script}.py']
+    return hash_file_contents(tuple(code_files))
+
+
+def map_clean_fba(method, attr, fba_sourcename, df_year, flowclass,
+                  geoscale_from, geoscale_to, **kwargs):
+    """
     Load, clean, and map a FlowByActivity df
     :param method: dictionary, FBS method yaml
     :param attr: dictionary, attribute data from method yaml for activity set
@@ -9,25 +9,47 @@ EX: --year 2015 --source USGS_NWIS_WU
 """
 
 import argparse
+import contextlib
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 import requests
 import pandas as pd
-from esupy.processed_data_mgmt import write_df_to_file
+from esupy.processed_data_mgmt import write_df_to_file, find_file
 from flowsa.common import log, make_http_request, load_api_key, load_sourceconfig, \
-    paths, rename_log_file
+    paths, rename_log_file, separate_log_files, create_process_pool_executor, \
+    fbadatasetpath, FBA_PARTITION_COLUMNS, FBA_PARTITION_ROW_GROUP_SIZE
 from flowsa.metadata import set_fb_meta, write_metadata
 from flowsa.flowbyfunctions import flow_by_activity_fields, fba_fill_na_dict, \
-    dynamically_import_fxn
-from flowsa.dataclean import clean_df
+    dynamically_import_fxn, get_geoscale_fips
+from flowsa.dataclean import clean_df, convert_to_compact_dtypes
+
+# columns FBAs are sorted by when saved
+fba_sort_columns = ['Class', 'Location', 'ActivityProducedBy', 'ActivityConsumedBy',
+                    'FlowName', 'Compartment']
 
 
 def parse_args():
     """
     Make year and source script parameters
-    :return: dictionary, 'year' and 'source'
+    :return: dictionary, 'year', 'source', 'http_cache', 'max_workers' and 'max_downloads'
     """
     ap = argparse.ArgumentParser()
     ap.add_argument("-y", "--year", required=True, help="Year for data pull and save")
     ap.add_argument("-s", "--source", required=True, help="Data source code to pull and save")
+    ap.add_argument("-c", "--http_cache", choices=['use', 'offline'], default=None,
+                    help="Store raw responses in the local http cache and revalidate "
+                         "them ('use'), or only parse cached responses ('offline')")
+    ap.add_argument("-w", "--max_workers", type=int, default=None,
+                    help="Number of processes to generate a range of years in. "
+                         "Years are generated sequentially if not specified.")
+    ap.add_argument("-d", "--max_downloads", type=int, default=None,
+                    help="Number of years to download data for at once, "
+                         "defaults to max_workers")
     args = vars(ap.parse_args())
     return args
 
@@ -46,6 +68,115 @@ def set_fba_name(datasource, year):
     return name_data
 
 
+def load_fba_parquet(fba_meta, columns=None, filters=None, geographic_level=None):
+    """
+    Load the local FBA parquet or partitioned FBA dataset, whichever was saved last,
+    only reading the columns and rows requested
+    :param fba_meta: FileMeta of the FBA
+    :param columns: list, columns to load, skipping columns not in the parquet.
+           All columns are loaded if None.
+    :param filters: list, pyarrow filters in disjunctive normal form, see
+           flowbyfunctions.create_fba_load_filters
+    :param geographic_level: str, 'national', 'state', or 'county', used to only
+           read the partitions of a partitioned FBA at the geographic level
+    :return: df, None if the FBA is not found locally
+    """
+    import pyarrow.dataset as ds
+
+    f = find_local_fba(fba_meta)
+    if f is None:
+        return None
+    dataset_path = get_fba_dataset_path(fba_meta)
+    if f == dataset_path:
+        dataset = ds.dataset(dataset_path, format='parquet',
+                             partitioning=get_fba_partitioning())
+        if geographic_level is not None:
+            geo_filter = ('geo', '==', geographic_level)
+            filters = [c + [geo_filter] for c in filters] if filters else [[geo_filter]]
+        read_columns = columns
+        if columns is None:
+            # partition columns are appended, so return the columns in the FBA order
+            read_columns = [c for c in flow_by_activity_fields if c in dataset.schema.names] + \
+                [c for c in dataset.schema.names
+                 if c not in flow_by_activity_fields and c not in FBA_PARTITION_COLUMNS]
+        read_columns = [c for c in read_columns if c in dataset.schema.names]
+        fba = pd.read_parquet(dataset_path, columns=read_columns, filters=filters,
+                              partitioning=get_fba_partitioning())
+        # restore the order rows are saved in, as partitions are read in name order
+        sort_cols = [c for c in fba_sort_columns if c in fba.columns]
+        if sort_cols:
+            fba = fba.sort_values(sort_cols, kind='stable').reset_index(drop=True)
+        return fba
+    if columns is not None:
+        parquet_columns = ds.dataset(f, format='parquet').schema.names
+        columns = [c for c in columns if c in parquet_columns]
+    return pd.read_parquet(f, columns=columns, filters=filters)
+
+
+def find_local_fba(fba_meta):
+    """
+    Find the local FBA parquet or partitioned FBA dataset, whichever was saved last
+    :param fba_meta: FileMeta of the FBA
+    :return: str, path to the parquet or dataset directory, None if not found
+    """
+    f = find_file(fba_meta, paths)
+    if not f or not os.path.exists(f):
+        f = None
+    dataset_path = get_fba_dataset_path(fba_meta)
+    if os.path.isdir(dataset_path) and \
+            (f is None or os.path.getmtime(dataset_path) > os.path.getmtime(f)):
+        f = dataset_path
+    return f
+
+
+def get_fba_dataset_path(fba_meta):
+    """
+    Generate the path of a partitioned FBA dataset
+    :param fba_meta: FileMeta of the FBA
+    :return: str, path to dataset directory
+    """
+    return f'{fbadatasetpath}{fba_meta.name_data}/'
+
+
+def get_fba_partitioning():
+    """
+    Hive partitioning of FBA datasets, by Class and geographic level
+    :return: pyarrow Partitioning
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    return ds.partitioning(pa.schema([(c, pa.string()) for c in FBA_PARTITION_COLUMNS]),
+                           flavor='hive')
+
+
+def write_partitioned_fba(df, fba_meta):
+    """
+    Save a FBA as a parquet dataset partitioned by Class and geographic level, with
+    rows sorted by Location and activity within each partition so the row group
+    statistics can be used to skip row groups when filtering
+    :param df: df, FBA format, sorted
+    :param fba_meta: FileMeta of the FBA
+    :return: parquet dataset saved to local directory
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    # assign the geographic level of each location, locations that are not
+    # FIPS codes are assigned 'other'
+    geo = pd.Series('other', index=df.index)
+    for geoscale in ['county', 'state', 'national']:
+        geo = geo.mask(df['Location'].isin(get_geoscale_fips(geoscale)), geoscale)
+    df = df.assign(geo=geo)
+
+    dataset_path = get_fba_dataset_path(fba_meta)
+    shutil.rmtree(dataset_path, ignore_errors=True)
+    ds.write_dataset(pa.Table.from_pandas(df, preserve_index=False), dataset_path,
+                     format='parquet', partitioning=get_fba_partitioning(),
+                     max_rows_per_group=FBA_PARTITION_ROW_GROUP_SIZE)
+    log.info("Saved partitioned FBA to %s", dataset_path)
+
+
 def build_url_for_query(config, args):
     """
     Creates a base url which requires string substitutions that depend on data source
@@ -95,6 +226,69 @@ def assemble_urls_for_query(build_url, config, args):
     return urls
 
 
+def request_urls(url_list, request_kwargs):
+    """
+    Request each url in turn
+    :param url_list: list, urls to call
+    :param request_kwargs: dictionary, kwargs for make_http_request
+    :return: generator of responses, in the order of url_list
+    """
+    for url in url_list:
+        log.info("Calling %s", url)
+        yield make_http_request(url, **request_kwargs)
+
+
+def request_urls_concurrently(url_list, request_kwargs, request_config):
+    """
+    Request urls in a thread pool, limiting the rate of requests to each host and
+    retrying requests that fail with a server error, connection error or timeout, with
+    exponential backoff
+    :param url_list: list, urls to call
+    :param request_kwargs: dictionary, kwargs for make_http_request
+    :param request_config: dictionary, 'concurrent_requests' parameters in the FBA yaml:
+           max_workers, max_requests_per_second (per host), retries, and backoff_factor
+    :return: generator of responses, in the order of url_list
+    """
+    max_workers = request_config.get('max_workers', 4)
+    retries = request_config.get('retries', 3)
+    backoff_factor = request_config.get('backoff_factor', 1)
+    if 'max_requests_per_second' in request_config:
+        min_interval = 1 / request_config['max_requests_per_second']
+    else:
+        min_interval = 0
+    # time at which the next request to each host can be made
+    next_request_time = {}
+    host_lock = threading.Lock()
+
+    def wait_for_host(url):
+        host = urlparse(url).netloc
+        with host_lock:
+            now = time.monotonic()
+            request_time = max(now, next_request_time.get(host, now))
+            next_request_time[host] = request_time + min_interval
+        time.sleep(request_time - now)
+
+    def request_url(url):
+        for attempt in range(retries + 1):
+            wait_for_host(url)
+            log.info("Calling %s", url)
+            try:
+                r = make_http_request(url, **request_kwargs)
+                if r.status_code != 429 and r.status_code < 500:
+                    return r
+            except requests.exceptions.RequestException:
+                if attempt == retries:
+                    raise
+            if attempt == retries:
+                return r
+            delay = backoff_factor * 2 ** attempt
+            log.warning("Request failed, retrying %s in %s seconds", url, delay)
+            time.sleep(delay)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        yield from executor.map(request_url, url_list)
+
+
 def call_urls(url_list, args, config):
     """
     This method calls all the urls that have been generated.
@@ -102,7 +296,8 @@ def call_urls(url_list, args, config):
     The processing method is specific to
     the data source, so this function relies on a function in source.py
     :param url_list: list, urls to call
-    :param args: dictionary, load parameters 'source' and 'year'
+    :param args: dictionary, load parameters 'source' and 'year', and optionally
+                 'http_cache' (see common.make_cached_http_request)
     :param config: dictionary, FBA yaml
     :return: list, dfs to concat and parse
     """
@@ -113,13 +308,20 @@ def call_urls(url_list, args, config):
         set_cookies = 'yes'
     else:
         set_cookies = 'no'
+    request_kwargs = {'requests_session': s, 'set_cookies': set_cookies,
+                      'http_cache': args.get('http_cache'),
+                      'timeout': config.get('request_timeout')}
 
     # create dataframes list by iterating through url list
     data_frames_list = []
     if url_list[0] is not None:
-        for url in url_list:
-            log.info("Calling %s", url)
-            r = make_http_request(url, requests_session=s, set_cookies=set_cookies)
+        # responses are returned in the order of the url list
+        if 'concurrent_requests' in config:
+            responses = request_urls_concurrently(url_list, request_kwargs,
+                                                  config['concurrent_requests'])
+        else:
+            responses = request_urls(url_list, request_kwargs)
+        for url, r in zip(url_list, responses):
             if "call_response_fxn" in config:
                 # dynamically import and call on function
                 df = dynamically_import_fxn(args['source'],
@@ -157,6 +359,7 @@ def process_data_frame(df, source, year, config):
     :param df: df, FBA format
     :param source: str, source name
     :param year: str, year
+    :param config: dictionary, FBA yaml
     :return: df, FBA format, standardized
     """
     # log that data was retrieved
@@ -165,50 +368,46 @@ def process_data_frame(df, source, year, config):
     log.info("Add any missing columns and check field datatypes")
     flow_df = clean_df(df, flow_by_activity_fields, fba_fill_na_dict, drop_description=False)
     # sort df and reset index
-    flow_df = flow_df.sort_values(['Class', 'Location', 'ActivityProducedBy', 'ActivityConsumedBy',
-                                   'FlowName', 'Compartment']).reset_index(drop=True)
+    flow_df = flow_df.sort_values(fba_sort_columns).reset_index(drop=True)
+    # compact dtypes are set once no values are modified
+    if config.get('compact_dtypes', False):
+        flow_df = convert_to_compact_dtypes(flow_df)
     # save as parquet file
     name_data = set_fba_name(source, year)
     meta = set_fb_meta(name_data, "FlowByActivity")
-    write_df_to_file(flow_df,paths,meta)
+    if config.get('partitioned_storage', False):
+        write_partitioned_fba(flow_df, meta)
+    else:
+        write_df_to_file(flow_df,paths,meta)
     write_metadata(source, config, meta, "FlowByActivity", year=year)
     log.info("FBA generated and saved for %s", name_data)
     # rename the log file saved to local directory
     rename_log_file(name_data, meta)
 
 
-def main(**kwargs):
+def generate_fba_for_year(kwargs, config, download_semaphore=None):
     """
-    Generate FBA parquet(s)
-    :param kwargs: 'source' and 'year'
+    Download, parse and save the FBA parquet(s) for a single year of a source
+    :param kwargs: dictionary, 'source' and 'year', optionally 'http_cache'
+    :param config: dictionary, FBA yaml
+    :param download_semaphore: semaphore limiting the number of years downloading
+           data at once, None if years are not generated in parallel
     :return: parquet saved to local directory
     """
-    # assign arguments
-    if len(kwargs) == 0:
-        kwargs = parse_args()
-
-    # assign yaml parameters (common.py fxn)
-    config = load_sourceconfig(kwargs['source'])
-
-    log.info("Creating dataframe list")
-    # @@@01082021JS - Range of years defined, to support split into multiple Parquets:
-    if '-' in str(kwargs['year']):
-        years = str(kwargs['year']).split('-')
-        min_year = int(years[0])
-        max_year = int(years[1]) + 1
-        year_iter = list(range(min_year, max_year))
+    # years generated in parallel write their own logs, so the log saved for each year
+    # does not include the statements of other years
+    if download_semaphore is not None:
+        log_files = separate_log_files(f"{kwargs['source']}_{kwargs['year']}")
     else:
-        # Else only a single year defined, create an array of one:
-        year_iter = [kwargs['year']]
-
-    for p_year in year_iter:
-        kwargs['year'] = str(p_year)
+        log_files = contextlib.nullcontext()
+    with log_files:
         # build the base url with strings that will be replaced
         build_url = build_url_for_query(config, kwargs)
         # replace parts of urls with specific instructions from source.py
         urls = assemble_urls_for_query(build_url, config, kwargs)
         # create a list with data from all source urls
-        dataframe_list = call_urls(urls, kwargs, config)
+        with download_semaphore or contextlib.nullcontext():
+            dataframe_list = call_urls(urls, kwargs, config)
         # concat the dataframes and parse data with specific instructions from source.py
         log.info("Concat dataframe list and parse data")
         df = parse_data(dataframe_list, kwargs, config)
@@ -225,5 +424,47 @@ def main(**kwargs):
             process_data_frame(df, kwargs['source'], kwargs['year'], config)
 
 
+def main(**kwargs):
+    """
+    Generate FBA parquet(s)
+    :param kwargs: 'source' and 'year', optionally 'http_cache', and for a range of
+                   years 'max_workers' and 'max_downloads'
+    :return: parquet saved to local directory
+    """
+    # assign arguments
+    if len(kwargs) == 0:
+        kwargs = parse_args()
+
+    # assign yaml parameters (common.py fxn)
+    config = load_sourceconfig(kwargs['source'])
+
+    log.info("Creating dataframe list")
+    # @@@01082021JS - Range of years defined, to support split into multiple Parquets:
+    if '-' in str(kwargs['year']):
+        years = str(kwargs['year']).split('-')
+        min_year = int(years[0])
+        max_year = int(years[1]) + 1
+        year_iter = list(range(min_year, max_year))
+    else:
+        # Else only a single year defined, create an array of one:
+        year_iter = [kwargs['year']]
+
+    max_workers = kwargs.get('max_workers')
+    if max_workers and len(year_iter) > 1:
+        # generate each year in a worker process, limiting the number of years
+        # downloading data at once
+        with create_process_pool_executor(max_workers) as executor, \
+                multiprocessing.Manager() as manager:
+            download_semaphore = manager.Semaphore(kwargs.get('max_downloads') or max_workers)
+            futures = [executor.submit(generate_fba_for_year, dict(kwargs, year=str(p_year)),
+                                       config, download_semaphore)
+                       for p_year in year_iter]
+            for future in futures:
+                future.result()
+    else:
+        for p_year in year_iter:
+            generate_fba_for_year(dict(kwargs, year=str(p_year)), config)
+
+
 if __name__ == '__main__':
     main()
@@ -11,7 +11,8 @@ from esupy.dqi import get_weighted_average
 import flowsa
 from flowsa.common import fbs_activity_fields, US_FIPS, get_state_FIPS, \
     get_county_FIPS, update_geoscale, log, load_source_catalog, \
-    load_sector_length_crosswalk, flow_by_sector_fields, fbs_fill_na_dict, \
+    load_sector_length_crosswalk, load_sector_sole_child_crosswalk, \
+    flow_by_sector_fields, fbs_fill_na_dict, \
     fbs_collapsed_default_grouping_fields, flow_by_sector_collapsed_fields, \
     fbs_collapsed_fill_na_dict, fba_activity_fields, \
     fips_number_key, flow_by_activity_fields, fba_fill_na_dict, datasourcescriptspath, \
@@ -32,20 +33,57 @@ def create_geoscale_list(df, geoscale, year='2015'):
 
     # filter by geoscale depends on Location System
     fips = []
+    if geoscale == "national" or df['LocationSystem'].str.contains('FIPS').any():
+        fips = get_geoscale_fips(geoscale, year)
+
+    return fips
+
+
+def get_geoscale_fips(geoscale, year='2015'):
+    """
+    List the FIPS at a geoscale
+    :param geoscale: 'national', 'state', or 'county'
+    :param year: str, year of FIPS, defaults to 2015
+    :return: list of FIPS
+    """
+    fips = []
     if geoscale == "national":
         fips.append(US_FIPS)
-    elif df['LocationSystem'].str.contains('FIPS').any():
-        # all_FIPS = read_stored_FIPS()
-        if geoscale == "state":
-            state_FIPS = get_state_FIPS(year)
-            fips = list(state_FIPS['FIPS'])
-        elif geoscale == "county":
-            county_FIPS = get_county_FIPS(year)
-            fips = list(county_FIPS['FIPS'])
+    elif geoscale == "state":
+        state_FIPS = get_state_FIPS(year)
+        fips = list(state_FIPS['FIPS'])
+    elif geoscale == "county":
+        county_FIPS = get_county_FIPS(year)
+        fips = list(county_FIPS['FIPS'])
 
     return fips
 
 
+def create_fba_load_filters(flowclass=None, geographic_level=None, locations=None,
+                            activities=None):
+    """
+    Create the row filters applied when reading a FBA parquet
+    :param flowclass: str, a 'Class' of the flow
+    :param geographic_level: str, 'national', 'state', or 'county'
+    :param locations: list, Location codes to load
+    :param activities: list, activities to load, in either ActivityProducedBy
+           or ActivityConsumedBy
+    :return: list, pyarrow filters in disjunctive normal form, None if no filters
+    """
+    conditions = []
+    if flowclass is not None:
+        conditions.append(('Class', '==', flowclass))
+    if geographic_level is not None:
+        conditions.append(('Location', 'in', get_geoscale_fips(geographic_level)))
+    if locations is not None:
+        conditions.append(('Location', 'in', list(locations)))
+    if activities is not None:
+        return [conditions + [(a, 'in', list(activities))] for a in fba_activity_fields]
+    if len(conditions) == 0:
+        return None
+    return [conditions]
+
+
 def filter_by_geoscale(df, geoscale):
     """
     Filter flowbyactivity by FIPS at the given scale
@@ -84,18 +122,29 @@ def agg_by_geoscale(df, from_scale, to_scale, groupbycols):
     return fba_agg
 
 
-def aggregator(df, groupbycols):
+def aggregator(df, groupbycols, retain_empty_cells=False):
     """
     Aggregates flowbyactivity or flowbysector 'FlowAmount' column in df and generate
     weighted average values based on FlowAmount values for numeric columns
 
     :param df: df, Either flowbyactivity or flowbysector
     :param groupbycols: list, Either flowbyactivity or flowbysector columns
+    :param retain_empty_cells: bool, True to return null values as empty cells,
+           for use within functions that work on dfs with empty cells
     :return: df, with aggregated columns
     """
 
     # reset index
     df = df.reset_index(drop=True)
+    # dtypes of compact columns (see flow_by_fields_compact_dtypes), restored after
+    # aggregating as weighted averages are float64
+    compact_dtypes = {e: df[e].dtype for e in df.columns
+                      if isinstance(df[e].dtype, pd.CategoricalDtype) or
+                      df[e].dtype in ['int16', 'float32']}
+    # group by categorical columns as strings, grouping by categories returns
+    # every combination of categories rather than only those in the df
+    categorical_cols = [e for e in groupbycols if isinstance(df[e].dtype, pd.CategoricalDtype)]
+    df = df.astype({e: object for e in categorical_cols})
     # tmp replace null values with empty cells
     df = replace_NoneType_with_empty_cells(df)
 
@@ -120,7 +169,11 @@ def aggregator(df, groupbycols):
     df_dfg.columns = df_dfg.columns.droplevel(level=1)
 
     # if datatypes are strings, ensure that Null values remain NoneType
-    df_dfg = replace_strings_with_NoneType(df_dfg)
+    if not retain_empty_cells:
+        df_dfg = replace_strings_with_NoneType(df_dfg)
+    # restore compact columns
+    df_dfg = df_dfg.astype({e: 'category' if isinstance(d, pd.CategoricalDtype) else d
+                            for e, d in compact_dtypes.items() if e in df_dfg.columns})
 
     return df_dfg
 
@@ -200,59 +253,13 @@ def sector_aggregation(df_load, group_cols):
         lambda x: x.str.len()).max().max()
     length = int(length)
     # for loop in reverse order longest length naics minus 1 to 2
-    # appends missing naics levels to df
+    # appends missing naics levels to df. Each level is built from the
+    # rows one digit longer, including those created in the previous pass
     for i in range(length - 1, 1, -1):
-        # subset df to sectors with length = i and length = i + 1
-        df_subset = df.loc[df[fbs_activity_fields[0]].apply(lambda x: i + 1 >= len(x) >= i) |
-                           df[fbs_activity_fields[1]].apply(lambda x: i + 1 >= len(x) >= i)]
-        # create a list of i digit sectors in df subset
-        sector_subset = df_subset[
-            ['Location', fbs_activity_fields[0],
-             fbs_activity_fields[1]]].drop_duplicates().reset_index(drop=True)
-        df_sectors = sector_subset.copy()
-        df_sectors.loc[:, 'SectorProducedBy'] = \
-            df_sectors['SectorProducedBy'].apply(lambda x: x[0:i])
-        df_sectors.loc[:, 'SectorConsumedBy'] = \
-            df_sectors['SectorConsumedBy'].apply(lambda x: x[0:i])
-        sector_list = df_sectors.drop_duplicates().values.tolist()
-        # create a list of sectors that are exactly i digits long
-        # where either sector column is i digits in length
-        df_existing_1 = \
-            sector_subset.loc[(sector_subset['SectorProducedBy'].apply(lambda x: len(x) == i)) |
-                              (sector_subset['SectorConsumedBy'].apply(lambda x: len(x) == i))]
-        # where both sector columns are i digits in length
-        df_existing_2 = \
-            sector_subset.loc[(sector_subset['SectorProducedBy'].apply(lambda x: len(x) == i)) &
-                              (sector_subset['SectorConsumedBy'].apply(lambda x: len(x) == i))]
-        # concat existing dfs
-        df_existing = pd.concat([df_existing_1, df_existing_2], sort=False)
-        existing_sectors = df_existing.drop_duplicates().dropna().values.tolist()
-        # list of sectors of length i that are not in sector list
-        missing_sectors = [e for e in sector_list if e not in existing_sectors]
-        if len(missing_sectors) != 0:
-            # new df of sectors that start with missing sectors.
-            # drop last digit of the sector and sum flows
-            # set conditions
-            agg_sectors_list = []
-            for q, r, s in missing_sectors:
-                c1 = df_subset['Location'] == q
-                c2 = df_subset[fbs_activity_fields[0]].apply(lambda x: x[0:i] == r)
-                c3 = df_subset[fbs_activity_fields[1]].apply(lambda x: x[0:i] == s)
-                # subset data
-                agg_sectors_list.append(df_subset.loc[c1 & c2 & c3])
-            agg_sectors = pd.concat(agg_sectors_list, sort=False)
-            agg_sectors = agg_sectors.loc[
-                (agg_sectors[fbs_activity_fields[0]].apply(lambda x: len(x) > i)) |
-                (agg_sectors[fbs_activity_fields[1]].apply(lambda x: len(x) > i))]
-            agg_sectors.loc[:, fbs_activity_fields[0]] = agg_sectors[fbs_activity_fields[0]].apply(
-                lambda x: x[0:i])
-            agg_sectors.loc[:, fbs_activity_fields[1]] = agg_sectors[fbs_activity_fields[1]].apply(
-                lambda x: x[0:i])
-            # aggregate the new sector flow amounts
-            agg_sectors = aggregator(agg_sectors, group_cols)
+        agg_sectors = sum_missing_parent_sectors(df, i, group_cols)
+        if agg_sectors is not None:
             # append to df
-            agg_sectors = replace_NoneType_with_empty_cells(agg_sectors)
-            df = df.append(agg_sectors, sort=False).reset_index(drop=True)
+            df = pd.concat([df, agg_sectors], sort=False).reset_index(drop=True)
 
     # manually modify non-NAICS codes that might exist in sector
     df.loc[:, 'SectorConsumedBy'] = np.where(df['SectorConsumedBy'].isin(['F0', 'F01']),
@@ -273,6 +280,49 @@ def sector_aggregation(df_load, group_cols):
     return df
 
 
+def sum_missing_parent_sectors(df, sector_length, group_cols):
+    """
+    Sum the sectors that are one digit longer than sector_length into their
+    parent sectors, for each (Location, SectorProducedBy, SectorConsumedBy)
+    parent that does not already exist in the df
+    :param df: df with sector columns, NoneType replaced with empty cells
+    :param sector_length: int, length of the parent sectors to create
+    :param group_cols: columns by which to aggregate
+    :return: df of aggregated parent sectors with empty cells, None if no
+             parents are missing
+    """
+    sector_cols = ['Location', fbs_activity_fields[0], fbs_activity_fields[1]]
+
+    # subset df to sectors with length = i and length = i + 1
+    spb_length = df[fbs_activity_fields[0]].str.len()
+    scb_length = df[fbs_activity_fields[1]].str.len()
+    df_subset = df.loc[spb_length.between(sector_length, sector_length + 1) |
+                       scb_length.between(sector_length, sector_length + 1)]
+
+    # truncate both sector columns to i digits, every truncated combination
+    # has at least one sector exactly i digits in length
+    parents = df_subset[sector_cols].assign(
+        SectorProducedBy=df_subset[fbs_activity_fields[0]].str[0:sector_length],
+        SectorConsumedBy=df_subset[fbs_activity_fields[1]].str[0:sector_length])
+    # a parent is missing if it does not already exist as a row in the subset
+    existing = pd.MultiIndex.from_frame(df_subset[sector_cols])
+    missing = ~pd.MultiIndex.from_frame(parents).isin(existing)
+    if not missing.any():
+        return None
+
+    # keep the child rows of each missing parent, ordered by the first
+    # appearance of the parent so flows are summed in a consistent order
+    parent_order = parents.groupby(sector_cols, sort=False).ngroup().values[missing]
+    agg_sectors = df_subset.loc[missing].assign(
+        SectorProducedBy=parents.loc[missing, fbs_activity_fields[0]],
+        SectorConsumedBy=parents.loc[missing, fbs_activity_fields[1]])
+    agg_sectors = agg_sectors.iloc[np.argsort(parent_order, kind='stable')]
+    # aggregate the new sector flow amounts
+    agg_sectors = aggregator(agg_sectors, group_cols, retain_empty_cells=True)
+
+    return agg_sectors
+
+
 def sector_disaggregation(df):
     """
     function to disaggregate sectors if there is only one naics at a lower level
@@ -284,42 +334,34 @@ def sector_disaggregation(df):
     # ensure None values are not strings
     df = replace_NoneType_with_empty_cells(df)
 
-    # load naics 2 to naics 6 crosswalk
-    cw_load = load_sector_length_crosswalk()
+    # load the precomputed map of naics with only one child naics at each length
+    sole_child_cw = load_sector_sole_child_crosswalk()
 
     # for loop min length to 6 digits, where min length cannot be less than 2
     length = df[[fbs_activity_fields[0], fbs_activity_fields[1]]].apply(
         lambda x: x.str.len()).min().min()
     if length < 2:
         length = 2
-    # appends missing naics levels to df
+    # appends missing naics levels to df. Each length is run separately because
+    # the rows added at length i + 1 are checked for duplicates in the next pass
     for i in range(length, 6):
-        sector_merge = 'NAICS_' + str(i)
-        sector_add = 'NAICS_' + str(i+1)
-
-        # subset the df by naics length
-        cw = cw_load[[sector_merge, sector_add]]
-        # only keep the rows where there is only one value in sector_add for a value in sector_merge
-        cw = cw.drop_duplicates(subset=[sector_merge], keep=False).reset_index(drop=True)
-        sector_list = cw[sector_merge].values.tolist()
+        sole_child = sole_child_cw[i]
 
         # subset df to sectors with length = i and length = i + 1
-        df_subset = df.loc[df[fbs_activity_fields[0]].apply(lambda x: i + 1 >= len(x) >= i) |
-                           df[fbs_activity_fields[1]].apply(lambda x: i + 1 >= len(x) >= i)]
+        df_subset = df.loc[df[fbs_activity_fields[0]].str.len().between(i, i + 1) |
+                           df[fbs_activity_fields[1]].str.len().between(i, i + 1)]
         # create new columns that are length i
-        df_subset = df_subset.assign(SectorProduced_tmp=
-                                     df_subset[fbs_activity_fields[0]].apply(lambda x: x[0:i]))
-        df_subset = df_subset.assign(SectorConsumed_tmp=
-                                     df_subset[fbs_activity_fields[1]].apply(lambda x: x[0:i]))
+        df_subset = df_subset.assign(
+            SectorProduced_tmp=df_subset[fbs_activity_fields[0]].str[0:i],
+            SectorConsumed_tmp=df_subset[fbs_activity_fields[1]].str[0:i])
         # subset the df to the rows where the tmp sector columns are in naics list
-        df_subset_1 = df_subset.loc[(df_subset['SectorProduced_tmp'].isin(sector_list)) &
-                                    (df_subset['SectorConsumed_tmp'] == "")]
-        df_subset_2 = df_subset.loc[(df_subset['SectorProduced_tmp'] == "") &
-                                    (df_subset['SectorConsumed_tmp'].isin(sector_list))]
-        df_subset_3 = df_subset.loc[(df_subset['SectorProduced_tmp'].isin(sector_list)) &
-                                    (df_subset['SectorConsumed_tmp'].isin(sector_list))]
-        # concat existing dfs
-        df_subset = pd.concat([df_subset_1, df_subset_2, df_subset_3], sort=False)
+        produced_in_list = df_subset['SectorProduced_tmp'].isin(sole_child.index)
+        consumed_in_list = df_subset['SectorConsumed_tmp'].isin(sole_child.index)
+        produced_empty = df_subset['SectorProduced_tmp'] == ""
+        consumed_empty = df_subset['SectorConsumed_tmp'] == ""
+        df_subset = pd.concat([df_subset.loc[produced_in_list & consumed_empty],
+                               df_subset.loc[produced_empty & consumed_in_list],
+                               df_subset.loc[produced_in_list & consumed_in_list]], sort=False)
         # drop all rows with duplicate temp values, as a less aggregated naics exists
         # list of column headers, that if exist in df, should be
         # aggregated using the weighted avg fxn
@@ -333,24 +375,13 @@ def sector_disaggregation(df):
         df_subset = df_subset.drop_duplicates(subset=cols_to_drop,
                                               keep=False).reset_index(drop=True)
 
-        # merge the naics cw
-        new_naics = pd.merge(df_subset, cw[[sector_merge, sector_add]],
-                             how='left', left_on=['SectorProduced_tmp'], right_on=[sector_merge])
-        new_naics = new_naics.rename(columns={sector_add: "SPB"})
-        new_naics = new_naics.drop(columns=[sector_merge])
-        new_naics = pd.merge(new_naics, cw[[sector_merge, sector_add]],
-                             how='left', left_on=['SectorConsumed_tmp'], right_on=[sector_merge])
-        new_naics = new_naics.rename(columns={sector_add: "SCB"})
-        new_naics = new_naics.drop(columns=[sector_merge])
-        # drop columns and rename new sector columns
-        new_naics = new_naics.drop(columns=["SectorProducedBy", "SectorConsumedBy",
+        # look up the child naics and replace the sector columns
+        new_naics = df_subset.drop(columns=["SectorProducedBy", "SectorConsumedBy",
                                             "SectorProduced_tmp", "SectorConsumed_tmp"])
-        new_naics = new_naics.rename(columns={"SPB": "SectorProducedBy",
-                                              "SCB": "SectorConsumedBy"})
+        new_naics = new_naics.assign(
+            SectorProducedBy=df_subset['SectorProduced_tmp'].map(sole_child).replace({np.nan: ""}),
+            SectorConsumedBy=df_subset['SectorConsumed_tmp'].map(sole_child).replace({np.nan: ""}))
         # append new naics to df
-        new_naics['SectorConsumedBy'] = new_naics['SectorConsumedBy'].replace({np.nan: ""})
-        new_naics['SectorProducedBy'] = new_naics['SectorProducedBy'].replace({np.nan: ""})
-        new_naics = replace_NoneType_with_empty_cells(new_naics)
         df = pd.concat([df, new_naics], sort=True)
     # replace blank strings with None
     df = replace_strings_with_NoneType(df)
@@ -729,6 +760,8 @@ def load_fba_w_standardized_units(datasource, year, **kwargs):
         fba_dict['flowclass'] = kwargs['flowclass']
     if 'geographic_level' in kwargs:
         fba_dict['geographic_level'] = kwargs['geographic_level']
+    # the description is dropped when cleaning the df, so do not load it
+    fba_dict['columns'] = [c for c in flow_by_activity_fields if c != 'Description']
     # load the allocation FBA
     fba = flowsa.getFlowByActivity(datasource, year, **fba_dict).reset_index(drop=True)
     # ensure df loaded correctly/has correct dtypes
@@ -21,39 +21,68 @@ you need functions to clean up the FBA
 """
 
 import argparse
-import yaml
+import os
+import glob
+import hashlib
+import json
+import time
+from concurrent.futures import Future
+from importlib import metadata
 import pandas as pd
-from esupy.processed_data_mgmt import write_df_to_file
+from esupy.processed_data_mgmt import write_df_to_file, create_paths_if_missing, find_file
 import flowsa
 from flowsa.common import log, vLog, flowbysectormethodpath, flow_by_sector_fields, \
     fips_number_key, flow_by_activity_fields, load_source_catalog, \
     flowbysectoractivitysetspath, flow_by_sector_fields_w_activity, \
     paths, fba_activity_fields, rename_log_file, \
     fbs_activity_fields, fba_fill_na_dict, fbs_fill_na_dict, fbs_default_grouping_fields, \
-    fbs_grouping_fields_w_activities, logoutputpath
+    fbs_grouping_fields_w_activities, logoutputpath, load_yaml_dict, \
+    create_process_pool_executor, MODULEPATH, datasourcescriptspath, \
+    activitysetoutputpath, find_true_file_path, get_file_info, get_data_files, \
+    hash_file_contents, write_parquet_atomically, remove_stale_files, \
+    load_fbs_methods_additional_fbas_config, load_functions_loading_fbas_config, \
+    PKG_VERSION_NUMBER, fbsoutputpath, record_stage, validation_level_key, run_validation, \
+    DEFAULT_VALIDATION_LEVEL
 from flowsa.metadata import set_fb_meta, write_metadata
+from flowsa.validationreport import start_validation_report_run, validation_report_run
 from flowsa.fbs_allocation import direct_allocation_method, function_allocation_method, \
     dataset_allocation_method
 from flowsa.sectormapping import add_sectors_to_flowbyactivity, map_fbs_flows, \
-    get_sector_list
+    get_sector_list, get_activitytosector_mapping_path
 from flowsa.flowbyfunctions import agg_by_geoscale, sector_aggregation, \
     aggregator, subset_df_by_geoscale, sector_disaggregation, dynamically_import_fxn
-from flowsa.dataclean import clean_df, harmonize_FBS_columns, reset_fbs_dq_scores
+from flowsa.dataclean import clean_df, harmonize_FBS_columns, reset_fbs_dq_scores, \
+    convert_to_compact_dtypes
 from flowsa.validation import allocate_dropped_sector_data,\
     compare_activity_to_sector_flowamounts, \
     compare_fba_geo_subset_and_fbs_output_totals, compare_geographic_totals,\
     replace_naics_w_naics_from_another_year, calculate_flowamount_diff_between_dfs
 
+# modules used to create a FBS, in addition to the data source scripts
+fbs_modules = ['allocation', 'common', 'dataclean', 'fbs_allocation', 'flowbyfunctions',
+               'flowbysector', 'literature_values', 'sectormapping', 'validation']
+# packages mapping flows to the federal elementary flow list
+flow_mapping_packages = ['esupy', 'fedelemflowlist']
+
 
 def parse_args():
     """
     Make year and source script parameters
-    :return: dictionary, 'method'
+    :return: dictionary, 'method', 'max_workers', 'validation_level' and 'compact_dtypes'
     """
     ap = argparse.ArgumentParser()
     ap.add_argument("-m", "--method",
                     required=True, help="Method for flow by sector file. "
                                         "A valid method config file must exist with this name.")
+    ap.add_argument("-w", "--max_workers", type=int, default=None,
+                    help="Number of processes to run independent activity sets in. "
+                         "Activity sets run sequentially if not specified.")
+    ap.add_argument("-v", "--validation_level", choices=list(validation_level_key),
+                    default=None, help="Validation to run: 'off', 'summary' for FlowAmount "
+                                       "totals only, or 'full'. Overrides the method yaml.")
+    ap.add_argument("-c", "--compact_dtypes", action='store_true',
+                    help="Save the FBS with the memory saving dtypes in "
+                         "flow_by_fields_compact_dtypes")
     args = vars(ap.parse_args())
     return args
 
@@ -66,8 +95,7 @@ def load_method(method_name):
     """
     sfile = flowbysectormethodpath + method_name + '.yaml'
     try:
-        with open(sfile, 'r') as f:
-            method = yaml.safe_load(f)
+        method = load_yaml_dict(sfile)
     except IOError:
         log.error("FlowBySector method file not found.")
     return method
@@ -103,223 +131,588 @@ def load_source_dataframe(k, v):
     return flows_df
 
 
+def process_activity_set(k, v, aset, attr, names, flows_mapped, aset_names,
+                         method, method_name, fbs_list, stage_times):
+    """
+    Subset, allocate and aggregate the flows of one activity set in a source
+    :param k: str, source name
+    :param v: dictionary, the source parameters in the FBS method yaml
+    :param aset: str, activity set
+    :param attr: dictionary, attribute data from method yaml for activity set
+    :param names: list, activity names in activity set
+    :param flows_mapped: df, FBA with flows mapped to the federal elementary flow list
+    :param aset_names: df, activity set names if specified in an activity set file, else None
+    :param method: dictionary, FBS method yaml
+    :param method_name: str, FBS method name
+    :param fbs_list: list, fbs dfs created for previous activity sets, used by
+           allocation functions
+    :param stage_times: list, records of the time and memory of each stage, see
+           record_stage
+    :return: df, FBS for the activity set at the target sector level
+    """
+    start_time = time.perf_counter()
+    vLog.info("Preparing to handle %s in %s", aset, k)
+    with record_stage(stage_times, 'activity_subset', k, aset, flows_mapped) as stage:
+        # subset fba data by activity
+        flows_subset =\
+            flows_mapped[(flows_mapped[fba_activity_fields[0]].isin(names)) |
+                      (flows_mapped[fba_activity_fields[1]].isin(names)
+                       )].reset_index(drop=True)
+
+        # if activities are sector-like, check sectors are valid
+        if load_source_catalog()[k]['sector-like_activities']:
+            flows_subset2 =\
+                replace_naics_w_naics_from_another_year(flows_subset,
+                                                        method['target_sector_source'])
+            # check impact on df FlowAmounts
+            if run_validation(method, 'full'):
+                vLog.info('Calculate FlowAmount difference caused by '
+                          'replacing NAICS Codes with %s, saving difference in Validation log',
+                          method['target_sector_source'],)
+                calculate_flowamount_diff_between_dfs(flows_subset, flows_subset2, k, aset)
+        else:
+            flows_subset2 = flows_subset.copy()
+        stage['rows_out'] = len(flows_subset2)
+
+    # extract relevant geoscale data or aggregate existing data
+    with record_stage(stage_times, 'geoscale_subset', k, aset, flows_subset2) as stage:
+        flows_subset_geo = subset_df_by_geoscale(flows_subset2, v['geoscale_to_use'],
+                                                 attr['allocation_from_scale'])
+        stage['rows_out'] = len(flows_subset_geo)
+    # if loading data subnational geoscale, check for data loss
+    if attr['allocation_from_scale'] != 'national' and run_validation(method, 'summary'):
+        with record_stage(stage_times, 'compare_geographic_totals', k, aset, flows_subset_geo):
+            compare_geographic_totals(flows_subset_geo, flows_mapped, k,
+                                      attr, aset, names)
+
+    # Add sectors to df activity, depending on level of specified sector aggregation
+    log.info("Adding sectors to %s", k)
+    with record_stage(stage_times, 'add_sectors', k, aset, flows_subset_geo) as stage:
+        flows_subset_wsec =\
+            add_sectors_to_flowbyactivity(flows_subset_geo,
+                                          sectorsourcename=method['target_sector_source'],
+                                          allocationmethod=attr['allocation_method'])
+        # clean up fba with sectors, if specified in yaml
+        if "clean_fba_w_sec_df_fxn" in v:
+            vLog.info("Cleaning up %s FlowByActivity with sectors", k)
+            flows_subset_wsec = \
+                dynamically_import_fxn(k, v["clean_fba_w_sec_df_fxn"])(flows_subset_wsec,
+                                                                       attr=attr,
+                                                                       method=method)
+
+        # rename SourceName to MetaSources and drop columns
+        flows_mapped_wsec = flows_subset_wsec.\
+            rename(columns={'SourceName': 'MetaSources'}).\
+            drop(columns=['FlowName', 'Compartment'])
+        stage['rows_out'] = len(flows_mapped_wsec)
+
+    with record_stage(stage_times, 'allocation', k, aset, flows_mapped_wsec) as stage:
+        # if allocation method is "direct", then no need to create alloc ratios,
+        # else need to use allocation
+        # dataframe to create sector allocation ratios
+        if attr['allocation_method'] == 'direct':
+            fbs = direct_allocation_method(flows_mapped_wsec, k, names, method)
+        # if allocation method for an activity set requires a specific
+        # function due to the complicated nature
+        # of the allocation, call on function here
+        elif attr['allocation_method'] == 'allocation_function':
+            fbs = function_allocation_method(flows_mapped_wsec, k, names, attr, fbs_list)
+        else:
+            fbs =\
+                dataset_allocation_method(flows_mapped_wsec, attr,
+                                          names, method, k, v, aset,
+                                          method_name, aset_names)
+
+        # drop rows where flowamount = 0 (although this includes dropping suppressed data)
+        fbs = fbs[fbs['FlowAmount'] != 0].reset_index(drop=True)
+
+        # define grouping columns dependent on sectors being activity-like or not
+        if load_source_catalog()[k]['sector-like_activities'] is False:
+            groupingcols = fbs_grouping_fields_w_activities
+            groupingdict = flow_by_sector_fields_w_activity
+        else:
+            groupingcols = fbs_default_grouping_fields
+            groupingdict = flow_by_sector_fields
+
+        # clean df
+        fbs = clean_df(fbs, groupingdict, fbs_fill_na_dict)
+        stage['rows_out'] = len(fbs)
+
+    # aggregate df geographically, if necessary
+    log.info("Aggregating flowbysector to %s level", method['target_geoscale'])
+    # determine from scale
+    if fips_number_key[v['geoscale_to_use']] <\
+            fips_number_key[attr['allocation_from_scale']]:
+        from_scale = v['geoscale_to_use']
+    else:
+        from_scale = attr['allocation_from_scale']
+
+    with record_stage(stage_times, 'geo_agg', k, aset, fbs) as stage:
+        fbs_geo_agg = agg_by_geoscale(fbs, from_scale,
+                                      method['target_geoscale'], groupingcols)
+        stage['rows_out'] = len(fbs_geo_agg)
+
+    # aggregate data to every sector level
+    log.info("Aggregating flowbysector to all sector levels")
+    with record_stage(stage_times, 'sector_aggregation', k, aset, fbs_geo_agg) as stage:
+        fbs_sec_agg = sector_aggregation(fbs_geo_agg, groupingcols)
+        stage['rows_out'] = len(fbs_sec_agg)
+    # add missing naics5/6 when only one naics5/6 associated with a naics4
+    with record_stage(stage_times, 'sector_disaggregation', k, aset, fbs_sec_agg) as stage:
+        fbs_agg = sector_disaggregation(fbs_sec_agg)
+        stage['rows_out'] = len(fbs_agg)
+
+    # check if any sector information is lost before reaching
+    # the target sector length, if so,
+    # allocate values equally to disaggregated sectors
+    vLog.info('Searching for and allocating FlowAmounts for any parent '
+              'NAICS that were dropped in the subset to '
+              '%s child NAICS', method['target_sector_level'])
+    with record_stage(stage_times, 'allocate_dropped_sector_data', k, aset,
+                      fbs_agg) as stage:
+        fbs_agg_2 = allocate_dropped_sector_data(fbs_agg, method['target_sector_level'],
+                                                 k, aset)
+        stage['rows_out'] = len(fbs_agg_2)
+
+    # compare flowbysector with flowbyactivity
+    if run_validation(method, 'full'):
+        with record_stage(stage_times, 'compare_activity_to_sector_flowamounts', k, aset,
+                          fbs_agg_2):
+            compare_activity_to_sector_flowamounts(
+                flows_mapped_wsec, fbs_agg_2, aset, k, method)
+
+    with record_stage(stage_times, 'sector_subset', k, aset, fbs_agg_2) as stage:
+        # return sector level specified in method yaml
+        # load the crosswalk linking sector lengths
+        sector_list = get_sector_list(method['target_sector_level'])
+
+        # subset df, necessary because not all of the sectors are
+        # NAICS and can get duplicate rows
+        fbs_1 = fbs_agg_2.loc[(fbs_agg_2[fbs_activity_fields[0]].isin(sector_list)) &
+                              (fbs_agg_2[fbs_activity_fields[1]].isin(sector_list))].\
+            reset_index(drop=True)
+        fbs_2 = fbs_agg_2.loc[(fbs_agg_2[fbs_activity_fields[0]].isin(sector_list)) &
+                              (fbs_agg_2[fbs_activity_fields[1]].isnull())].\
+            reset_index(drop=True)
+        fbs_3 = fbs_agg_2.loc[(fbs_agg_2[fbs_activity_fields[0]].isnull()) &
+                              (fbs_agg_2[fbs_activity_fields[1]].isin(sector_list))].\
+            reset_index(drop=True)
+        fbs_sector_subset = pd.concat([fbs_1, fbs_2, fbs_3])
+
+        # drop activity columns
+        fbs_sector_subset = fbs_sector_subset.drop(['ActivityProducedBy',
+                                                    'ActivityConsumedBy'],
+                                                   axis=1, errors='ignore')
+        stage['rows_out'] = len(fbs_sector_subset)
+
+    # save comparison of FBA total to FBS total for an activity set
+    if run_validation(method, 'summary'):
+        with record_stage(stage_times, 'compare_fba_geo_subset_and_fbs_output_totals', k,
+                          aset, fbs_sector_subset):
+            compare_fba_geo_subset_and_fbs_output_totals(flows_subset_geo, fbs_sector_subset,
+                                                         aset, k, v, attr, method)
+
+    log.info("Completed flowbysector for %s in %.1f seconds", aset,
+             time.perf_counter() - start_time)
+
+    return fbs_sector_subset
+
+
+def collect_activity_set_results(fbs_list, stage_times):
+    """
+    Wait for activity sets submitted to the process pool, keeping the order of the list
+    :param fbs_list: list, fbs dfs or futures of fbs dfs and stage records
+    :param stage_times: list, records of each stage, extended with the records
+           of the activity sets run in the process pool
+    :return: list, fbs dfs
+    """
+    results = []
+    for f in fbs_list:
+        if isinstance(f, Future):
+            fbs, pool_stage_times = f.result()
+            stage_times.extend(pool_stage_times)
+            results.append(fbs)
+        else:
+            results.append(f)
+    return results
+
+
+def list_activity_set_fbas(k, v, aset, attr, method_name):
+    """
+    List the FBAs an activity set is created from: the source FBA, the allocation
+    and helper FBAs, and FBAs loaded within functions
+    :param k: str, source name
+    :param v: dictionary, the source parameters in the FBS method yaml
+    :param aset: str, activity set
+    :param attr: dictionary, attribute data from method yaml for activity set
+    :param method_name: str, FBS method name
+    :return: list, FBA (source, year) pairs
+    """
+    fbas = [(k, v['year'])]
+    if attr.get('allocation_source', 'None') != 'None':
+        fbas.append((attr['allocation_source'], attr.get('allocation_source_year')))
+    if 'helper_source' in attr:
+        fbas.append((attr['helper_source'], attr['helper_source_year']))
+    fxn_fbas = load_fbs_methods_additional_fbas_config().get(method_name, {}).get(
+        k, {}).get(aset, {})
+    for fxn, fba_info in fxn_fbas.items():
+        for fba, y in fba_info.items():
+            fbas.append((load_functions_loading_fbas_config()[fxn][fba]['source'], y))
+    return fbas
+
+
+def activity_set_fingerprint(k, v, aset, attr, names, method, method_name,
+                             previous_fingerprints):
+    """
+    Create a hash of the inputs to an activity set: the method parameters, the versions
+    of the FBAs, crosswalks and flow mappings it is created from, and the code used to
+    create it
+    :param k: str, source name
+    :param v: dictionary, the source parameters in the FBS method yaml
+    :param aset: str, activity set
+    :param attr: dictionary, attribute data from method yaml for activity set
+    :param names: list, activity names in activity set
+    :param method: dictionary, FBS method yaml
+    :param method_name: str, FBS method name
+    :param previous_fingerprints: list, fingerprints of the activity sets and sources
+           preceding an activity set that uses an allocation function, else empty
+    :return: str, hash of inputs
+    """
+    source_params = {kk: vv for kk, vv in v.items() if kk != 'activity_sets'}
+    # the validation level does not change the activity set
+    method_params = {kk: vv for kk, vv in method.items()
+                     if kk not in ['source_names', 'validation_level']}
+    params = [k, source_params, aset, attr, list(names), method_params]
+
+    fbas = list_activity_set_fbas(k, v, aset, attr, method_name)
+    fba_files = []
+    for source, year in fbas:
+        fba_meta = set_fb_meta(flowsa.flowbyactivity.set_fba_name(source, year),
+                               "FlowByActivity")
+        fba_files.append(flowsa.flowbyactivity.find_local_fba(fba_meta) or '')
+    sources = {source for source, year in fbas}
+    # the sector crosswalks, sector code and FIPS files are read throughout the activity set
+    input_files = get_data_files() + \
+        [get_activitytosector_mapping_path(source) for source in sorted(sources)]
+    if 'activity_set_file' in v:
+        input_files.append(flowbysectoractivitysetspath + v['activity_set_file'])
+    code_files = [f'{MODULEPATH}{m}.py' for m in fbs_modules] + \
+        [f'{datasourcescriptspath}{find_true_file_path(datasourcescriptspath, source, "py")}.py'
+         for source in sorted(sources)]
+
+    fingerprint = hashlib.sha256(
+        json.dumps([PKG_VERSION_NUMBER, params, get_file_info(fba_files + input_files),
+                    get_flow_mapping_versions(), previous_fingerprints],
+                   sort_keys=True, default=str).encode())
+    fingerprint.update(hash_file_contents(tuple(code_files)).encode())
+    return fingerprint.hexdigest()[0:12]
+
+
+def get_flow_mapping_versions():
+    """
+    Identify the versions of the packages used to map flows, as activity sets are mapped
+    with the flow mappings of the installed fedelemflowlist
+    :return: dictionary, version of each package, None if the package is not installed
+    """
+    versions = {}
+    for package in flow_mapping_packages:
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def source_fingerprint(k, v):
+    """
+    Create a hash of a source that is loaded in FBS format, used as an input to
+    activity sets that use an allocation function
+    :param k: str, source name
+    :param v: dictionary, the source parameters in the FBS method yaml
+    :return: str, hash of the source parameters and stored FBS
+    """
+    fbs_file = find_file(set_fb_meta(k, "FlowBySector"), paths) if \
+        v['data_format'] == 'FBS' else ''
+    return hashlib.sha256(json.dumps([k, v, get_file_info([fbs_file] if fbs_file else [])],
+                                     sort_keys=True, default=str).encode()
+                          ).hexdigest()[0:12]
+
+
+def get_activity_set_path(method_name, k, aset, fingerprint):
+    """
+    Generate the path of a stored activity set FBS
+    :param method_name: str, FBS method name
+    :param k: str, source name
+    :param aset: str, activity set
+    :param fingerprint: str, hash of the activity set inputs
+    :return: str, path to parquet
+    """
+    return f'{activitysetoutputpath}{method_name}/{k}_{aset}_{fingerprint}.parquet'
+
+
+def process_and_store_activity_set(k, v, aset, attr, names, flows_mapped, aset_names,
+                                   method, method_name, fbs_list, previous_fingerprints,
+                                   stage_times):
+    """
+    Create the FBS for an activity set and store it, so it is not created again
+    while the activity set inputs are unchanged
+    :param k: str, source name
+    :param v: dictionary, the source parameters in the FBS method yaml
+    :param aset: str, activity set
+    :param attr: dictionary, attribute data from method yaml for activity set
+    :param names: list, activity names in activity set
+    :param flows_mapped: df, FBA with flows mapped to the federal elementary flow list
+    :param aset_names: df, activity set names if specified in an activity set file, else None
+    :param method: dictionary, FBS method yaml
+    :param method_name: str, FBS method name
+    :param fbs_list: list, fbs dfs created for previous activity sets, used by
+           allocation functions
+    :param previous_fingerprints: list, see activity_set_fingerprint
+    :param stage_times: list, records of the time and memory of each stage, see
+           record_stage
+    :return: df, FBS for the activity set at the target sector level
+    """
+    fbs = process_activity_set(k, v, aset, attr, names, flows_mapped, aset_names,
+                               method, method_name, fbs_list, stage_times)
+    # FBAs generated while creating the activity set change the hash
+    fingerprint = activity_set_fingerprint(k, v, aset, attr, names, method, method_name,
+                                           previous_fingerprints)
+    fbs_file = get_activity_set_path(method_name, k, aset, fingerprint)
+    create_paths_if_missing(f'{activitysetoutputpath}{method_name}/')
+    # remove activity sets stored for previous inputs
+    stored_prefix = get_activity_set_path(method_name, k, aset, '')[:-len('.parquet')]
+    remove_stale_files(f'{glob.escape(stored_prefix)}{"?" * 12}.parquet')
+    try:
+        write_parquet_atomically(fbs, fbs_file)
+    except (ValueError, TypeError):
+        log.warning("Unable to store flowbysector for %s", aset)
+    return fbs
+
+
+def process_and_store_activity_set_in_pool(*args):
+    """
+    Run process_and_store_activity_set in a process pool worker, returning the stage
+    records along with the fbs, as the worker cannot append to the list in the
+    main process
+    :param args: arguments of process_and_store_activity_set, excluding stage_times
+    :return: df, FBS for the activity set, and list, records of each stage
+    """
+    stage_times = []
+    fbs = process_and_store_activity_set(*args, stage_times)
+    return fbs, stage_times
+
+
+def load_and_map_source_flows(k, v, stage_times):
+    """
+    Load a FBA source, mapping flows and cleaning the df as specified in the method yaml
+    :param k: str, source name
+    :param v: dictionary, the source parameters in the FBS method yaml
+    :param stage_times: list, records of the time and memory of each stage, see
+           record_stage
+    :return: df, FBA with flows mapped to the federal elementary flow list
+    """
+    with record_stage(stage_times, 'load', k) as stage:
+        # pull fba data for allocation
+        flows = load_source_dataframe(k, v)
+        # ensure correct datatypes and that all fields exist
+        flows = clean_df(flows, flow_by_activity_fields,
+                         fba_fill_na_dict, drop_description=False)
+        stage['rows_out'] = len(flows)
+
+    with record_stage(stage_times, 'map_fbs_flows', k, df_in=flows) as stage:
+        # map flows to federal flow list or material flow list
+        flows_mapped, mapping_files = map_fbs_flows(flows, k, v, keep_fba_columns=True)
+
+        # clean up fba, if specified in yaml
+        if "clean_fba_df_fxn" in v:
+            vLog.info("Cleaning up %s FlowByActivity", k)
+            flows_mapped = dynamically_import_fxn(k, v["clean_fba_df_fxn"])(flows_mapped)
+        stage['rows_out'] = len(flows_mapped)
+    return flows_mapped
+
+
+def write_stage_times(stage_times, fb_meta):
+    """
+    Write the records of each stage in creating a FBS as a JSON next to the FBS metadata
+    :param stage_times: list, records of the time and memory of each stage, see
+           record_stage
+    :param fb_meta: object, FBS metadata
+    :return: None
+    """
+    git_hash = f'_{fb_meta.git_hash}' if fb_meta.git_hash else ''
+    f = f'{fbsoutputpath}{fb_meta.name_data}_v{fb_meta.tool_version}{git_hash}' \
+        f'_stage_times.json'
+    create_paths_if_missing(fbsoutputpath)
+    with open(f, 'w') as fp:
+        json.dump(stage_times, fp, indent=1)
+
+
 def main(**kwargs):
     """
-    Creates a flowbysector dataset
-    :param kwargs: dictionary of arguments, only argument is "method_name", the name of method
-                   corresponding to flowbysector method yaml name
+    Creates a flowbysector dataset. Each activity set is stored when created, and
+    loaded rather than created again while its inputs are unchanged.
+    :param kwargs: dictionary of arguments, "method", the name of method
+                   corresponding to flowbysector method yaml name, and optionally
+                   "max_workers", the number of processes to run activity sets in, and
+                   "validation_level", overriding the validation level of the method yaml,
+                   and "compact_dtypes", to save the FBS with compact dtypes
     :return: parquet, FBS save to local folder
     """
     if len(kwargs) == 0:
         kwargs = parse_args()
 
+    # FBSs used as sources are created by a nested call from getFlowBySector, so restore
+    # the validation report run of the calling method once the FBS is created
+    calling_report_run = dict(validation_report_run)
+    try:
+        create_flowbysector(kwargs)
+    finally:
+        validation_report_run.update(calling_report_run)
+
+
+def create_flowbysector(kwargs):
+    """
+    Create a flowbysector dataset, see main
+    :param kwargs: dictionary of arguments, see main
+    :return: parquet, FBS save to local folder
+    """
     method_name = kwargs['method']
+    max_workers = kwargs.get('max_workers')
     # assign arguments
     vLog.info("Initiating flowbysector creation for %s", method_name)
     # call on method
     method = load_method(method_name)
+    if kwargs.get('validation_level') is not None:
+        method['validation_level'] = kwargs['validation_level']
+    if method.get('validation_level', DEFAULT_VALIDATION_LEVEL) not in validation_level_key:
+        raise ValueError(f"validation_level must be one of {', '.join(validation_level_key)}")
+    vLog.info("Running %s validation", method.get('validation_level', DEFAULT_VALIDATION_LEVEL))
+    # validation comparisons are saved to a report run for the method
+    start_validation_report_run(method_name, enabled=run_validation(method, 'summary'),
+                                validation_level=method.get('validation_level',
+                                                            DEFAULT_VALIDATION_LEVEL))
     # create dictionary of data and allocation datasets
     fb = method['source_names']
     # Create empty list for storing fbs files
     fbs_list = []
-    for k, v in fb.items():
-        # pull fba data for allocation
-        flows = load_source_dataframe(k, v)
-
-        if v['data_format'] == 'FBA':
-            # ensure correct datatypes and that all fields exist
-            flows = clean_df(flows, flow_by_activity_fields,
-                             fba_fill_na_dict, drop_description=False)
-
-            # map flows to federal flow list or material flow list
-            flows_mapped, mapping_files = map_fbs_flows(flows, k, v, keep_fba_columns=True)
-
-            # clean up fba, if specified in yaml
-            if "clean_fba_df_fxn" in v:
-                vLog.info("Cleaning up %s FlowByActivity", k)
-                flows_mapped = dynamically_import_fxn(k, v["clean_fba_df_fxn"])(flows_mapped)
-
-            # if activity_sets are specified in a file, call them here
-            if 'activity_set_file' in v:
-                aset_names = pd.read_csv(flowbysectoractivitysetspath +
-                                         v['activity_set_file'], dtype=str)
-            else:
-                aset_names = None
-
-            # create dictionary of allocation datasets for different activities
-            activities = v['activity_sets']
-            # subset activity data and allocate to sector
-            for aset, attr in activities.items():
-                # subset by named activities
+    # fingerprints of the activity sets and sources added to fbs_list
+    fingerprints = []
+    # time, row counts and memory of each stage
+    stage_times = []
+    # activity sets that do not use an allocation function are independent of each other,
+    # so if specified they run in a process pool, storing futures in fbs_list
+    executor = create_process_pool_executor(max_workers) if max_workers else None
+    try:
+        for k, v in fb.items():
+            if v['data_format'] == 'FBA':
+                # if activity_sets are specified in a file, call them here
                 if 'activity_set_file' in v:
-                    names = aset_names[aset_names['activity_set'] == aset]['name']
-                else:
-                    names = attr['names']
-
-                vLog.info("Preparing to handle %s in %s", aset, k)
-                # subset fba data by activity
-                flows_subset =\
-                    flows_mapped[(flows_mapped[fba_activity_fields[0]].isin(names)) |
-                              (flows_mapped[fba_activity_fields[1]].isin(names)
-                               )].reset_index(drop=True)
-
-                # if activities are sector-like, check sectors are valid
-                if load_source_catalog()[k]['sector-like_activities']:
-                    flows_subset2 =\
-                        replace_naics_w_naics_from_another_year(flows_subset,
-                                                                method['target_sector_source'])
-                    # check impact on df FlowAmounts
-                    vLog.info('Calculate FlowAmount difference caused by '
-                              'replacing NAICS Codes with %s, saving difference in Validation log',
-                              method['target_sector_source'],)
-                    calculate_flowamount_diff_between_dfs(flows_subset, flows_subset2)
+                    aset_names = pd.read_csv(flowbysectoractivitysetspath +
+                                             v['activity_set_file'], dtype=str)
                 else:
-                    flows_subset2 = flows_subset.copy()
-
-                # extract relevant geoscale data or aggregate existing data
-                flows_subset_geo = subset_df_by_geoscale(flows_subset2, v['geoscale_to_use'],
-                                                         attr['allocation_from_scale'])
-                # if loading data subnational geoscale, check for data loss
-                if attr['allocation_from_scale'] != 'national':
-                    compare_geographic_totals(flows_subset_geo, flows_mapped, k,
-                                              attr, aset, names)
-
-                # Add sectors to df activity, depending on level of specified sector aggregation
-                log.info("Adding sectors to %s", k)
-                flows_subset_wsec =\
-                    add_sectors_to_flowbyactivity(flows_subset_geo,
-                                                  sectorsourcename=method['target_sector_source'],
-                                                  allocationmethod=attr['allocation_method'])
-                # clean up fba with sectors, if specified in yaml
-                if "clean_fba_w_sec_df_fxn" in v:
-                    vLog.info("Cleaning up %s FlowByActivity with sectors", k)
-                    flows_subset_wsec = \
-                        dynamically_import_fxn(k, v["clean_fba_w_sec_df_fxn"])(flows_subset_wsec,
-                                                                               attr=attr,
-                                                                               method=method)
-
-                # rename SourceName to MetaSources and drop columns
-                flows_mapped_wsec = flows_subset_wsec.\
-                    rename(columns={'SourceName': 'MetaSources'}).\
-                    drop(columns=['FlowName', 'Compartment'])
-
-                # if allocation method is "direct", then no need to create alloc ratios,
-                # else need to use allocation
-                # dataframe to create sector allocation ratios
-                if attr['allocation_method'] == 'direct':
-                    fbs = direct_allocation_method(flows_mapped_wsec, k, names, method)
-                # if allocation method for an activity set requires a specific
-                # function due to the complicated nature
-                # of the allocation, call on function here
-                elif attr['allocation_method'] == 'allocation_function':
-                    fbs = function_allocation_method(flows_mapped_wsec, k, names, attr, fbs_list)
+                    aset_names = None
+
+                # create dictionary of allocation datasets for different activities
+                activities = v['activity_sets']
+                # activity sets with unchanged inputs are loaded from the stored activity set
+                aset_list = []
+                for aset, attr in activities.items():
+                    # subset by named activities
+                    if 'activity_set_file' in v:
+                        names = aset_names[aset_names['activity_set'] == aset]['name']
+                    else:
+                        names = attr['names']
+                    # allocation functions can use the fbs of previous activity sets
+                    if attr['allocation_method'] == 'allocation_function':
+                        previous_fingerprints = list(fingerprints)
+                    else:
+                        previous_fingerprints = []
+                    fingerprint = activity_set_fingerprint(k, v, aset, attr, names, method,
+                                                           method_name, previous_fingerprints)
+                    fingerprints.append(fingerprint)
+                    aset_list.append((aset, attr, names, previous_fingerprints,
+                                      get_activity_set_path(method_name, k, aset, fingerprint)))
+
+                # only load the source if an activity set must be created
+                if all(os.path.isfile(a[-1]) for a in aset_list):
+                    flows_mapped = None
                 else:
-                    fbs =\
-                        dataset_allocation_method(flows_mapped_wsec, attr,
-                                                  names, method, k, v, aset,
-                                                  method_name, aset_names)
-
-                # drop rows where flowamount = 0 (although this includes dropping suppressed data)
-                fbs = fbs[fbs['FlowAmount'] != 0].reset_index(drop=True)
-
-                # define grouping columns dependent on sectors being activity-like or not
-                if load_source_catalog()[k]['sector-like_activities'] is False:
-                    groupingcols = fbs_grouping_fields_w_activities
-                    groupingdict = flow_by_sector_fields_w_activity
-                else:
-                    groupingcols = fbs_default_grouping_fields
-                    groupingdict = flow_by_sector_fields
-
-                # clean df
-                fbs = clean_df(fbs, groupingdict, fbs_fill_na_dict)
-
-                # aggregate df geographically, if necessary
-                log.info("Aggregating flowbysector to %s level", method['target_geoscale'])
-                # determine from scale
-                if fips_number_key[v['geoscale_to_use']] <\
-                        fips_number_key[attr['allocation_from_scale']]:
-                    from_scale = v['geoscale_to_use']
-                else:
-                    from_scale = attr['allocation_from_scale']
-
-                fbs_geo_agg = agg_by_geoscale(fbs, from_scale,
-                                              method['target_geoscale'], groupingcols)
-
-                # aggregate data to every sector level
-                log.info("Aggregating flowbysector to all sector levels")
-                fbs_sec_agg = sector_aggregation(fbs_geo_agg, groupingcols)
-                # add missing naics5/6 when only one naics5/6 associated with a naics4
-                fbs_agg = sector_disaggregation(fbs_sec_agg)
-
-                # check if any sector information is lost before reaching
-                # the target sector length, if so,
-                # allocate values equally to disaggregated sectors
-                vLog.info('Searching for and allocating FlowAmounts for any parent '
-                          'NAICS that were dropped in the subset to '
-                          '%s child NAICS', method['target_sector_level'])
-                fbs_agg_2 = allocate_dropped_sector_data(fbs_agg, method['target_sector_level'])
-
-                # compare flowbysector with flowbyactivity
-                compare_activity_to_sector_flowamounts(
-                    flows_mapped_wsec, fbs_agg_2, aset, k, method)
-
-                # return sector level specified in method yaml
-                # load the crosswalk linking sector lengths
-                sector_list = get_sector_list(method['target_sector_level'])
-
-                # subset df, necessary because not all of the sectors are
-                # NAICS and can get duplicate rows
-                fbs_1 = fbs_agg_2.loc[(fbs_agg_2[fbs_activity_fields[0]].isin(sector_list)) &
-                                      (fbs_agg_2[fbs_activity_fields[1]].isin(sector_list))].\
-                    reset_index(drop=True)
-                fbs_2 = fbs_agg_2.loc[(fbs_agg_2[fbs_activity_fields[0]].isin(sector_list)) &
-                                      (fbs_agg_2[fbs_activity_fields[1]].isnull())].\
-                    reset_index(drop=True)
-                fbs_3 = fbs_agg_2.loc[(fbs_agg_2[fbs_activity_fields[0]].isnull()) &
-                                      (fbs_agg_2[fbs_activity_fields[1]].isin(sector_list))].\
-                    reset_index(drop=True)
-                fbs_sector_subset = pd.concat([fbs_1, fbs_2, fbs_3])
-
-                # drop activity columns
-                fbs_sector_subset = fbs_sector_subset.drop(['ActivityProducedBy',
-                                                            'ActivityConsumedBy'],
-                                                           axis=1, errors='ignore')
-
-                # save comparison of FBA total to FBS total for an activity set
-                compare_fba_geo_subset_and_fbs_output_totals(flows_subset_geo, fbs_sector_subset,
-                                                             aset, k, v, attr, method)
-
-                log.info("Completed flowbysector for %s", aset)
-                fbs_list.append(fbs_sector_subset)
-        else:
-            # if the loaded flow dt is already in FBS format, append directly to list of FBS
-            log.info("Append %s to FBS list", k)
-            # ensure correct field datatypes and add any missing fields
-            flows = clean_df(flows, flow_by_sector_fields, fbs_fill_na_dict)
-            fbs_list.append(flows)
-    # create single df of all activities
-    log.info("Concat data for all activities")
-    fbss = pd.concat(fbs_list, ignore_index=True, sort=False)
-    log.info("Clean final dataframe")
-    # add missing fields, ensure correct data type, add missing columns, reorder columns
-    fbss = clean_df(fbss, flow_by_sector_fields, fbs_fill_na_dict)
-    # prior to aggregating, replace MetaSources string with all sources
-    # that share context/flowable/sector values
-    fbss = harmonize_FBS_columns(fbss)
-    # aggregate df as activities might have data for the same specified sector length
-    fbss = aggregator(fbss, fbs_default_grouping_fields)
-    # sort df
-    log.info("Sort and store dataframe")
-    # ensure correct data types/order of columns
-    fbss = clean_df(fbss, flow_by_sector_fields, fbs_fill_na_dict)
-    fbss = fbss.sort_values(
-        ['SectorProducedBy', 'SectorConsumedBy', 'Flowable', 'Context']).reset_index(drop=True)
-    # tmp reset data quality scores
-    fbss = reset_fbs_dq_scores(fbss)
-    # save parquet file
-    meta = set_fb_meta(method_name, "FlowBySector")
-    write_df_to_file(fbss, paths, meta)
-    write_metadata(method_name, method, meta, "FlowBySector")
+                    flows_mapped = load_and_map_source_flows(k, v, stage_times)
+
+                # subset activity data and allocate to sector
+                for aset, attr, names, previous_fingerprints, fbs_file in aset_list:
+                    if os.path.isfile(fbs_file):
+                        log.info("Loading stored flowbysector for %s, inputs are unchanged", aset)
+                        if run_validation(method, 'summary'):
+                            vLog.info("Skipping validation of %s %s, the stored activity "
+                                      "set was validated when created", k, aset)
+                        with record_stage(stage_times, 'load_stored', k, aset) as stage:
+                            fbs_list.append(pd.read_parquet(fbs_file))
+                            stage['rows_out'] = len(fbs_list[-1])
+                    elif executor is None:
+                        fbs_list.append(process_and_store_activity_set(
+                            k, v, aset, attr, names, flows_mapped, aset_names, method,
+                            method_name, fbs_list, previous_fingerprints, stage_times))
+                    elif attr['allocation_method'] == 'allocation_function':
+                        # allocation functions can use the fbs of previous activity sets,
+                        # so wait for those running in the process pool to complete
+                        fbs_list = collect_activity_set_results(fbs_list, stage_times)
+                        fbs_list.append(process_and_store_activity_set(
+                            k, v, aset, attr, names, flows_mapped, aset_names, method,
+                            method_name, fbs_list, previous_fingerprints, stage_times))
+                    else:
+                        fbs_list.append(executor.submit(
+                            process_and_store_activity_set_in_pool, k, v, aset, attr, names,
+                            flows_mapped, aset_names, method, method_name, [],
+                            previous_fingerprints))
+            else:
+                with record_stage(stage_times, 'load', k) as stage:
+                    # pull fba data for allocation
+                    flows = load_source_dataframe(k, v)
+                    # if the loaded flow dt is already in FBS format, append directly to list
+                    # of FBS
+                    log.info("Append %s to FBS list", k)
+                    # ensure correct field datatypes and add any missing fields
+                    flows = clean_df(flows, flow_by_sector_fields, fbs_fill_na_dict)
+                    stage['rows_out'] = len(flows)
+                fbs_list.append(flows)
+                fingerprints.append(source_fingerprint(k, v))
+        if executor is not None:
+            fbs_list = collect_activity_set_results(fbs_list, stage_times)
+    finally:
+        # shut down the process pool workers if an activity set fails
+        if executor is not None:
+            executor.shutdown()
+    with record_stage(stage_times, 'finalize', method_name) as stage:
+        stage['rows_in'] = sum(len(df) for df in fbs_list)
+        # create single df of all activities
+        log.info("Concat data for all activities")
+        fbss = pd.concat(fbs_list, ignore_index=True, sort=False)
+        log.info("Clean final dataframe")
+        # add missing fields, ensure correct data type, add missing columns, reorder columns
+        fbss = clean_df(fbss, flow_by_sector_fields, fbs_fill_na_dict)
+        # prior to aggregating, replace MetaSources string with all sources
+        # that share context/flowable/sector values
+        fbss = harmonize_FBS_columns(fbss)
+        # aggregate df as activities might have data for the same specified sector length
+        fbss = aggregator(fbss, fbs_default_grouping_fields)
+        # sort df
+        log.info("Sort and store dataframe")
+        # ensure correct data types/order of columns
+        fbss = clean_df(fbss, flow_by_sector_fields, fbs_fill_na_dict)
+        fbss = fbss.sort_values(['SectorProducedBy', 'SectorConsumedBy', 'Flowable',
+                                 'Context']).reset_index(drop=True)
+        # tmp reset data quality scores
+        fbss = reset_fbs_dq_scores(fbss)
+        # compact dtypes are set once no values are modified
+        if kwargs.get('compact_dtypes'):
+            fbss = convert_to_compact_dtypes(fbss)
+        # save parquet file
+        meta = set_fb_meta(method_name, "FlowBySector")
+        write_df_to_file(fbss, paths, meta)
+        stage['rows_out'] = len(fbss)
+        write_metadata(method_name, method, meta, "FlowBySector")
+    write_stage_times(stage_times, meta)
     # rename the log file saved to local directory
     rename_log_file(method_name, meta)
     log.info('See the Validation log for detailed assessment of model results in %s', logoutputpath)
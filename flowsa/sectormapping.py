@@ -4,14 +4,25 @@
 """
 Contains mapping functions
 """
+import os
+import glob
+import hashlib
 import pandas as pd
 import numpy as np
 from esupy.mapping import apply_flow_mapping
+from esupy.processed_data_mgmt import create_paths_if_missing
 from flowsa.common import datapath, SECTOR_SOURCE_NAME, activity_fields, load_source_catalog, \
-    load_sector_crosswalk, log, fba_activity_fields
+    load_sector_crosswalk, log, fba_activity_fields, load_csv_df, apply_unit_conversions, \
+    load_sorted_sector_codes, mappingoutputpath, PKG_VERSION_NUMBER, get_file_info, \
+    MODULEPATH, hash_file_contents, write_parquet_atomically, remove_stale_files
 from flowsa.flowbyfunctions import fbs_activity_fields, load_sector_length_crosswalk
 from flowsa.validation import replace_naics_w_naics_from_another_year
 
+# compiled activity-to-sector mappings loaded in this session, keyed by parquet path
+compiled_mappings = {}
+# modules used to compile the activity-to-sector mappings
+mapping_modules = ['common', 'sectormapping']
+
 
 def get_activitytosector_mapping(source):
     """
@@ -19,14 +30,23 @@ def get_activitytosector_mapping(source):
     :param source: str, the data source name
     :return: a pandas df for a standard ActivitytoSector mapping
     """
+    mapping = load_csv_df(get_activitytosector_mapping_path(source),
+                          dtype={'Activity': 'str',
+                                 'Sector': 'str'})
+    return mapping
+
+
+def get_activitytosector_mapping_path(source):
+    """
+    Gets the path of the activity-to-sector mapping csv
+    :param source: str, the data source name
+    :return: str, path to the mapping csv
+    """
     if 'EPA_NEI' in source:
         source = 'SCC'
     if 'BEA' in source:
         source = 'BEA_2012_Detail'
-    mapping = pd.read_csv(datapath+'activitytosectormapping/'+'Crosswalk_'+source+'_toNAICS.csv',
-                          dtype={'Activity': 'str',
-                                 'Sector': 'str'})
-    return mapping
+    return datapath+'activitytosectormapping/'+'Crosswalk_'+source+'_toNAICS.csv'
 
 
 def add_sectors_to_flowbyactivity(flowbyactivity_df, sectorsourcename=SECTOR_SOURCE_NAME, **kwargs):
@@ -57,6 +77,88 @@ def add_sectors_to_flowbyactivity(flowbyactivity_df, sectorsourcename=SECTOR_SOU
                 levelofSectoragg = 'disaggregated'
         if 'overwrite_sectorlevel' in kwargs:
             levelofSectoragg = kwargs['overwrite_sectorlevel']
+    mapping = load_compiled_activitytosector_mapping(s, src_info, sectorsourcename,
+                                                     levelofSectoragg)
+    # Merge in with flowbyactivity by expanding the unique pairs of produced/consumed
+    # activities to sectors, then merging them into the df once
+    activity_pairs = flowbyactivity_df[fba_activity_fields].drop_duplicates()
+    for k, v in activity_fields.items():
+        sector_direction = k
+        flowbyactivity_field = v[0]["flowbyactivity"]
+        flowbysector_field = v[1]["flowbysector"]
+        sector_type_field = sector_direction+'SectorType'
+        mappings_df_tmp = mapping.rename(columns={'Activity': flowbyactivity_field,
+                                                      'Sector': flowbysector_field,
+                                                      'SectorType': sector_type_field})
+        # column doesn't exist for sector-like activities, so ignore if error occurs
+        mappings_df_tmp = mappings_df_tmp.drop(columns=['ActivitySourceName'], errors='ignore')
+        activity_pairs = pd.merge(activity_pairs, mappings_df_tmp,
+                                  how='left', on=flowbyactivity_field)
+    # Merge them in. Critical this is a left merge to preserve all unmapped rows
+    flowbyactivity_wsector_df = pd.merge(flowbyactivity_df, activity_pairs,
+                                         how='left', on=fba_activity_fields)
+    flowbyactivity_wsector_df = flowbyactivity_wsector_df.replace({np.nan: None})
+    # add sector source name
+    flowbyactivity_wsector_df = flowbyactivity_wsector_df.assign(SectorSourceName=sectorsourcename)
+
+    # if activities are sector-like check that the sectors are in the crosswalk
+    if src_info['sector-like_activities']:
+        flowbyactivity_wsector_df =\
+            replace_naics_w_naics_from_another_year(flowbyactivity_wsector_df,
+                                                    sectorsourcename)
+
+    return flowbyactivity_wsector_df
+
+
+def load_compiled_activitytosector_mapping(source, src_info, sectorsourcename,
+                                            levelofSectoragg):
+    """
+    Load the activity-to-sector mapping for a source, compiling it and saving it as a
+    parquet if it does not exist or if the crosswalks or source catalog changed since
+    the mapping was compiled, or the code compiling it changed
+    :param source: str, the data source name
+    :param src_info: dictionary, source catalog information for the source
+    :param sectorsourcename: str, sectorsourcename for naics year
+    :param levelofSectoragg: str, 'aggregated' or 'disaggregated'
+    :return: df, activity-to-sector mapping
+    """
+    # files the mapping is compiled from
+    input_files = [datapath + 'NAICS_Crosswalk.csv', datapath + 'source_catalog.yaml']
+    if not src_info['sector-like_activities']:
+        input_files.append(get_activitytosector_mapping_path(source))
+    file_info = get_file_info(input_files)
+    code_hash = hash_file_contents(tuple(f'{MODULEPATH}{m}.py' for m in mapping_modules))
+    fingerprint = hashlib.sha256(
+        repr((PKG_VERSION_NUMBER, file_info, code_hash)).encode()).hexdigest()[0:12]
+    mapping_name = f'{source}_{sectorsourcename}_{levelofSectoragg}_'
+    mapping_file = f'{mappingoutputpath}{mapping_name}{fingerprint}.parquet'
+
+    if mapping_file not in compiled_mappings:
+        if os.path.isfile(mapping_file):
+            mapping = pd.read_parquet(mapping_file)
+        else:
+            log.info("Compiling activity-to-sector mapping for %s", source)
+            mapping = compile_activitytosector_mapping(source, src_info, sectorsourcename,
+                                                       levelofSectoragg)
+            create_paths_if_missing(mappingoutputpath)
+            # process pool workers can load the file while it is written
+            write_parquet_atomically(mapping, mapping_file)
+            # remove mappings compiled from previous inputs
+            remove_stale_files(f'{glob.escape(mappingoutputpath + mapping_name)}'
+                               f'{"?" * 12}.parquet', keep=1)
+        compiled_mappings[mapping_file] = mapping
+    return compiled_mappings[mapping_file].copy()
+
+
+def compile_activitytosector_mapping(source, src_info, sectorsourcename, levelofSectoragg):
+    """
+    Create the activity-to-sector mapping for a source
+    :param source: str, the data source name
+    :param src_info: dictionary, source catalog information for the source
+    :param sectorsourcename: str, sectorsourcename for naics year
+    :param levelofSectoragg: str, 'aggregated' or 'disaggregated'
+    :return: df, activity-to-sector mapping
+    """
     # if data are provided in NAICS format, use the mastercrosswalk
     if src_info['sector-like_activities']:
         cw = load_sector_crosswalk()
@@ -68,7 +170,7 @@ def add_sectors_to_flowbyactivity(flowbyactivity_df, sectorsourcename=SECTOR_SOU
         mapping = mapping.rename(columns={SECTOR_SOURCE_NAME: "Sector"})
         # add columns so can run expand_naics_list_fxn
         # if sector-like_activities = True, missing columns, so add
-        mapping['ActivitySourceName'] = s
+        mapping['ActivitySourceName'] = source
         # tmp assignment
         mapping['SectorType'] = None
         # Include all digits of naics in mapping, if levelofNAICSagg is specified as "aggregated"
@@ -77,7 +179,7 @@ def add_sectors_to_flowbyactivity(flowbyactivity_df, sectorsourcename=SECTOR_SOU
     else:
         # if source data activities are text strings, or sector-like
         # activities should be modified, call on the manually created source crosswalks
-        mapping = get_activitytosector_mapping(s)
+        mapping = get_activitytosector_mapping(source)
         # filter by SectorSourceName of interest
         mapping = mapping[mapping['SectorSourceName'] == sectorsourcename]
         # drop SectorSourceName
@@ -85,32 +187,7 @@ def add_sectors_to_flowbyactivity(flowbyactivity_df, sectorsourcename=SECTOR_SOU
         # Include all digits of naics in mapping, if levelofNAICSagg is specified as "aggregated"
         if levelofSectoragg == 'aggregated':
             mapping = expand_naics_list(mapping, sectorsourcename)
-    # Merge in with flowbyactivity by
-    flowbyactivity_wsector_df = flowbyactivity_df
-    for k, v in activity_fields.items():
-        sector_direction = k
-        flowbyactivity_field = v[0]["flowbyactivity"]
-        flowbysector_field = v[1]["flowbysector"]
-        sector_type_field = sector_direction+'SectorType'
-        mappings_df_tmp = mapping.rename(columns={'Activity': flowbyactivity_field,
-                                                      'Sector': flowbysector_field,
-                                                      'SectorType': sector_type_field})
-        # column doesn't exist for sector-like activities, so ignore if error occurs
-        mappings_df_tmp = mappings_df_tmp.drop(columns=['ActivitySourceName'], errors='ignore')
-        # Merge them in. Critical this is a left merge to preserve all unmapped rows
-        flowbyactivity_wsector_df = pd.merge(flowbyactivity_wsector_df,mappings_df_tmp,
-                                             how='left', on=flowbyactivity_field)
-    flowbyactivity_wsector_df = flowbyactivity_wsector_df.replace({np.nan: None})
-    # add sector source name
-    flowbyactivity_wsector_df = flowbyactivity_wsector_df.assign(SectorSourceName=sectorsourcename)
-
-    # if activities are sector-like check that the sectors are in the crosswalk
-    if src_info['sector-like_activities']:
-        flowbyactivity_wsector_df =\
-            replace_naics_w_naics_from_another_year(flowbyactivity_wsector_df,
-                                                    sectorsourcename)
-
-    return flowbyactivity_wsector_df
+    return mapping.reset_index(drop=True)
 
 
 def expand_naics_list(df, sectorsourcename):
@@ -121,28 +198,27 @@ def expand_naics_list(df, sectorsourcename):
     :return: df with additional rows for expanded sector list
     """
 
-    # load master crosswalk
-    cw = load_sector_crosswalk()
-    sectors = cw.loc[:, [sectorsourcename]]
-    # drop duplicates
-    sectors = sectors.drop_duplicates().dropna()
-    # drop rows that contain hyphenated sectors
-    sectors = sectors[~sectors[sectorsourcename].str.contains("-")].reset_index(drop=True)
-    # Ensure 'None' not added to sectors
-    sectors = sectors[sectors[sectorsourcename] != "None"]
+    # load sector codes sorted by code
+    sectors = load_sorted_sector_codes(sectorsourcename)
+    sorted_codes = sectors.values
 
     # create list of sectors that exist in original df, which,
     # if created when expanding sector list cannot be added
-    existing_sectors = df[['Sector']]
-    existing_sectors = existing_sectors.drop_duplicates()
-
-    naics_df = pd.DataFrame([])
-    for i in existing_sectors['Sector']:
-        dig = len(str(i))
-        n = sectors.loc[sectors[sectorsourcename].apply(lambda x: x[0:dig]) == i]
-        if len(n) != 0:
-            n = n.assign(Sector=i)
-            naics_df = naics_df.append(n)
+    existing_sectors = [i for i in df['Sector'].drop_duplicates() if isinstance(i, str)]
+    existing_sectors = np.array(existing_sectors, dtype=object)
+
+    # the sectors that start with each existing sector are a slice of the sorted codes
+    start = np.searchsorted(sorted_codes, existing_sectors, side='left')
+    end = np.searchsorted(sorted_codes, existing_sectors + '\U0010ffff', side='left')
+    counts = end - start
+    group = np.repeat(np.arange(len(existing_sectors)), counts)
+    sorted_position = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + \
+        np.repeat(start, counts)
+    # keep the crosswalk order of the sectors for each existing sector
+    crosswalk_order = sectors.index.values[sorted_position]
+    order = np.lexsort((crosswalk_order, group))
+    naics_df = pd.DataFrame({sectorsourcename: sorted_codes[sorted_position[order]],
+                             'Sector': existing_sectors[group[order]]})
 
     # merge df to retain activityname/sectortype info
     naics_expanded = df.merge(naics_df, how='left')
@@ -263,11 +339,11 @@ def convert_units_to_annual(df):
     :param df: df with 'FlowAmount' and 'Unit' column
     :return: df with annual FlowAmounts
     """
-    # convert unit per day to year
-    df['FlowAmount'] = np.where(df['Unit'].str.contains('/d'),
-                                df['FlowAmount'] * 365,
-                                df['FlowAmount'])
-    df['Unit'] = df['Unit'].apply(lambda x: x.replace('/d', ""))
+    # convert unit per day to year, building conversions for the units in the df
+    per_day_units = [u for u in df['Unit'].dropna().unique() if '/d' in u]
+    conversions = pd.DataFrame({'TargetUnit': [u.replace('/d', "") for u in per_day_units],
+                                'Multiplier': 1, 'PerDay': True}, index=per_day_units)
+    df = apply_unit_conversions(df, conversions)
 
     return df
 
@@ -0,0 +1,147 @@
+# test_sector_functions.py (flowsa)
+# !/usr/bin/env python3
+# coding=utf-8
+"""
+Check the vectorized sector and unit conversion functions against known inputs, with the
+expected outputs created by the original loop implementations
+"""
+
+import pandas as pd
+import pytest
+from flowsa.common import flow_by_sector_fields, fbs_fill_na_dict, \
+    fbs_default_grouping_fields
+from flowsa.dataclean import clean_df, standardize_units
+from flowsa.flowbyfunctions import sector_aggregation, sector_disaggregation
+from flowsa.sectormapping import expand_naics_list
+from flowsa.validation import allocate_dropped_sector_data
+from flowsa.validationreport import start_validation_report_run
+
+
+@pytest.fixture(autouse=True)
+def disable_validation_reports():
+    """
+    Do not save validation reports created by the functions
+    """
+    start_validation_report_run('Test', enabled=False, validation_level='off')
+
+
+def make_fbs(rows):
+    """
+    Create a FBS df
+    :param rows: list, (SectorProducedBy, SectorConsumedBy, FlowAmount, Location)
+    :return: df, FBS format
+    """
+    df = pd.DataFrame(rows, columns=['SectorProducedBy', 'SectorConsumedBy',
+                                     'FlowAmount', 'Location'])
+    df = df.assign(Flowable='Water', Class='Water', Unit='kg', FlowType='ELEMENTARY_FLOW',
+                   Context='resource/water', LocationSystem='FIPS_2015', Year=2015,
+                   MetaSources='Test', DataReliability=1, DataCollection=1)
+    return clean_df(df, flow_by_sector_fields, fbs_fill_na_dict)
+
+
+def summarize_fbs(df):
+    """
+    Sum the FlowAmounts of a FBS by sector and location
+    :param df: df, FBS format
+    :return: list, (SectorProducedBy, SectorConsumedBy, Location, FlowAmount), sorted
+    """
+    df = df.fillna({'SectorProducedBy': '', 'SectorConsumedBy': ''}).replace(
+        {'SectorProducedBy': {None: ''}, 'SectorConsumedBy': {None: ''}})
+    df = df.groupby(['SectorProducedBy', 'SectorConsumedBy', 'Location'],
+                    as_index=False)['FlowAmount'].sum()
+    return sorted((r.SectorProducedBy, r.SectorConsumedBy, r.Location,
+                   round(r.FlowAmount, 6)) for r in df.itertuples())
+
+
+def test_sector_aggregation():
+    """
+    Missing parent sectors are added as the sum of their child sectors
+    """
+    fbs = make_fbs([['111110', None, 10, '00000'], ['111120', None, 20, '00000'],
+                    ['1121', None, 5, '00000'], ['112111', None, 3, '00000'],
+                    [None, '221310', 7, '06000'], ['11', None, 100, '00000']])
+    df = sector_aggregation(fbs, fbs_default_grouping_fields)
+    assert summarize_fbs(df) == [
+        ('', '22', '06000', 7.0), ('', '221', '06000', 7.0), ('', '2213', '06000', 7.0),
+        ('', '22131', '06000', 7.0), ('', '221310', '06000', 7.0),
+        ('11', '', '00000', 100.0), ('111', '', '00000', 30.0),
+        ('1111', '', '00000', 30.0), ('11111', '', '00000', 10.0),
+        ('111110', '', '00000', 10.0), ('11112', '', '00000', 20.0),
+        ('111120', '', '00000', 20.0), ('112', '', '00000', 5.0),
+        ('1121', '', '00000', 5.0), ('11211', '', '00000', 3.0),
+        ('112111', '', '00000', 3.0)]
+
+
+def test_sector_disaggregation():
+    """
+    Sectors with a single child sector at the next length are copied to the child,
+    unless the child exists
+    """
+    fbs = make_fbs([['1122', None, 4, '00000'], ['11111', None, 6, '00000'],
+                    [None, '2212', 8, '00000'], ['491', None, 1, '06000'],
+                    ['1133', None, 2, '00000'], ['11331', None, 2, '00000'],
+                    ['1113', None, 3, '00000']])
+    df = sector_disaggregation(fbs)
+    assert summarize_fbs(df) == [
+        ('', '2212', '00000', 8.0), ('', '22121', '00000', 8.0),
+        ('', '221210', '00000', 8.0), ('11111', '', '00000', 6.0),
+        ('111110', '', '00000', 6.0), ('1113', '', '00000', 3.0),
+        ('1122', '', '00000', 4.0), ('11221', '', '00000', 4.0),
+        ('112210', '', '00000', 4.0), ('1133', '', '00000', 2.0),
+        ('11331', '', '00000', 2.0), ('113310', '', '00000', 2.0),
+        ('491', '', '06000', 1.0), ('4911', '', '06000', 1.0),
+        ('49111', '', '06000', 1.0), ('491110', '', '06000', 1.0)]
+
+
+def test_allocate_dropped_sector_data():
+    """
+    Sectors without child sectors at the target level are equally allocated to the
+    child sectors at the target level
+    """
+    fbs = make_fbs([['1111', None, 12, '00000'], ['111110', None, 2, '00000'],
+                    ['11213', None, 6, '00000'], [None, '11211', 9, '00000']])
+    df = allocate_dropped_sector_data(fbs, 'NAICS_6')
+    assert 'spb_tmp' not in df.columns and 'scb_tmp' not in df.columns
+    assert summarize_fbs(df) == [
+        ('', '11211', '00000', 9.0), ('', '112111', '00000', 4.5),
+        ('', '112112', '00000', 4.5), ('1111', '', '00000', 12.0),
+        ('111110', '', '00000', 3.5), ('111120', '', '00000', 1.5),
+        ('111130', '', '00000', 1.5), ('111140', '', '00000', 1.5),
+        ('111150', '', '00000', 1.5), ('111160', '', '00000', 1.5),
+        ('111191', '', '00000', 1.5), ('111199', '', '00000', 1.5),
+        ('11213', '', '00000', 6.0), ('112130', '', '00000', 6.0)]
+
+
+def test_expand_naics_list():
+    """
+    Mapped sectors are expanded to all more detailed sectors, in crosswalk order,
+    including sectors also mapped to another activity
+    """
+    mapping = pd.DataFrame({'ActivitySourceName': 'Test',
+                            'Activity': ['a', 'b', 'c', 'd'],
+                            'Sector': ['1113', '2213', '11251', '22131'],
+                            'SectorType': None})
+    df = expand_naics_list(mapping, 'NAICS_2012_Code')
+    expanded = df.groupby('Activity', sort=True)['Sector'].apply(list).to_dict()
+    assert expanded == {
+        'a': ['1113', '11131', '111310', '11132', '111320', '11133', '111331', '111332',
+              '111333', '111334', '111335', '111336', '111339'],
+        'b': ['2213', '22131', '221310', '22132', '221320', '22133', '221330'],
+        'c': ['11251', '112511', '112512', '112519'],
+        'd': ['22131', '221310']}
+
+
+def test_standardize_units():
+    """
+    Land areas are converted to m2 and water flows per animal per day to kg, other
+    units are unchanged
+    """
+    df = pd.DataFrame({'Unit': ['ACRES', 'million sq ft', 'Mgal/d', 'gallons/animal/day',
+                                'Thousand Acres', 'kg', 'ac-ft/yr', 'Bgal/d'],
+                       'FlowAmount': [2.0, 1.0, 1.0, 10.0, 3.0, 5.0, 1.0, 1.0],
+                       'Class': ['Land', 'Land', 'Water', 'Water', 'Land', 'Water', 'Water',
+                                 'Water']})
+    df = standardize_units(df)
+    assert [(u, round(f, 4)) for u, f in zip(df['Unit'], df['FlowAmount'])] == [
+        ('m2', 8093.7128), ('m2', 92903.0), ('Mgal/d', 1.0), ('kg', 13833.5),
+        ('Thousand Acres', 3.0), ('kg', 5.0), ('ac-ft/yr', 1.0), ('Bgal/d', 1.0)]
@@ -12,9 +12,10 @@ from flowsa.flowbyfunctions import aggregator, create_geoscale_list,\
 from flowsa.dataclean import replace_strings_with_NoneType, \
     replace_NoneType_with_empty_cells
 from flowsa.common import US_FIPS, sector_level_key, \
-    load_sector_length_crosswalk, load_source_catalog, \
+    load_sector_descendant_crosswalk, load_source_catalog, \
     load_sector_crosswalk, SECTOR_SOURCE_NAME, log, fba_activity_fields, \
-    fbs_activity_fields, vLog, vLogDetailed, fba_default_grouping_fields
+    fbs_activity_fields, vLog, vLogDetailed, fba_default_grouping_fields, run_validation
+from flowsa.validationreport import write_validation_report, validation_report_run
 
 
 def check_flow_by_fields(flowby_df, flowbyfields):
@@ -147,98 +148,84 @@ def check_if_location_systems_match(df1, df2):
         vLog.warning("LocationSystems do not match, might lose county level data")
 
 
-def allocate_dropped_sector_data(df_load, target_sector_level):
+def allocate_dropped_sector_data(df_load, target_sector_level, source_name=None,
+                                 activity_set=None):
     """
     Determine rows of data that will be lost if subset data at target sector level
     Equally allocate parent NAICS to child NAICS where child NAICS missing
     :param df: df, FBS format
     :param target_sector_level: str, target NAICS level for FBS output
+    :param source_name: str, source name, used in the validation report
+    :param activity_set: str, activity set, used in the validation report
     :return: df, with all child NAICS at target sector level
     """
 
     # exclude nonsectors
     df = replace_NoneType_with_empty_cells(df_load)
 
+    target_length = sector_level_key[target_sector_level]
+    group_cols = ['Class', 'Context', 'FlowType', 'Flowable', 'Location',
+                  'LocationSystem', 'Unit', 'Year']
+    spb_len = df[fbs_activity_fields[0]].str.len()
+    scb_len = df[fbs_activity_fields[1]].str.len()
+    spb_empty = df[fbs_activity_fields[0]] == ''
+    scb_empty = df[fbs_activity_fields[1]] == ''
+
+    # sector length of the rows that might not be disaggregated further, ordered by length,
+    # then rows with only a sector produced, only a sector consumed, and both sectors
+    df_x = df.assign(
+        SectorLength=np.select([scb_empty, spb_empty, spb_len == scb_len],
+                               [spb_len, scb_len, spb_len], 0),
+        row_type=np.select([scb_empty, spb_empty], [0, 1], 2))
+    df_x = df_x[df_x['SectorLength'].between(2, target_length - 1)]
+    df_x = df_x.sort_values(['SectorLength', 'row_type'], kind='mergesort').drop(columns='row_type')
+
     rows_lost = pd.DataFrame()
-    for i in range(2, sector_level_key[target_sector_level]):
-        # create df of i length
-        df_x1 = df.loc[(df[fbs_activity_fields[0]].apply(lambda x: len(x) == i)) &
-                       (df[fbs_activity_fields[1]] == '')]
-        df_x2 = df.loc[(df[fbs_activity_fields[0]] == '') &
-                       (df[fbs_activity_fields[1]].apply(lambda x: len(x) == i))]
-        df_x3 = df.loc[(df[fbs_activity_fields[0]].apply(lambda x: len(x) == i)) &
-                       (df[fbs_activity_fields[1]].apply(lambda x: len(x) == i))]
-        df_x = pd.concat([df_x1, df_x2, df_x3], ignore_index=True, sort=False)
-
-        # create df of i + 1 length
-        df_y1 = df.loc[df[fbs_activity_fields[0]].apply(lambda x: len(x) == i + 1) |
-                       df[fbs_activity_fields[1]].apply(lambda x: len(x) == i + 1)]
-        df_y2 = df.loc[df[fbs_activity_fields[0]].apply(lambda x: len(x) == i + 1) &
-                       df[fbs_activity_fields[1]].apply(lambda x: len(x) == i + 1)]
-        df_y = pd.concat([df_y1, df_y2], ignore_index=True, sort=False)
-
-        # create temp sector columns in df y, that are i digits in length
-        df_y.loc[:, 'spb_tmp'] = df_y[fbs_activity_fields[0]].apply(lambda x: x[0:i])
-        df_y.loc[:, 'scb_tmp'] = df_y[fbs_activity_fields[1]].apply(lambda x: x[0:i])
+    if len(df_x) != 0:
+        # sectors one digit longer than each sector length, truncated to that length,
+        # are the parent sectors that are already disaggregated
+        df_y_list = []
+        for i in range(2, target_length):
+            df_y = df.loc[(spb_len == i + 1) | (scb_len == i + 1)]
+            df_y_list.append(df_y[group_cols].assign(
+                SectorLength=i,
+                SectorProducedBy=df_y[fbs_activity_fields[0]].str[0:i],
+                SectorConsumedBy=df_y[fbs_activity_fields[1]].str[0:i]))
+        df_y = pd.concat(df_y_list, ignore_index=True)
         # don't modify household sector lengths or gov't transport
-        df_y = df_y.replace({'F0': 'F010',
-                             'F01': 'F010'
-                             })
-
-        # merge the two dfs
-        df_m = pd.merge(df_x,
-                        df_y[['Class', 'Context', 'FlowType', 'Flowable',
-                              'Location', 'LocationSystem', 'Unit',
-                              'Year', 'spb_tmp', 'scb_tmp']],
-                        how='left',
-                        left_on=['Class', 'Context', 'FlowType', 'Flowable',
-                                 'Location', 'LocationSystem', 'Unit',
-                                 'Year', 'SectorProducedBy', 'SectorConsumedBy'],
-                        right_on=['Class', 'Context', 'FlowType', 'Flowable',
-                                  'Location', 'LocationSystem', 'Unit',
-                                  'Year', 'spb_tmp', 'scb_tmp'])
+        df_y[fbs_activity_fields] = df_y[fbs_activity_fields].replace({'F0': 'F010',
+                                                                       'F01': 'F010'
+                                                                       })
+        df_y = df_y.drop_duplicates()
 
         # extract the rows that are not disaggregated to more specific naics
-        rl = df_m[(df_m['scb_tmp'].isnull()) & (df_m['spb_tmp'].isnull())].reset_index(drop=True)
+        df_m = pd.merge(df_x, df_y, how='left', indicator=True,
+                        on=group_cols + ['SectorLength'] + fbs_activity_fields)
+        rows_lost = df_m[df_m['_merge'] == 'left_only'].drop(columns='_merge')
         # clean df
-        rl = replace_strings_with_NoneType(rl)
-        rl_list = rl[['SectorProducedBy', 'SectorConsumedBy']].drop_duplicates().values.tolist()
-
-        # match sectors with target sector length sectors
-
-        # import cw and subset to current sector length and target sector length
-        cw_load = load_sector_length_crosswalk()
-        nlength = list(sector_level_key.keys())[list(sector_level_key.values()).index(i)]
-        cw = cw_load[[nlength, target_sector_level]].drop_duplicates()
-        # add column with counts
-        cw['sector_count'] = cw.groupby(nlength)[nlength].transform('count')
-
-        # merge df & conditionally replace sector produced/consumed columns
-        rl_m = pd.merge(rl, cw, how='left', left_on=[fbs_activity_fields[0]], right_on=[nlength])
-        rl_m.loc[rl_m[fbs_activity_fields[0]] != '',
-                 fbs_activity_fields[0]] = rl_m[target_sector_level]
-        rl_m = rl_m.drop(columns=[nlength, target_sector_level])
-
-        rl_m2 = pd.merge(rl_m, cw, how='left', left_on=[fbs_activity_fields[1]], right_on=[nlength])
-        rl_m2.loc[rl_m2[fbs_activity_fields[1]] != '',
-                  fbs_activity_fields[1]] = rl_m2[target_sector_level]
-        rl_m2 = rl_m2.drop(columns=[nlength, target_sector_level])
-
-        # create one sector count column
-        rl_m2['sector_count_x'] = rl_m2['sector_count_x'].fillna(rl_m2['sector_count_y'])
-        rl_m3 = rl_m2.rename(columns={'sector_count_x': 'sector_count'})
-        rl_m3 = rl_m3.drop(columns=['sector_count_y'])
+        rows_lost = replace_strings_with_NoneType(rows_lost)
+
+    if len(rows_lost) != 0:
+        vLogDetailed.warning('Data found at %s digit NAICS not represented in current '
+                             'data subset', ', '.join(map(str, rows_lost['SectorLength'].unique())))
+        write_validation_report(rows_lost, 'dropped_sector_data', source_name, activity_set)
+
+        # match sectors with target sector length sectors, replacing sector
+        # produced/consumed columns with each of their descendants
+        cw = load_sector_descendant_crosswalk(target_sector_level)
+        for s in fbs_activity_fields:
+            rows_lost = pd.merge(rows_lost, cw, how='left',
+                                 left_on=['SectorLength', s],
+                                 right_on=['SectorLength', 'Sector'])
+            rows_lost[s] = rows_lost['Descendant']
+            rows_lost = rows_lost.drop(columns=['Sector', 'Descendant'])
 
         # calculate new flow amounts, based on sector count,
         # allocating equally to the new sector length codes
-        rl_m3['FlowAmount'] = rl_m3['FlowAmount'] / rl_m3['sector_count']
-        rl_m3 = rl_m3.drop(columns=['sector_count'])
-
-        # append to df
-        if len(rl) != 0:
-            vLogDetailed.warning('Data found at %s digit NAICS not represented in current '
-                        'data subset: {}'.format(' '.join(map(str, rl_list))), str(i))
-            rows_lost = rows_lost.append(rl_m3, ignore_index=True)
+        sector_count = rows_lost['DescendantCount_x'].fillna(rows_lost['DescendantCount_y'])
+        rows_lost['FlowAmount'] = rows_lost['FlowAmount'] / sector_count
+        rows_lost = rows_lost.drop(columns=['SectorLength', 'DescendantCount_x',
+                                            'DescendantCount_y']).reset_index(drop=True)
 
     if len(rows_lost) != 0:
         vLogDetailed.info('Allocating FlowAmounts equally to each %s associated with '
@@ -251,12 +238,13 @@ def allocate_dropped_sector_data(df_load, target_sector_level):
     return df_w_lost_data
 
 
-def check_allocation_ratios(flow_alloc_df_load, activity_set, config):
+def check_allocation_ratios(flow_alloc_df_load, activity_set, config, source_name=None):
     """
     Check for issues with the flow allocation ratios
     :param flow_alloc_df_load: df, includes 'FlowAmountRatio' column
     :param activity_set: str, activity set
     :param config: dictionary, method yaml
+    :param source_name: str, source name, used in the validation report
     :return: print out information regarding allocation ratios,
              save csv of results to local directory
     """
@@ -287,23 +275,31 @@ def check_allocation_ratios(flow_alloc_df_load, activity_set, config):
 
     # add to validation log
     log.info('Save the summary table of flow allocation ratios for each sector length for '
-              '%s in validation log', activity_set)
+              '%s in validation report', activity_set)
     # if df not empty, print, if empty, print string
     if flow_alloc_df5.empty:
         vLogDetailed.info('Flow allocation ratios for %s all round to 1', activity_set)
 
     else:
-        vLogDetailed.info('Flow allocation ratios for %s: '
-                          '\n {}'.format(flow_alloc_df5.to_string()), activity_set)
+        write_validation_report(flow_alloc_df5, 'allocation_ratios', source_name,
+                                activity_set)
 
 
-def calculate_flowamount_diff_between_dfs(dfa_load, dfb_load):
+def calculate_flowamount_diff_between_dfs(dfa_load, dfb_load, source_name=None,
+                                          activity_set=None):
     """
-    Calculate the differences in FlowAmounts between two dfs
+    Calculate the differences in FlowAmounts between two dfs, if the validation level
+    of the current FBS run is 'full'
     :param dfa_load: df, initial df
     :param dfb_load: df, modified df
-    :return: df, comparing changes in flowamounts between 2 dfs
+    :param source_name: str, source name, used in the validation report
+    :param activity_set: str, activity set, used in the validation report
+    :return: None, differences are saved to the validation report
     """
+    # data source cleaning functions do not receive the FBS method, so check the
+    # validation level of the current validation report run
+    if not run_validation(validation_report_run, 'full'):
+        return
 
     # subset the dataframes, only keeping data for easy comparison of flowamounts
     drop_cols = ['Year', 'MeasureofSpread', 'Spread', 'DistributionType',
@@ -333,9 +329,8 @@ def calculate_flowamount_diff_between_dfs(dfa_load, dfb_load):
     # determine if any new data is negative
     dfn = df[df['FlowAmount_Modified'] < 0].reset_index(drop=True)
     if len(dfn) > 0:
-        vLog.info('There are negative FlowAmounts in new dataframe, see Validation Log')
-        vLogDetailed.info('Negative FlowAmounts in new dataframe: '
-                          '\n {}'.format(dfn.to_string()))
+        vLog.info('There are negative FlowAmounts in new dataframe, see validation report')
+        write_validation_report(dfn, 'negative_flowamounts', source_name, activity_set)
 
     # Because code will sometimes change terminology, aggregate
     # data by context and flowable to compare df differences
@@ -368,12 +363,10 @@ def calculate_flowamount_diff_between_dfs(dfa_load, dfb_load):
                                         dfagg4['FlowAmount_Original']) * 100
         # drop rows where difference = 0
         dfagg5 = dfagg4[dfagg4['FlowAmount_Difference'] != 0].reset_index(drop=True)
-        vLogDetailed.info('Total FlowAmount differences between dataframes: '
-                          '\n {}'.format(dfagg5.to_string(), index=False))
+        write_validation_report(dfagg5, 'flowamount_diff_totals', source_name, activity_set)
 
-        # save detail output in log file
-        vLogDetailed.info('Total FlowAmount differences by Activity Columns: '
-                          '\n {}'.format(dfagg2.to_string(), index=False))
+        # save detail output in validation report
+        write_validation_report(dfagg2, 'flowamount_diff', source_name, activity_set)
 
 
 def compare_activity_to_sector_flowamounts(fba_load, fbs_load,
@@ -464,13 +457,13 @@ def compare_activity_to_sector_flowamounts(fba_load, fbs_load,
 
         # save to validation log
         log.info('Save the comparison of FlowByActivity load to FlowBySector ratios '
-                 'for %s in validation log', activity_set)
+                 'for %s in validation report', activity_set)
         # if df not empty, print, if empty, print string
         if df_v.empty:
             vLogDetailed.info('Ratios for %s all round to 1', activity_set)
         else:
-            vLogDetailed.info('Comparison of FlowByActivity load to FlowBySector ratios for %s: '
-                              '\n {}'.format(df_v.to_string()), activity_set)
+            write_validation_report(df_v, 'activity_to_sector_ratios', source_name,
+                                    activity_set)
 
 
 def compare_fba_geo_subset_and_fbs_output_totals(fba_load, fbs_load, activity_set,
@@ -586,14 +579,12 @@ def compare_fba_geo_subset_and_fbs_output_totals(fba_load, fbs_load, activity_se
 
         # log output
         log.info('Save the comparison of FlowByActivity load to FlowBySector '
-                  'total FlowAmounts for %s in validation log file', activity_set)
+                  'total FlowAmounts for %s in validation report', activity_set)
         # if df not empty, print, if empty, print string
         if df_v.empty:
             vLogDetailed.info('Percent difference for %s all round to 0', activity_set)
         else:
-            vLogDetailed.info('Comparison of FBA load to FBS total '
-                          'FlowAmounts for %s: '
-                          '\n {}'.format(df_v.to_string()), activity_set)
+            write_validation_report(df_v, 'fba_fbs_totals', source_name, activity_set)
     except:
         vLog.info('Error occurred when comparing total FlowAmounts '
                   'for FlowByActivity and FlowBySector')
@@ -918,10 +909,9 @@ def compare_geographic_totals(df_subset, df_load, sourcename, attr, activity_set
                       'level data and %s subset', attr['allocation_from_scale'])
         else:
             vLog.info('There are data differences between published national values '
-                      'and %s subset, saving to validation log', attr['allocation_from_scale'])
-
-            vLogDetailed.info('Comparison of National FlowAmounts to aggregated Data '
-                              'Subset for %s: \n {}'.format(df_m_sub.to_string()), activity_set)
+                      'and %s subset, saving to validation report',
+                      attr['allocation_from_scale'])
+            write_validation_report(df_m_sub, 'geographic_totals', sourcename, activity_set)
 
 
 def rename_column_values_for_comparison(df, sourcename):
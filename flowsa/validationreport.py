@@ -0,0 +1,203 @@
+# validationreport.py (flowsa)
+# !/usr/bin/env python3
+# coding=utf-8
+"""
+Store and load the comparison dataframes created by the validation functions. Each FBS
+run saves its reports as parquets in the local Validation folder, by method, run, report,
+source and activity set. The latest 10 runs of each method are kept. The validation log
+only includes one-line summaries.
+
+To list the reports of the latest run of a method, specify the method name:
+"Parameters: --m Water_national_2015_m1"
+To load a report: "Parameters: --m Water_national_2015_m1 --r allocation_ratios"
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import uuid
+from datetime import datetime
+import pandas as pd
+from esupy.processed_data_mgmt import create_paths_if_missing
+from flowsa.common import log, vLogDetailed, validationoutputpath, DEFAULT_VALIDATION_LEVEL
+
+# method name and folder of the current validation report run, if reports are saved, and
+# the validation level of the run
+validation_report_run = {'method': None, 'path': None, 'enabled': True,
+                         'validation_level': DEFAULT_VALIDATION_LEVEL}
+# number of validation report runs kept for each method, the oldest runs are removed
+# when a new run is started
+max_validation_runs = 10
+
+
+def parse_args():
+    """
+    Make report parameters
+    :return: dictionary, 'method', 'report', 'run', 'source', 'activity_set' and 'output'
+    """
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-m", "--method", required=True, help="FBS method name")
+    ap.add_argument("-r", "--report", default=None,
+                    help="Validation report to load, lists the reports if not specified")
+    ap.add_argument("-u", "--run", default=None, help="Run to load, defaults to the latest")
+    ap.add_argument("-s", "--source", default=None, help="Source name to filter by")
+    ap.add_argument("-a", "--activity_set", default=None, help="Activity set to filter by")
+    ap.add_argument("-o", "--output", default=None,
+                    help="csv file to save the report to, printed if not specified")
+    args = vars(ap.parse_args())
+    return args
+
+
+def start_validation_report_run(method_name, enabled=True,
+                                validation_level=DEFAULT_VALIDATION_LEVEL):
+    """
+    Start a new run of validation reports for a FBS method. Process pool workers are
+    forked after the run is started, so they save to the same run.
+    :param method_name: str, FBS method name
+    :param enabled: bool, False if reports are not saved
+    :param validation_level: str, 'off', 'summary' or 'full', used by validation
+           functions that are not passed the FBS method
+    :return: str, path of the run folder
+    """
+    # microseconds and the process id keep runs started in the same second separate,
+    # while runs still sort by start time
+    run = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{os.getpid()}"
+    validation_report_run['method'] = method_name
+    validation_report_run['path'] = f'{validationoutputpath}{method_name}/{run}/'
+    validation_report_run['enabled'] = enabled
+    validation_report_run['validation_level'] = validation_level
+    if enabled:
+        remove_old_validation_runs(method_name, max_validation_runs - 1)
+    return validation_report_run['path']
+
+
+def remove_old_validation_runs(method_name, keep):
+    """
+    Remove the oldest validation report runs saved for a FBS method
+    :param method_name: str, FBS method name
+    :param keep: int, number of the latest runs to keep
+    :return: None
+    """
+    runs = list_validation_runs(method_name)
+    for run in runs[:max(len(runs) - keep, 0)]:
+        shutil.rmtree(f'{validationoutputpath}{method_name}/{run}', ignore_errors=True)
+
+
+def write_validation_report(df, report, source_name=None, activity_set=None):
+    """
+    Save a validation comparison df to the current report run, logging a one-line
+    summary. Reports created outside of a FBS run are saved for the method 'Other'.
+    :param df: df, comparison to save
+    :param report: str, report name (ex. 'allocation_ratios')
+    :param source_name: str, source name
+    :param activity_set: str, activity set
+    :return: None
+    """
+    if not validation_report_run['enabled'] or len(df) == 0:
+        return
+    if validation_report_run['path'] is None:
+        start_validation_report_run('Other')
+    path = f"{validation_report_run['path']}{report}/"
+    create_paths_if_missing(path)
+    df = df.assign(MethodName=validation_report_run['method'],
+                   SourceName=source_name if source_name is not None else
+                   df.get('SourceName'),
+                   ActivitySet=activity_set)
+    # a report can be saved more than once for a source and activity set
+    f = f'{path}{source_name}_{activity_set}_{uuid.uuid4().hex[0:8]}.parquet'
+    try:
+        df.reset_index(drop=True).to_parquet(f)
+    except (ValueError, TypeError):
+        df.astype(str).reset_index(drop=True).to_parquet(f)
+    vLogDetailed.info('Saved %s rows to the %s validation report for %s %s',
+                      len(df), report, source_name, activity_set)
+
+
+def list_validation_runs(method_name):
+    """
+    List the validation report runs saved for a FBS method
+    :param method_name: str, FBS method name
+    :return: list, runs, ordered oldest to latest
+    """
+    path = f'{validationoutputpath}{method_name}/'
+    if not os.path.isdir(path):
+        return []
+    return sorted(r for r in os.listdir(path) if os.path.isdir(path + r))
+
+
+def get_validation_run_path(method_name, run=None):
+    """
+    Generate the path of a validation report run
+    :param method_name: str, FBS method name
+    :param run: str, run, defaults to the latest run
+    :return: str, path of the run folder
+    """
+    if run is None:
+        runs = list_validation_runs(method_name)
+        if len(runs) == 0:
+            raise FileNotFoundError(f'No validation reports saved for {method_name}')
+        run = runs[-1]
+    return f'{validationoutputpath}{method_name}/{run}/'
+
+
+def list_validation_reports(method_name, run=None):
+    """
+    List the validation reports of a run
+    :param method_name: str, FBS method name
+    :param run: str, run, defaults to the latest run
+    :return: dictionary, report name and number of files saved
+    """
+    path = get_validation_run_path(method_name, run)
+    return {r: len(glob.glob(f'{path}{r}/*.parquet')) for r in sorted(os.listdir(path))}
+
+
+def load_validation_report(method_name, report, run=None, source_name=None,
+                           activity_set=None):
+    """
+    Load a validation report, optionally filtered by source and activity set
+    :param method_name: str, FBS method name
+    :param report: str, report name (ex. 'allocation_ratios')
+    :param run: str, run, defaults to the latest run
+    :param source_name: str, source name to filter by
+    :param activity_set: str, activity set to filter by
+    :return: df, report
+    """
+    files = sorted(glob.glob(f'{get_validation_run_path(method_name, run)}{report}/*.parquet'))
+    if len(files) == 0:
+        log.info('No %s validation report for %s', report, method_name)
+        return pd.DataFrame()
+    df = pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
+    if source_name is not None:
+        df = df[df['SourceName'] == source_name]
+    if activity_set is not None:
+        df = df[df['ActivitySet'] == activity_set]
+    return df.reset_index(drop=True)
+
+
+def main(**kwargs):
+    """
+    List the validation reports of a FBS method run, or load a report
+    :param kwargs: dictionary, parameters in parse_args
+    :return: dictionary of reports or df, report
+    """
+    if len(kwargs) == 0:
+        kwargs = parse_args()
+
+    if kwargs.get('report') is None:
+        reports = list_validation_reports(kwargs['method'], kwargs.get('run'))
+        for r, n in reports.items():
+            print(f'{r}: {n} file(s)')
+        return reports
+
+    df = load_validation_report(kwargs['method'], kwargs['report'], kwargs.get('run'),
+                                kwargs.get('source'), kwargs.get('activity_set'))
+    if kwargs.get('output'):
+        df.to_csv(kwargs['output'], index=False)
+    else:
+        print(df.to_string())
+    return df
+
+
+if __name__ == '__main__':
+    main()
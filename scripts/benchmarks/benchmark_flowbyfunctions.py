@@ -0,0 +1,184 @@
+# benchmark_flowbyfunctions.py (scripts)
+# !/usr/bin/env python3
+# coding=utf-8
+
+"""
+Time and memory-profile the functions used to create FlowBySector dfs, on synthetic
+dfs of increasing size. Results are compared to stored baselines, flagging
+functions that are slower or use more memory than the baseline by more than a threshold.
+EX: --rows 10000 100000 --save_baseline
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from esupy.processed_data_mgmt import create_paths_if_missing
+from flowsa.common import outputpath, fbs_default_grouping_fields, \
+    flow_by_activity_mapped_fields, fba_fill_na_dict
+from flowsa.dataclean import clean_df
+from flowsa.flowbyfunctions import aggregator, sector_aggregation, sector_disaggregation, \
+    subset_df_by_geoscale, estimate_suppressed_data
+from flowsa.validation import allocate_dropped_sector_data, \
+    replace_naics_w_naics_from_another_year
+from flowsa.validationreport import start_validation_report_run
+from synthetic_flowby import generate_flowbysector, generate_flowbyactivity_with_sectors
+
+benchmarkoutputpath = outputpath + 'Benchmarks/'
+baseline_file = benchmarkoutputpath + 'flowbyfunctions_baseline.json'
+
+# functions benchmarked, the synthetic df each function is run on, and the function call
+benchmarks = {
+    'aggregator': ('fbs', lambda df: aggregator(df, fbs_default_grouping_fields)),
+    'sector_aggregation': ('fbs', lambda df: sector_aggregation(df, fbs_default_grouping_fields)),
+    'sector_disaggregation': ('fbs', sector_disaggregation),
+    'allocate_dropped_sector_data': ('fbs', lambda df: allocate_dropped_sector_data(
+        df, 'NAICS_6')),
+    'subset_df_by_geoscale': ('fba_mapped', lambda df: subset_df_by_geoscale(
+        df, 'state', 'state')),
+    'estimate_suppressed_data': ('fba', lambda df: estimate_suppressed_data(
+        df, 'SectorProducedBy', 3, 'BLS_QCEW')),
+    'replace_naics_w_naics_from_another_year': ('fbs_other_years', lambda df:
+                                                replace_naics_w_naics_from_another_year(
+                                                    df, 'NAICS_2012_Code')),
+}
+
+
+def parse_args():
+    """
+    Make benchmark parameters
+    :return: dictionary, benchmark parameters
+    """
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-r", "--rows", type=int, nargs='+', default=[10000, 100000, 1000000],
+                    help="Row counts of the synthetic dfs")
+    ap.add_argument("-f", "--functions", nargs='+', default=list(benchmarks),
+                    choices=list(benchmarks), help="Functions to benchmark")
+    ap.add_argument("-l", "--locations", type=int, default=50,
+                    help="Number of locations in the synthetic dfs")
+    ap.add_argument("-z", "--suppressed_share", type=float, default=0.05,
+                    help="Share of rows with suppressed (zero) flows")
+    ap.add_argument("-n", "--repeat", type=int, default=3,
+                    help="Number of times to time each function, the fastest is kept")
+    ap.add_argument("-t", "--threshold", type=float, default=0.2,
+                    help="Allowed increase over the baseline time and memory, "
+                         "as a share of the baseline")
+    ap.add_argument("-s", "--save_baseline", action='store_true',
+                    help="Save the results as the baseline")
+    args = vars(ap.parse_args())
+    return args
+
+
+def generate_benchmark_df(df_type, n_rows, n_locations, suppressed_share):
+    """
+    Generate the synthetic df a function is benchmarked on
+    :param df_type: str, 'fbs', 'fbs_other_years', 'fba' or 'fba_mapped'
+    :param n_rows: int, number of rows
+    :param n_locations: int, number of locations
+    :param suppressed_share: float, share of rows with a FlowAmount of 0
+    :return: df
+    """
+    if df_type == 'fbs':
+        return generate_flowbysector(n_rows, n_locations=n_locations,
+                                     suppressed_share=suppressed_share)
+    if df_type == 'fbs_other_years':
+        return generate_flowbysector(n_rows, n_locations=n_locations,
+                                     suppressed_share=suppressed_share,
+                                     other_year_share=0.1)
+    df = generate_flowbyactivity_with_sectors(n_rows, n_locations=n_locations,
+                                              suppressed_share=suppressed_share)
+    if df_type == 'fba_mapped':
+        df = clean_df(df.assign(Flowable=df['FlowName'], Description=''),
+                      flow_by_activity_mapped_fields, fba_fill_na_dict, drop_description=False)
+    return df
+
+
+def run_benchmark(fxn, df, repeat):
+    """
+    Time a function and measure the peak memory allocated while it runs
+    :param fxn: function, called on a copy of df
+    :param df: df
+    :param repeat: int, number of times to time the function
+    :return: dictionary, fastest 'seconds' and 'peak_mb'
+    """
+    seconds = []
+    for _ in range(repeat):
+        df_copy = df.copy()
+        start = time.perf_counter()
+        fxn(df_copy)
+        seconds.append(time.perf_counter() - start)
+    # measure memory separately, as tracing allocations slows the function
+    df_copy = df.copy()
+    tracemalloc.start()
+    fxn(df_copy)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': min(seconds), 'peak_mb': peak / 1e6}
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """
+    List the benchmarks slower or using more memory than the baseline by more than
+    the threshold
+    :param results: dictionary, benchmark results keyed by function and row count
+    :param baseline: dictionary, baseline results keyed by function and row count
+    :param threshold: float, allowed increase as a share of the baseline
+    :return: list, descriptions of the regressions
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        for measure in ['seconds', 'peak_mb']:
+            if result[measure] > baseline[key][measure] * (1 + threshold):
+                regressions.append(f'{key} {measure}: {result[measure]:.3f} > '
+                                   f'baseline {baseline[key][measure]:.3f}')
+    return regressions
+
+
+def main(**kwargs):
+    """
+    Run the benchmarks, comparing the results to the stored baseline
+    :param kwargs: dictionary, parameters in parse_args
+    :return: dictionary, benchmark results, and list of regressions
+    """
+    if len(kwargs) == 0:
+        kwargs = parse_args()
+    # do not time saving validation reports
+    start_validation_report_run('Benchmark', enabled=False, validation_level='off')
+
+    results = {}
+    for n_rows in kwargs['rows']:
+        dfs = {}
+        for function_name in kwargs['functions']:
+            df_type, fxn = benchmarks[function_name]
+            if df_type not in dfs:
+                dfs[df_type] = generate_benchmark_df(df_type, n_rows, kwargs['locations'],
+                                                     kwargs['suppressed_share'])
+            key = f'{function_name}_{n_rows}'
+            results[key] = run_benchmark(fxn, dfs[df_type], kwargs['repeat'])
+            print(f"{key}: {results[key]['seconds']:.3f} s, "
+                  f"{results[key]['peak_mb']:.1f} MB peak")
+
+    baseline = {}
+    if os.path.isfile(baseline_file):
+        with open(baseline_file, 'r') as f:
+            baseline = json.load(f)
+    regressions = compare_to_baseline(results, baseline, kwargs['threshold'])
+    for r in regressions:
+        print(f'Regression: {r}')
+
+    if kwargs['save_baseline']:
+        create_paths_if_missing(benchmarkoutputpath)
+        baseline.update(results)
+        with open(baseline_file, 'w') as f:
+            json.dump(baseline, f, indent=2)
+        print(f'Saved baseline to {baseline_file}')
+    return results, regressions
+
+
+if __name__ == '__main__':
+    if main()[1]:
+        sys.exit(1)
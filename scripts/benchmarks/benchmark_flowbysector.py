@@ -0,0 +1,231 @@
+# benchmark_flowbysector.py (scripts)
+# !/usr/bin/env python3
+# coding=utf-8
+
+"""
+Time complete FlowBySector methods against frozen fixture FBAs, to track the throughput
+of the whole pipeline across releases.
+
+'freeze' copies the locally saved FBAs the methods depend on, and a snapshot of the
+fedelemflowlist flow mappings, to a fixture folder. 'run' generates each method in a
+separate process, in an empty local data directory (FLOWSA_LOCAL_PATH) holding only the
+fixture FBAs, so no stored FBSs, activity sets or allocation FBAs are reused, and flows
+are mapped with the snapshot. Wall time, peak RSS and the time of each source activity
+set, summed from the stage times saved by flowbysector, are reported and saved to the
+results file.
+EX: freeze --method Water_national_2015_m1 Land_national_2012 Employment_national_2017
+EX: run
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import pandas as pd
+
+benchmarkpath = os.path.dirname(os.path.abspath(__file__)).replace('\\', '/') + '/'
+default_fixturepath = benchmarkpath + 'fixtures/'
+flowmapping_snapshot = 'fedelemflowlist_flowmapping.parquet'
+manifest_file = 'manifest.json'
+default_methods = ['Water_national_2015_m1', 'Land_national_2012', 'Employment_national_2017']
+
+
+def parse_args():
+    """
+    Make benchmark parameters
+    :return: dictionary, benchmark parameters
+    """
+    ap = argparse.ArgumentParser()
+    ap.add_argument("command", choices=['freeze', 'run', 'method'],
+                    help="'freeze' the fixture FBAs, 'run' the benchmark, or generate a "
+                         "single 'method', as called by 'run'")
+    ap.add_argument("-m", "--method", nargs='+', default=default_methods,
+                    help="FBS method(s) to freeze the fixtures for, 'run' generates the "
+                         "methods in the fixture manifest")
+    ap.add_argument("-x", "--fixtures", default=default_fixturepath,
+                    help="Folder of the fixture FBAs and flow mapping snapshot")
+    ap.add_argument("-o", "--output", default=None,
+                    help="Results json file, defaults to the Benchmarks folder in the "
+                         "local flowsa output folder")
+    args = vars(ap.parse_args())
+    return args
+
+
+def freeze_fixtures(method_names, fixturepath):
+    """
+    Copy the local FBAs FBS methods depend on, and the fedelemflowlist flow mappings,
+    to the fixture folder
+    :param method_names: list, FBS method names
+    :param fixturepath: str, fixture folder
+    :return: dictionary, fixture manifest
+    """
+    import fedelemflowlist
+    from esupy.processed_data_mgmt import create_paths_if_missing
+    from flowsa.build import resolve_build_order
+    from flowsa.common import fbaoutputpath, PKG_VERSION_NUMBER
+    from flowsa.flowbyactivity import set_fba_name, find_local_fba
+    from flowsa.metadata import set_fb_meta
+
+    fbas, fbs_order = resolve_build_order(method_names)
+    fbapath = fixturepath + 'FlowByActivity/'
+    if os.path.exists(fbapath):
+        shutil.rmtree(fbapath)
+    create_paths_if_missing(fbapath)
+    fba_files = []
+    for source, year in fbas:
+        f = find_local_fba(set_fb_meta(set_fba_name(source, year), "FlowByActivity"))
+        if f is None:
+            raise FileNotFoundError(f'No local FBA for {source} {year}, generate it '
+                                    f'before freezing the fixtures')
+        relpath = os.path.relpath(f, fbaoutputpath)
+        if os.path.isdir(f):
+            shutil.copytree(f, fbapath + relpath)
+        else:
+            create_paths_if_missing(os.path.dirname(fbapath + relpath) + '/')
+            shutil.copy2(f, fbapath + relpath)
+        fba_files.append(relpath.replace('\\', '/'))
+
+    fedelemflowlist.get_flowmapping().to_parquet(fixturepath + flowmapping_snapshot,
+                                                 index=False)
+    manifest = {'methods': fbs_order,
+                'fbas': fba_files,
+                'flowsa_version': PKG_VERSION_NUMBER,
+                'fedelemflowlist_version': getattr(fedelemflowlist, '__version__', None)}
+    with open(fixturepath + manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def use_flowmapping_snapshot(fixturepath):
+    """
+    Map flows with the fedelemflowlist flow mapping snapshot in the fixture folder
+    rather than the installed fedelemflowlist mappings
+    :param fixturepath: str, fixture folder
+    :return: None
+    """
+    import fedelemflowlist
+    snapshot = pd.read_parquet(fixturepath + flowmapping_snapshot)
+
+    def get_flowmapping(source=None):
+        if source is None:
+            return snapshot.copy()
+        if isinstance(source, str):
+            source = [source]
+        return snapshot[snapshot['SourceListName'].isin(source)].reset_index(drop=True)
+
+    fedelemflowlist.get_flowmapping = get_flowmapping
+
+
+def load_activity_set_times(method_name):
+    """
+    Sum the stage times recorded by flowbysector for each source and activity set, as
+    activity set names are reused across the sources of a method
+    :param method_name: str, FBS method name
+    :return: dictionary, seconds keyed by source and activity set
+    """
+    from flowsa.common import fbsoutputpath
+    files = glob.glob(f'{glob.escape(fbsoutputpath + method_name)}_v*_stage_times.json')
+    if len(files) == 0:
+        return {}
+    with open(max(files, key=os.path.getmtime), 'r') as f:
+        stage_times = json.load(f)
+    activity_sets = {}
+    for s in stage_times:
+        if s['activity_set'] is None:
+            continue
+        source_times = activity_sets.setdefault(s['source'], {})
+        source_times[s['activity_set']] = round(
+            source_times.get(s['activity_set'], 0) + s['wall_seconds'], 3)
+    return activity_sets
+
+
+def generate_method(method_name, fixturepath):
+    """
+    Generate a FBS method, run in the process started by run_benchmark
+    :param method_name: str, FBS method name
+    :param fixturepath: str, fixture folder
+    :return: dictionary, wall time, peak RSS and activity set times
+    """
+    import flowsa.flowbysector
+    from flowsa.common import get_peak_rss_mb
+
+    use_flowmapping_snapshot(fixturepath)
+    start = time.perf_counter()
+    flowsa.flowbysector.main(method=method_name)
+    return {'seconds': round(time.perf_counter() - start, 3),
+            'peak_rss_mb': get_peak_rss_mb(),
+            'activity_sets': load_activity_set_times(method_name)}
+
+
+def run_benchmark(fixturepath):
+    """
+    Generate the FBS methods in the fixture manifest, each in a new process, in a
+    temporary local data directory holding the fixture FBAs
+    :param fixturepath: str, fixture folder
+    :return: dictionary, results of each method
+    """
+    with open(fixturepath + manifest_file, 'r') as f:
+        manifest = json.load(f)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as localpath:
+        shutil.copytree(fixturepath + 'FlowByActivity', localpath + '/FlowByActivity')
+        env = dict(os.environ, FLOWSA_LOCAL_PATH=localpath)
+        # methods are ordered so FBSs used as sources are generated first
+        for method_name in manifest['methods']:
+            with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+                resultfile = f.name
+            subprocess.run([sys.executable, os.path.abspath(__file__), 'method',
+                            '--method', method_name, '--fixtures', fixturepath,
+                            '--output', resultfile], env=env, check=True)
+            with open(resultfile, 'r') as f:
+                results[method_name] = json.load(f)
+            os.remove(resultfile)
+            print(f"{method_name}: {results[method_name]['seconds']:.1f} s, "
+                  f"{results[method_name]['peak_rss_mb']} MB peak RSS")
+            for source, activity_sets in results[method_name]['activity_sets'].items():
+                for aset, seconds in activity_sets.items():
+                    print(f'    {source} {aset}: {seconds:.1f} s')
+    return {'fixtures': manifest, 'results': results}
+
+
+def main(**kwargs):
+    """
+    Freeze the fixtures, or run the benchmark
+    :param kwargs: dictionary, parameters in parse_args
+    :return: dictionary, fixture manifest or benchmark results
+    """
+    if len(kwargs) == 0:
+        kwargs = parse_args()
+    fixturepath = kwargs['fixtures'].replace('\\', '/').rstrip('/') + '/'
+
+    if kwargs['command'] == 'freeze':
+        return freeze_fixtures(kwargs['method'], fixturepath)
+    if kwargs['command'] == 'method':
+        result = generate_method(kwargs['method'][0], fixturepath)
+        with open(kwargs['output'], 'w') as f:
+            json.dump(result, f)
+        return result
+
+    results = run_benchmark(fixturepath)
+    results['timestamp'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    outputfile = kwargs['output']
+    if outputfile is None:
+        from esupy.processed_data_mgmt import create_paths_if_missing
+        from flowsa.common import outputpath, PKG_VERSION_NUMBER
+        create_paths_if_missing(outputpath + 'Benchmarks/')
+        outputfile = f"{outputpath}Benchmarks/flowbysector_v{PKG_VERSION_NUMBER}_" \
+                     f"{time.strftime('%Y%m%d%H%M%S')}.json"
+    with open(outputfile, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Saved results to {outputfile}')
+    return results
+
+
+if __name__ == '__main__':
+    main()
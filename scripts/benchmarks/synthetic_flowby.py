@@ -0,0 +1,166 @@
+# synthetic_flowby.py (scripts)
+# !/usr/bin/env python3
+# coding=utf-8
+
+"""
+Generate synthetic FlowByActivity (with sectors) and FlowBySector dfs for benchmarking.
+Row count, number of locations, the distribution of NAICS lengths and the share of
+suppressed (zero) flows can be set.
+"""
+
+import numpy as np
+import pandas as pd
+from flowsa.common import load_sector_crosswalk, get_state_FIPS, get_county_FIPS, \
+    US_FIPS, flow_by_sector_fields, flow_by_activity_wsec_fields, fbs_fill_na_dict, \
+    fba_fill_na_dict
+from flowsa.dataclean import clean_df
+
+# share of NAICS codes drawn at each NAICS length
+default_naics_depth = {2: 0.1, 3: 0.15, 4: 0.2, 5: 0.2, 6: 0.35}
+
+
+def list_naics_by_length(sectorsourcename='NAICS_2012_Code', other_year_share=0.0):
+    """
+    List the NAICS codes of a NAICS year by code length
+    :param sectorsourcename: str, sector source name (ex. NAICS_2012_Code)
+    :param other_year_share: float, share of codes drawn from the other NAICS years
+           in the crosswalk, used to create sectors that must be replaced
+    :return: dictionary, code length and array of codes
+    """
+    cw = load_sector_crosswalk()
+    codes = pd.Series(cw[sectorsourcename].dropna().unique())
+    if other_year_share > 0:
+        other_codes = pd.Series(pd.unique(cw.drop(columns=sectorsourcename).values.ravel()))
+        other_codes = other_codes[other_codes.notnull() & ~other_codes.isin(codes)]
+        n_other = int(len(codes) * other_year_share)
+        codes = pd.concat([codes, other_codes.sample(min(n_other, len(other_codes)),
+                                                     random_state=0)])
+    return {length: codes[codes.str.len() == length].values for length in range(2, 7)}
+
+
+def list_locations(n_locations, geoscale='state'):
+    """
+    List FIPS codes at a geographic scale, including the national FIPS
+    :param n_locations: int, number of FIPS to return, excluding the national FIPS
+    :param geoscale: str, 'state' or 'county'
+    :return: list, FIPS codes
+    """
+    if geoscale == 'county':
+        fips = get_county_FIPS('2015')['FIPS']
+    else:
+        fips = get_state_FIPS('2015')['FIPS']
+    return [US_FIPS] + list(fips[fips != US_FIPS].iloc[0:n_locations])
+
+
+def draw_sectors(rng, n, naics_by_length, naics_depth):
+    """
+    Draw NAICS codes with the given distribution of code lengths
+    :param rng: numpy Generator
+    :param n: int, number of codes
+    :param naics_by_length: dictionary, see list_naics_by_length
+    :param naics_depth: dictionary, NAICS length and share of codes at the length
+    :return: array, NAICS codes
+    """
+    lengths = np.array(list(naics_depth))
+    weights = np.array(list(naics_depth.values()), dtype=float)
+    drawn_lengths = rng.choice(lengths, n, p=weights / weights.sum())
+    sectors = np.empty(n, dtype=object)
+    for length in lengths:
+        rows = drawn_lengths == length
+        sectors[rows] = rng.choice(naics_by_length[length], rows.sum())
+    return sectors
+
+
+def generate_flowbysector(n_rows, n_locations=10, geoscale='state', naics_depth=None,
+                          suppressed_share=0.05, both_sectors_share=0.2,
+                          sectorsourcename='NAICS_2012_Code', other_year_share=0.0, seed=0):
+    """
+    Generate a synthetic FlowBySector df
+    :param n_rows: int, number of rows
+    :param n_locations: int, number of locations, in addition to the national location
+    :param geoscale: str, 'state' or 'county', scale of the locations
+    :param naics_depth: dictionary, NAICS length and share of sectors at the length,
+           defaults to default_naics_depth
+    :param suppressed_share: float, share of rows with a FlowAmount of 0
+    :param both_sectors_share: float, share of rows with both a SectorProducedBy and a
+           SectorConsumedBy, the remaining rows are split between the two sector columns
+    :param sectorsourcename: str, sector source name (ex. NAICS_2012_Code)
+    :param other_year_share: float, see list_naics_by_length
+    :param seed: int, random seed
+    :return: df, FBS format
+    """
+    rng = np.random.default_rng(seed)
+    naics_by_length = list_naics_by_length(sectorsourcename, other_year_share)
+    naics_depth = naics_depth or default_naics_depth
+
+    spb = draw_sectors(rng, n_rows, naics_by_length, naics_depth)
+    scb = draw_sectors(rng, n_rows, naics_by_length, naics_depth)
+    r = rng.random(n_rows)
+    produced_only = r < (1 - both_sectors_share) / 2
+    consumed_only = (r >= (1 - both_sectors_share) / 2) & (r < 1 - both_sectors_share)
+    spb[consumed_only] = None
+    scb[produced_only] = None
+
+    df = pd.DataFrame({
+        'Flowable': rng.choice(['Water', 'Land', 'Carbon dioxide'], n_rows),
+        'Class': 'Other',
+        'SectorProducedBy': spb,
+        'SectorConsumedBy': scb,
+        'SectorSourceName': sectorsourcename,
+        'Context': rng.choice(['ground', 'surface', 'air'], n_rows),
+        'Location': rng.choice(list_locations(n_locations, geoscale), n_rows),
+        'LocationSystem': 'FIPS_2015',
+        'FlowAmount': np.where(rng.random(n_rows) < suppressed_share, 0.0,
+                               rng.random(n_rows) * 1000),
+        'Unit': 'kg',
+        'FlowType': 'ELEMENTARY_FLOW',
+        'Year': 2015,
+        'DataReliability': rng.integers(1, 6, n_rows).astype(float),
+        'DataCollection': rng.integers(1, 6, n_rows).astype(float),
+        'MetaSources': 'Synthetic',
+    })
+    return clean_df(df, flow_by_sector_fields, fbs_fill_na_dict)
+
+
+def generate_flowbyactivity_with_sectors(n_rows, n_locations=10, geoscale='county',
+                                         naics_depth=None, suppressed_share=0.05,
+                                         sourcename='BLS_QCEW',
+                                         sectorsourcename='NAICS_2012_Code', seed=0):
+    """
+    Generate a synthetic FlowByActivity df with sector-like activities and sectors
+    :param n_rows: int, number of rows
+    :param n_locations: int, number of locations, in addition to the national location
+    :param geoscale: str, 'state' or 'county', scale of the locations
+    :param naics_depth: dictionary, NAICS length and share of sectors at the length,
+           defaults to default_naics_depth
+    :param suppressed_share: float, share of rows with a FlowAmount of 0
+    :param sourcename: str, source name, a source in the source catalog with
+           sector-like activities
+    :param sectorsourcename: str, sector source name (ex. NAICS_2012_Code)
+    :param seed: int, random seed
+    :return: df, FBA format with sector columns
+    """
+    rng = np.random.default_rng(seed)
+    naics_by_length = list_naics_by_length(sectorsourcename)
+    naics_depth = naics_depth or default_naics_depth
+
+    sectors = draw_sectors(rng, n_rows, naics_by_length, naics_depth)
+    df = pd.DataFrame({
+        'Class': 'Employment',
+        'SourceName': sourcename,
+        'FlowName': rng.choice(['Number of employees', 'Number of establishments'],
+                               n_rows),
+        'FlowAmount': np.where(rng.random(n_rows) < suppressed_share, 0.0,
+                               rng.random(n_rows) * 1000),
+        'Unit': 'p',
+        'FlowType': 'ELEMENTARY_FLOW',
+        'ActivityProducedBy': sectors,
+        'Location': rng.choice(list_locations(n_locations, geoscale), n_rows),
+        'LocationSystem': 'FIPS_2015',
+        'Year': 2015,
+        'DataReliability': 5.0,
+        'DataCollection': 5.0,
+        'SectorProducedBy': sectors,
+        'SectorSourceName': sectorsourcename,
+    })
+    return clean_df(df, flow_by_activity_wsec_fields, fba_fill_na_dict)